@@ -4,8 +4,14 @@ import sys
 
 sys.path.append('src/main/python')
 
+from pypiproxy.configuration import Configuration
+from pypiproxy import server
+
+configuration = Configuration("./pypiproxy.cfg")
+server.prepare(configuration.server_mode)
+
 from pypiproxy.webapp import application
 from pypiproxy import initialize
 
 initialize("./pypiproxy.cfg")
-application.run(debug=True)
+server.run(application, configuration.server_mode, debug=True)
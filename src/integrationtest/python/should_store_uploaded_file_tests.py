@@ -11,7 +11,7 @@ def integration_test():
                               .package_name("foobar").package_version("1.0.0").to(liveserver)
 
         assert_that(status_code).is_equal_to(OK)
-        assert_that("target/integrationtest/packages/hosted/foobar-1.0.0.tar.gz").is_a_file()
+        assert_that("target/integrationtest/packages/hosted/f/foobar/foobar-1.0.0.tar.gz").is_a_file()
 
 if __name__=='__main__':
     run_tests()
@@ -24,11 +24,33 @@ from .configuration import Configuration
 from .services import initialize_services
 
 
-def initialize(config_file):
+def initialize(config_file, defer_background_tasks=False):
     current_configuration = Configuration(config_file)
     initialize_logging(current_configuration.log_file)
     initialize_services(current_configuration.hosted_packages_directory,
-                        current_configuration.cached_packages_directory, current_configuration.pypi_url)
+                        current_configuration.cached_packages_directory, current_configuration.pypi_urls,
+                        watch_package_directories=current_configuration.watch_package_directories,
+                        watch_polling_interval=current_configuration.watch_polling_interval,
+                        stream_upstream_downloads=current_configuration.stream_upstream_downloads,
+                        version_cache_directory=current_configuration.version_cache_directory,
+                        version_cache_time_to_live=current_configuration.version_cache_time_to_live,
+                        upstream_pool_size=current_configuration.upstream_pool_size,
+                        upstream_connect_timeout=current_configuration.upstream_connect_timeout,
+                        upstream_read_timeout=current_configuration.upstream_read_timeout,
+                        upstream_index_snapshot=current_configuration.upstream_index_snapshot,
+                        upstream_index_refresh_interval=current_configuration.upstream_index_refresh_interval,
+                        static_export_directory=current_configuration.static_export_directory,
+                        static_export_interval=current_configuration.static_export_interval,
+                        defer_background_tasks=defer_background_tasks,
+                        negative_cache_time_to_live=current_configuration.negative_cache_time_to_live,
+                        negative_cache_maximum_entries=current_configuration.negative_cache_size,
+                        upstream_failure_threshold=current_configuration.upstream_failure_threshold,
+                        upstream_reset_timeout=current_configuration.upstream_reset_timeout,
+                        upstream_hedge_delay=current_configuration.upstream_hedge_delay,
+                        cached_packages_size_limit=current_configuration.cached_packages_size_limit,
+                        eviction_policy=current_configuration.cached_packages_eviction_policy,
+                        eviction_interval=current_configuration.cached_packages_eviction_interval,
+                        eviction_grace_period=current_configuration.cached_packages_eviction_grace_period)
     log_dir = os.path.dirname(current_configuration.log_file)
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
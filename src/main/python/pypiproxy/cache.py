@@ -0,0 +1,257 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import collections
+import errno
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+from . import layout, metrics
+
+LOGGER = logging.getLogger("pypiproxy.cache")
+
+DEFAULT_VERSION_CACHE_TIME_TO_LIVE = 300
+DEFAULT_NEGATIVE_CACHE_TIME_TO_LIVE = 120
+DEFAULT_NEGATIVE_CACHE_MAXIMUM_ENTRIES = 10000
+
+Validators = collections.namedtuple("Validators", ["etag", "last_modified", "size"])
+
+
+class VersionCacheEntry(object):
+    def __init__(self, versions, fetched_at, validators=None):
+        self.versions = versions
+        self.fetched_at = fetched_at
+        self.validators = validators
+
+
+class VersionCache(object):
+    """
+    Keeps the versions listed on the upstream version page of each package, in memory and persisted as one JSON
+    file per package below the given directory, so that the cache survives restarts. Entries older than the time
+    to live are stale but are still returned; it is up to the caller to refresh them.
+    """
+
+    def __init__(self, directory, time_to_live=DEFAULT_VERSION_CACHE_TIME_TO_LIVE):
+        self._directory = directory
+        self._time_to_live = time_to_live
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory)
+
+    def get(self, name):
+        """
+            Entries are loaded from their file on first use; misses are not remembered, so that requests for
+            unknown package names do not fill the memory.
+            @return: the VersionCacheEntry for the given package name or None
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                entry = self._load(name)
+                if entry is not None:
+                    self._entries[name] = entry
+            return entry
+
+    def is_stale(self, entry):
+        return time.time() - entry.fetched_at > self._time_to_live
+
+    def put(self, name, versions, validators=None):
+        """
+            Stores the versions of the given package name, together with the validators of the upstream response
+            they were read from, and restarts the time to live of the entry.
+        """
+        entry = VersionCacheEntry(list(versions), time.time(), validators)
+        with self._lock:
+            self._entries[name] = entry
+        self._store(name, entry)
+        return entry
+
+    def _filename(self, name):
+        return layout.sharded_path(self._directory, name, "{0}.json".format(layout.normalize_name(name)))
+
+    def _load(self, name):
+        filename = self._filename(name)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, "rb") as cache_file:
+                data = json.load(cache_file)
+            validators = data.get("validators")
+            return VersionCacheEntry(data["versions"], data["fetched_at"],
+                                     Validators(*validators) if validators else None)
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            LOGGER.warn("Ignoring unreadable version cache file {0}: {1}".format(filename, e))
+            return None
+
+    def _store(self, name, entry):
+        filename = self._filename(name)
+        try:
+            write_atomically(filename, json.dumps({"name": name, "versions": entry.versions,
+                                                   "fetched_at": entry.fetched_at, "validators": entry.validators}))
+        except (IOError, OSError) as e:
+            LOGGER.warn("Could not write version cache file {0}: {1}".format(filename, e))
+
+
+class NegativeCache(object):
+    """
+    Remembers the urls upstream could not find, for time_to_live seconds, grouped by the normalized package name
+    so that all entries of a package can be forgotten at once. At most maximum_entries urls are kept; the oldest
+    ones are dropped first.
+    """
+
+    def __init__(self, time_to_live=DEFAULT_NEGATIVE_CACHE_TIME_TO_LIVE,
+                 maximum_entries=DEFAULT_NEGATIVE_CACHE_MAXIMUM_ENTRIES):
+        self._time_to_live = time_to_live
+        self._maximum_entries = maximum_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._urls_by_name = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def contains(self, url):
+        """
+            Counts a hit or a miss in the metrics.
+            @return: True if upstream could not find the url less than time_to_live seconds ago
+        """
+        with self._lock:
+            self._remove_expired_entries()
+            found = url in self._entries
+        metrics.increment("negative_cache.hits" if found else "negative_cache.misses")
+        return found
+
+    def add(self, name, url):
+        with self._lock:
+            self._remove_entry(url)
+            normalized_name = layout.normalize_name(name)
+            self._entries[url] = (time.time() + self._time_to_live, normalized_name)
+            self._urls_by_name.setdefault(normalized_name, set()).add(url)
+            while len(self._entries) > self._maximum_entries:
+                self._remove_entry(next(iter(self._entries)))
+
+    def discard(self, name):
+        """
+            Forgets all urls of the given package.
+        """
+        with self._lock:
+            for url in list(self._urls_by_name.get(layout.normalize_name(name), [])):
+                self._remove_entry(url)
+
+    def _remove_expired_entries(self):
+        now = time.time()
+        while self._entries:
+            url, (expires_at, _) = next(self._entries.iteritems())
+            if expires_at > now:
+                break
+            self._remove_entry(url)
+
+    def _remove_entry(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is None:
+            return
+        urls = self._urls_by_name[entry[1]]
+        urls.discard(url)
+        if not urls:
+            del self._urls_by_name[entry[1]]
+
+
+class IndexSnapshot(object):
+    """
+    Persists the package names of the upstream /simple/ index as a gzipped file: a JSON header line with the
+    validators and the time the index was fetched, followed by one package name per line.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def modification_time(self):
+        """
+            @return: the modification time of the snapshot file or None if there is no snapshot
+        """
+        try:
+            return os.stat(self._filename).st_mtime
+        except OSError:
+            return None
+
+    def load(self):
+        """
+            @return: a tuple (names, validators, fetched_at) or None if there is no readable snapshot
+        """
+        if not os.path.exists(self._filename):
+            return None
+        try:
+            with gzip.open(self._filename, "rb") as snapshot_file:
+                header = json.loads(snapshot_file.readline())
+                names = snapshot_file.read().decode("utf8").split("\n") if header["count"] else []
+            if len(names) != header["count"]:
+                raise ValueError("Expected {0} names but found {1}".format(header["count"], len(names)))
+            validators = header.get("validators")
+            LOGGER.info("Loaded {0} upstream package names from {1}".format(len(names), self._filename))
+            return names, Validators(*validators) if validators else None, header["fetched_at"]
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            LOGGER.warn("Ignoring unreadable index snapshot {0}: {1}".format(self._filename, e))
+            return None
+
+    def store(self, names, validators, fetched_at):
+        header = json.dumps({"count": len(names), "validators": validators, "fetched_at": fetched_at})
+        content = StringIO()
+        with gzip.GzipFile(fileobj=content, mode="wb") as snapshot_file:
+            snapshot_file.write(header + "\n")
+            snapshot_file.write(u"\n".join(names).encode("utf8"))
+        try:
+            write_atomically(self._filename, content.getvalue())
+        except (IOError, OSError) as e:
+            LOGGER.warn("Could not write index snapshot {0}: {1}".format(self._filename, e))
+
+
+def write_atomically(filename, content, mode=None):
+    """
+        Writes the content to a temporary file next to the given file and renames it into place. The file gets the
+        given permissions, or the owner-only permissions of a temporary file if mode is None.
+    """
+    directory = os.path.dirname(filename)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    file_descriptor, temporary_filename = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(file_descriptor, "wb") as temporary_file:
+            temporary_file.write(content)
+        if mode is not None:
+            os.chmod(temporary_filename, mode)
+        os.rename(temporary_filename, filename)
+    except:
+        os.remove(temporary_filename)
+        raise
@@ -0,0 +1,108 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Compressed renderings of pages that are expensive to send uncompressed, kept so that a page is compressed once
+    per version of its content instead of on every request.
+
+    gzip is always available; brotli is offered in addition when the brotli module is installed.
+"""
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import collections
+import gzip
+import logging
+import threading
+from StringIO import StringIO
+
+from . import metrics
+from .singleflight import SingleFlight
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOGGER = logging.getLogger("pypiproxy.compression")
+
+DEFAULT_MAXIMUM_PAGES = 1024
+
+
+def gzip_compress(content):
+    compressed_content = StringIO()
+    with gzip.GzipFile(fileobj=compressed_content, mode="wb", compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(content)
+    return compressed_content.getvalue()
+
+
+def _compressors():
+    compressors = collections.OrderedDict()
+    if brotli is not None:
+        compressors["br"] = brotli.compress
+    compressors["gzip"] = gzip_compress
+    return compressors
+
+
+class CompressedPages(object):
+    """
+    Keeps the compressed content of up to maximum_pages pages, each identified by a key and the version of its
+    content (e.g. its entity tag). A page is rendered and compressed with every available encoding when it is
+    requested in a version that is not known yet; the previous version of the page is dropped then. The least
+    recently used pages are dropped once there are more than maximum_pages.
+    """
+
+    def __init__(self, maximum_pages=DEFAULT_MAXIMUM_PAGES):
+        self._maximum_pages = maximum_pages
+        self._compressors = _compressors()
+        self._lock = threading.Lock()
+        self._pages = collections.OrderedDict()
+        self._compressions = SingleFlight()
+
+    @property
+    def encodings(self):
+        """
+            @return: the available content encodings, the preferred one first
+        """
+        return list(self._compressors.keys())
+
+    def get(self, key, version, encoding, render):
+        """
+            @return: the content of the page in the given version, compressed with the given encoding. render is
+                called to get the uncompressed content (a string) unless the page is known in this version.
+        """
+        with self._lock:
+            page = self._pages.pop(key, None)
+            if page is not None and page[0] == version:
+                self._pages[key] = page
+                metrics.increment("compression.hits")
+                return page[1][encoding]
+
+        compressed_contents = self._compressions.do((key, version), self._compress, render)
+        with self._lock:
+            self._pages.pop(key, None)
+            self._pages[key] = (version, compressed_contents)
+            while len(self._pages) > self._maximum_pages:
+                self._pages.popitem(last=False)
+        return compressed_contents[encoding]
+
+    def _compress(self, render):
+        content = render()
+        compressed_contents = dict((encoding, compress(content)) for encoding, compress in self._compressors.items())
+        metrics.increment("compression.pages")
+        LOGGER.debug("Compressed page of {0} bytes to {1}".format(
+            len(content), ", ".join("{0} bytes ({1})".format(len(compressed_content), encoding)
+                                    for encoding, compressed_content in sorted(compressed_contents.items()))))
+        return compressed_contents
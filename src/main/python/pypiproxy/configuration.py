@@ -16,15 +16,75 @@
 __author__ = "Alexander Metzner, Michael Gruber, Maximilien Riehl"
 
 import ConfigParser
+import multiprocessing
+import re
+
+from .eviction import DEFAULT_EVICTION_INTERVAL_SECONDS, DEFAULT_GRACE_PERIOD_SECONDS, LRU, POLICIES
+from .server import SERVER_MODE_FLASK, SERVER_MODES
+
+_SIZE_PATTERN = re.compile(r"^\s*(\d+)\s*([KMGT]?)B?\s*$", re.IGNORECASE)
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
 
 class Configuration(object):
+    DEFAULT_CACHED_PACKAGES_EVICTION_GRACE_PERIOD = DEFAULT_GRACE_PERIOD_SECONDS
+    DEFAULT_CACHED_PACKAGES_EVICTION_INTERVAL = DEFAULT_EVICTION_INTERVAL_SECONDS
+    DEFAULT_CACHED_PACKAGES_EVICTION_POLICY = LRU
+    DEFAULT_CACHED_PACKAGES_SIZE_LIMIT = 0
     DEFAULT_LOG_FILE = "/var/log/pypiproxy.log"
+    DEFAULT_NEGATIVE_CACHE_SIZE = 10000
+    DEFAULT_NEGATIVE_CACHE_TIME_TO_LIVE = 120.0
     DEFAULT_PYPI_URL = "https://pypi.python.org"
+    DEFAULT_SERVER_BACKLOG = 128
+    DEFAULT_SERVER_GRACEFUL_TIMEOUT = 30.0
+    DEFAULT_SERVER_MODE = SERVER_MODE_FLASK
+    DEFAULT_SERVER_PORT = 5000
+    DEFAULT_SERVER_TIMEOUT = 60.0
+    DEFAULT_SERVER_WORKERS = 0
+    DEFAULT_STATIC_EXPORT_INTERVAL = 60.0
+    DEFAULT_STREAM_UPSTREAM_DOWNLOADS = True
+    DEFAULT_UPSTREAM_CONNECT_TIMEOUT = 10.0
+    DEFAULT_UPSTREAM_FAILURE_THRESHOLD = 5
+    DEFAULT_UPSTREAM_HEDGE_DELAY = 0.5
+    DEFAULT_UPSTREAM_INDEX_REFRESH_INTERVAL = 0.0
+    DEFAULT_UPSTREAM_POOL_SIZE = 10
+    DEFAULT_UPSTREAM_READ_TIMEOUT = 60.0
+    DEFAULT_UPSTREAM_RESET_TIMEOUT = 30.0
+    DEFAULT_VERSION_CACHE_TIME_TO_LIVE = 300.0
+    DEFAULT_WATCH_PACKAGE_DIRECTORIES = False
+    DEFAULT_WATCH_POLLING_INTERVAL = 2.0
 
     OPTION_CACHED_PACKAGES_DIRECTORY = "cached_packages_directory"
+    OPTION_CACHED_PACKAGES_EVICTION_GRACE_PERIOD = "cached_packages_eviction_grace_period"
+    OPTION_CACHED_PACKAGES_EVICTION_INTERVAL = "cached_packages_eviction_interval"
+    OPTION_CACHED_PACKAGES_EVICTION_POLICY = "cached_packages_eviction_policy"
+    OPTION_CACHED_PACKAGES_SIZE_LIMIT = "cached_packages_size_limit"
     OPTION_HOSTED_PACKAGES_DIRECTORY = "hosted_packages_directory"
     OPTION_LOG_FILE = "log_file"
+    OPTION_NEGATIVE_CACHE_SIZE = "negative_cache_size"
+    OPTION_NEGATIVE_CACHE_TIME_TO_LIVE = "negative_cache_ttl"
     OPTION_PYPI_URL = "pypi_url"
+    OPTION_SERVER_BACKLOG = "server_backlog"
+    OPTION_SERVER_GRACEFUL_TIMEOUT = "server_graceful_timeout"
+    OPTION_SERVER_HOST = "server_host"
+    OPTION_SERVER_MODE = "server_mode"
+    OPTION_SERVER_PORT = "server_port"
+    OPTION_SERVER_TIMEOUT = "server_timeout"
+    OPTION_SERVER_WORKERS = "server_workers"
+    OPTION_STATIC_EXPORT_DIRECTORY = "static_export_directory"
+    OPTION_STATIC_EXPORT_INTERVAL = "static_export_interval"
+    OPTION_STREAM_UPSTREAM_DOWNLOADS = "stream_upstream_downloads"
+    OPTION_UPSTREAM_CONNECT_TIMEOUT = "upstream_connect_timeout"
+    OPTION_UPSTREAM_FAILURE_THRESHOLD = "upstream_failure_threshold"
+    OPTION_UPSTREAM_HEDGE_DELAY = "upstream_hedge_delay"
+    OPTION_UPSTREAM_INDEX_REFRESH_INTERVAL = "upstream_index_refresh_interval"
+    OPTION_UPSTREAM_INDEX_SNAPSHOT = "upstream_index_snapshot"
+    OPTION_UPSTREAM_POOL_SIZE = "upstream_pool_size"
+    OPTION_UPSTREAM_READ_TIMEOUT = "upstream_read_timeout"
+    OPTION_UPSTREAM_RESET_TIMEOUT = "upstream_reset_timeout"
+    OPTION_VERSION_CACHE_DIRECTORY = "version_cache_directory"
+    OPTION_VERSION_CACHE_TIME_TO_LIVE = "version_cache_ttl"
+    OPTION_WATCH_PACKAGE_DIRECTORIES = "watch_package_directories"
+    OPTION_WATCH_POLLING_INTERVAL = "watch_polling_interval"
 
     SECTION = "pypiproxy"
 
@@ -37,6 +97,33 @@ class Configuration(object):
     def cached_packages_directory(self):
         return self._get_option(Configuration.OPTION_CACHED_PACKAGES_DIRECTORY)
 
+    @property
+    def cached_packages_eviction_grace_period(self):
+        return self._get_float_option(Configuration.OPTION_CACHED_PACKAGES_EVICTION_GRACE_PERIOD,
+                                      Configuration.DEFAULT_CACHED_PACKAGES_EVICTION_GRACE_PERIOD)
+
+    @property
+    def cached_packages_eviction_interval(self):
+        return self._get_float_option(Configuration.OPTION_CACHED_PACKAGES_EVICTION_INTERVAL,
+                                      Configuration.DEFAULT_CACHED_PACKAGES_EVICTION_INTERVAL)
+
+    @property
+    def cached_packages_eviction_policy(self):
+        policy = self._get_option(Configuration.OPTION_CACHED_PACKAGES_EVICTION_POLICY,
+                                  Configuration.DEFAULT_CACHED_PACKAGES_EVICTION_POLICY).lower()
+        if policy not in POLICIES:
+            raise ValueError("Invalid value for configuration option '{0}', expected one of {1}"
+                             .format(Configuration.OPTION_CACHED_PACKAGES_EVICTION_POLICY, ", ".join(POLICIES)))
+        return policy
+
+    @property
+    def cached_packages_size_limit(self):
+        """
+            @return: the size limit in bytes, 0 if the cached packages are not to be evicted
+        """
+        return self._get_size_option(Configuration.OPTION_CACHED_PACKAGES_SIZE_LIMIT,
+                                     Configuration.DEFAULT_CACHED_PACKAGES_SIZE_LIMIT)
+
     @property
     def hosted_packages_directory(self):
         return self._get_option(Configuration.OPTION_HOSTED_PACKAGES_DIRECTORY)
@@ -45,17 +132,183 @@ class Configuration(object):
     def log_file(self):
         return self._get_option(Configuration.OPTION_LOG_FILE, Configuration.DEFAULT_LOG_FILE)
 
+    @property
+    def negative_cache_size(self):
+        return self._get_integer_option(Configuration.OPTION_NEGATIVE_CACHE_SIZE,
+                                        Configuration.DEFAULT_NEGATIVE_CACHE_SIZE)
+
+    @property
+    def negative_cache_time_to_live(self):
+        return self._get_float_option(Configuration.OPTION_NEGATIVE_CACHE_TIME_TO_LIVE,
+                                      Configuration.DEFAULT_NEGATIVE_CACHE_TIME_TO_LIVE)
+
     @property
     def pypi_url(self):
         return self._get_option(Configuration.OPTION_PYPI_URL, Configuration.DEFAULT_PYPI_URL)
 
+    @property
+    def pypi_urls(self):
+        """
+            @return: the urls given in the pypi_url option, separated by whitespace, in the given order
+        """
+        return self.pypi_url.split()
+
+    @property
+    def server_backlog(self):
+        return self._get_integer_option(Configuration.OPTION_SERVER_BACKLOG, Configuration.DEFAULT_SERVER_BACKLOG)
+
+    @property
+    def server_graceful_timeout(self):
+        return self._get_float_option(Configuration.OPTION_SERVER_GRACEFUL_TIMEOUT,
+                                      Configuration.DEFAULT_SERVER_GRACEFUL_TIMEOUT)
+
+    @property
+    def server_host(self):
+        if self._config_parser.has_option(Configuration.SECTION, Configuration.OPTION_SERVER_HOST):
+            return self._get_option(Configuration.OPTION_SERVER_HOST)
+        return None
+
+    @property
+    def server_mode(self):
+        server_mode = self._get_option(Configuration.OPTION_SERVER_MODE, Configuration.DEFAULT_SERVER_MODE)
+        if server_mode not in SERVER_MODES:
+            raise ValueError("Invalid value for configuration option '{0}', expected one of {1}"
+                             .format(Configuration.OPTION_SERVER_MODE, ", ".join(SERVER_MODES)))
+        return server_mode
+
+    @property
+    def server_port(self):
+        return self._get_integer_option(Configuration.OPTION_SERVER_PORT, Configuration.DEFAULT_SERVER_PORT)
+
+    @property
+    def server_timeout(self):
+        return self._get_float_option(Configuration.OPTION_SERVER_TIMEOUT, Configuration.DEFAULT_SERVER_TIMEOUT)
+
+    @property
+    def server_workers(self):
+        """
+            The number of worker processes, the number of CPUs if the option is missing or not positive.
+        """
+        workers = self._get_integer_option(Configuration.OPTION_SERVER_WORKERS, Configuration.DEFAULT_SERVER_WORKERS)
+        return workers if workers > 0 else multiprocessing.cpu_count()
+
+    @property
+    def static_export_directory(self):
+        if self._config_parser.has_option(Configuration.SECTION, Configuration.OPTION_STATIC_EXPORT_DIRECTORY):
+            return self._get_option(Configuration.OPTION_STATIC_EXPORT_DIRECTORY)
+        return None
+
+    @property
+    def static_export_interval(self):
+        return self._get_float_option(Configuration.OPTION_STATIC_EXPORT_INTERVAL,
+                                      Configuration.DEFAULT_STATIC_EXPORT_INTERVAL)
+
+    @property
+    def stream_upstream_downloads(self):
+        return self._get_boolean_option(Configuration.OPTION_STREAM_UPSTREAM_DOWNLOADS,
+                                        Configuration.DEFAULT_STREAM_UPSTREAM_DOWNLOADS)
+
+    @property
+    def upstream_connect_timeout(self):
+        return self._get_float_option(Configuration.OPTION_UPSTREAM_CONNECT_TIMEOUT,
+                                      Configuration.DEFAULT_UPSTREAM_CONNECT_TIMEOUT)
+
+    @property
+    def upstream_failure_threshold(self):
+        return self._get_integer_option(Configuration.OPTION_UPSTREAM_FAILURE_THRESHOLD,
+                                        Configuration.DEFAULT_UPSTREAM_FAILURE_THRESHOLD)
+
+    @property
+    def upstream_hedge_delay(self):
+        return self._get_float_option(Configuration.OPTION_UPSTREAM_HEDGE_DELAY,
+                                      Configuration.DEFAULT_UPSTREAM_HEDGE_DELAY)
+
+    @property
+    def upstream_index_refresh_interval(self):
+        return self._get_float_option(Configuration.OPTION_UPSTREAM_INDEX_REFRESH_INTERVAL,
+                                      Configuration.DEFAULT_UPSTREAM_INDEX_REFRESH_INTERVAL)
+
+    @property
+    def upstream_index_snapshot(self):
+        if self._config_parser.has_option(Configuration.SECTION, Configuration.OPTION_UPSTREAM_INDEX_SNAPSHOT):
+            return self._get_option(Configuration.OPTION_UPSTREAM_INDEX_SNAPSHOT)
+        return self.cached_packages_directory.rstrip("/") + "-index.gz"
+
+    @property
+    def upstream_pool_size(self):
+        return self._get_integer_option(Configuration.OPTION_UPSTREAM_POOL_SIZE,
+                                        Configuration.DEFAULT_UPSTREAM_POOL_SIZE)
+
+    @property
+    def upstream_read_timeout(self):
+        return self._get_float_option(Configuration.OPTION_UPSTREAM_READ_TIMEOUT,
+                                      Configuration.DEFAULT_UPSTREAM_READ_TIMEOUT)
+
+    @property
+    def upstream_reset_timeout(self):
+        return self._get_float_option(Configuration.OPTION_UPSTREAM_RESET_TIMEOUT,
+                                      Configuration.DEFAULT_UPSTREAM_RESET_TIMEOUT)
+
+    @property
+    def version_cache_directory(self):
+        if self._config_parser.has_option(Configuration.SECTION, Configuration.OPTION_VERSION_CACHE_DIRECTORY):
+            return self._get_option(Configuration.OPTION_VERSION_CACHE_DIRECTORY)
+        return self.cached_packages_directory.rstrip("/") + "-versions"
+
+    @property
+    def version_cache_time_to_live(self):
+        return self._get_float_option(Configuration.OPTION_VERSION_CACHE_TIME_TO_LIVE,
+                                      Configuration.DEFAULT_VERSION_CACHE_TIME_TO_LIVE)
+
+    @property
+    def watch_package_directories(self):
+        return self._get_boolean_option(Configuration.OPTION_WATCH_PACKAGE_DIRECTORIES,
+                                        Configuration.DEFAULT_WATCH_PACKAGE_DIRECTORIES)
+
+    @property
+    def watch_polling_interval(self):
+        return self._get_float_option(Configuration.OPTION_WATCH_POLLING_INTERVAL,
+                                      Configuration.DEFAULT_WATCH_POLLING_INTERVAL)
+
     def _get_option(self, option, default_value=None):
         if not self._config_parser.has_option(Configuration.SECTION, option):
-            if default_value:
+            if default_value is not None:
                 return default_value
             raise ValueError("Missing configuration option '%s' in section '%s'", option, Configuration.SECTION)
         return self._config_parser.get(Configuration.SECTION, option)
 
+    def _get_boolean_option(self, option, default_value):
+        if not self._config_parser.has_option(Configuration.SECTION, option):
+            return default_value
+        try:
+            return self._config_parser.getboolean(Configuration.SECTION, option)
+        except ValueError:
+            raise ValueError("Invalid boolean value for configuration option '{0}'".format(option))
+
+    def _get_integer_option(self, option, default_value):
+        if not self._config_parser.has_option(Configuration.SECTION, option):
+            return default_value
+        try:
+            return self._config_parser.getint(Configuration.SECTION, option)
+        except ValueError:
+            raise ValueError("Invalid integer value for configuration option '{0}'".format(option))
+
+    def _get_float_option(self, option, default_value):
+        if not self._config_parser.has_option(Configuration.SECTION, option):
+            return default_value
+        try:
+            return self._config_parser.getfloat(Configuration.SECTION, option)
+        except ValueError:
+            raise ValueError("Invalid numeric value for configuration option '{0}'".format(option))
+
+    def _get_size_option(self, option, default_value):
+        if not self._config_parser.has_option(Configuration.SECTION, option):
+            return default_value
+        match = _SIZE_PATTERN.match(self._config_parser.get(Configuration.SECTION, option))
+        if match is None:
+            raise ValueError("Invalid size value for configuration option '{0}'".format(option))
+        return int(match.group(1)) * _SIZE_UNITS[match.group(2).upper()]
+
     def _load_config_file(self, config_file_name):
         try:
             if self._config_parser.read(config_file_name) != [config_file_name]:
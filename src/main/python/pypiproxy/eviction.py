@@ -0,0 +1,174 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Eviction of cached packages: keeps the cached packages directory below a size limit by deleting the least
+    recently (LRU) or least frequently (LFU) used packages.
+"""
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import logging
+import mmap
+import struct
+import threading
+import time
+
+from . import metrics
+
+LOGGER = logging.getLogger("pypiproxy.eviction")
+
+LRU = "lru"
+LFU = "lfu"
+POLICIES = (LRU, LFU)
+
+DEFAULT_EVICTION_INTERVAL_SECONDS = 60.0
+DEFAULT_GRACE_PERIOD_SECONDS = 300.0
+DEFAULT_ACCESS_TRACKER_SLOTS = 65536
+
+_LOW_WATERMARK = 0.9
+_ACCESS_SLOT = struct.Struct("=Id")
+
+
+class AccessTracker(object):
+    """
+    Counts the accesses to each package and remembers the time of the last one, in a table of a fixed number of
+    slots. The table is kept in shared memory, so the processes forked after creating the tracker (e.g. pre-forked
+    workers) all record into it, and the eviction in one of them sees the accesses served by all of them.
+
+    Packages are assigned to slots by the hash of their name and version. Packages sharing a slot share their
+    accesses, which can only keep a package longer. Increments made by several processes at the same time may get
+    lost. A package counts as accessed at least at the modification time of its file.
+    """
+
+    def __init__(self, slots=DEFAULT_ACCESS_TRACKER_SLOTS):
+        self._slots = slots
+        self._table = mmap.mmap(-1, slots * _ACCESS_SLOT.size)
+        self._lock = threading.Lock()
+
+    def record(self, name, version):
+        offset = self._offset(name, version)
+        with self._lock:
+            count, _ = _ACCESS_SLOT.unpack_from(self._table, offset)
+            _ACCESS_SLOT.pack_into(self._table, offset, count + 1, time.time())
+
+    def get(self, name, version, package_file):
+        """
+            @return: a tuple (number of accesses, time of the last access)
+        """
+        count, last_access = _ACCESS_SLOT.unpack_from(self._table, self._offset(name, version))
+        return count, max(last_access, package_file.mtime)
+
+    def _offset(self, name, version):
+        return hash((name, version)) % self._slots * _ACCESS_SLOT.size
+
+
+class CacheEvictor(object):
+    """
+    Deletes cached packages when their total size exceeds maximum_bytes, until it is below 90% of it. Packages
+    are deleted in the order of the policy: LRU deletes the package accessed least recently first, LFU the package
+    accessed least often (ties are broken by the time of the last access).
+
+    Packages accessed during the last grace_period seconds are never deleted, so that responses still streaming
+    them are not affected, and neither are packages that are being downloaded. The number of deleted packages and
+    the freed bytes are counted in the metrics "eviction.evicted_packages" and "eviction.freed_bytes".
+    """
+
+    def __init__(self, proxy_package_index, access_tracker, maximum_bytes, policy=LRU,
+                 grace_period=DEFAULT_GRACE_PERIOD_SECONDS):
+        if policy not in POLICIES:
+            raise ValueError("Unknown eviction policy '{0}'".format(policy))
+        self._proxy_package_index = proxy_package_index
+        self._access_tracker = access_tracker
+        self._maximum_bytes = maximum_bytes
+        self._policy = policy
+        self._grace_period = grace_period
+        self._changed = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def package_changed(self, name):
+        """
+            Wakes up the eviction thread, e.g. when a package has been cached.
+        """
+        self._changed.set()
+
+    def evict(self):
+        """
+            @return: the number of deleted packages
+        """
+        if self._proxy_package_index.get_statistics().bytes <= self._maximum_bytes:
+            return 0
+
+        candidates = sorted(self._proxy_package_index.list_package_files(), key=self._order)
+
+        target_bytes = self._maximum_bytes * _LOW_WATERMARK
+        evicted_packages = 0
+        freed_bytes = 0
+        for name, version, package_file in candidates:
+            if self._proxy_package_index.get_statistics().bytes <= target_bytes:
+                break
+            if self._is_in_grace_period(name, version, package_file):
+                continue
+            removed_file = self._proxy_package_index.remove_package(name, version)
+            if removed_file is not None:
+                LOGGER.debug("Evicted package {0} in version {1}".format(name, version))
+                evicted_packages += 1
+                freed_bytes += removed_file.size
+
+        metrics.increment("eviction.runs")
+        metrics.increment("eviction.evicted_packages", evicted_packages)
+        metrics.increment("eviction.freed_bytes", freed_bytes)
+        LOGGER.info("Evicted {0} package(s), freeing {1} bytes".format(evicted_packages, freed_bytes))
+        return evicted_packages
+
+    def start(self, interval=DEFAULT_EVICTION_INTERVAL_SECONDS):
+        """
+            Evicts right away and then whenever a package changes, but at most every interval seconds.
+        """
+        self._stopped.clear()
+        self._changed.set()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="eviction")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._changed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stopped.is_set():
+            self._changed.wait()
+            self._changed.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.evict()
+            except Exception as e:
+                LOGGER.exception("Failed to evict cached packages: {0}".format(e))
+            self._stopped.wait(interval)
+
+    def _order(self, package):
+        count, last_access = self._access_tracker.get(*package)
+        if self._policy == LFU:
+            return count, last_access
+        return last_access, count
+
+    def _is_in_grace_period(self, name, version, package_file):
+        _, last_access = self._access_tracker.get(name, version, package_file)
+        return time.time() - last_access < self._grace_period
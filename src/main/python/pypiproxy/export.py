@@ -0,0 +1,173 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Static export of the simple index: the package list and the version pages are rendered into an export
+    directory in the layout of a static PyPI (simple/index.html and simple/<name>/index.html), so that a web server
+    can serve them from disk.
+"""
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from jinja2 import Environment, PackageLoader
+
+from . import __version__ as pypiproxy_version
+from . import metrics
+from .cache import write_atomically
+
+LOGGER = logging.getLogger("pypiproxy.export")
+
+DEFAULT_EXPORT_INTERVAL_SECONDS = 60.0
+
+INDEX_FILENAME = "index.html"
+PAGE_MODE = 0644
+
+_templates = Environment(loader=PackageLoader("pypiproxy", "templates"), autoescape=True)
+
+
+class StaticExport(object):
+    """
+    Keeps the pages below the export directory up to date. The package list is exported again whenever the
+    generation of the package names changes (every time if it is unknown), but at most every interval seconds
+    while the export runs in the background; version pages are only exported for the packages reported through
+    package_changed. A page is written to a temporary file and renamed into place, and only if its content differs
+    from what has been exported before.
+    """
+
+    def __init__(self, directory, list_package_names, list_versions, get_generation):
+        self._directory = directory
+        self._list_package_names = list_package_names
+        self._list_versions = list_versions
+        self._get_generation = get_generation
+        self._lock = threading.Lock()
+        self._changed_names = set()
+        self._exported_generation = None
+        self._package_list_exported_at = None
+        self._digests = {}
+        self._changed = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def package_changed(self, name):
+        """
+            Marks the version page of the given package for the next export and wakes up the export thread.
+        """
+        with self._lock:
+            self._changed_names.add(name)
+        self._changed.set()
+
+    def export_changes(self, package_list_interval=0):
+        """
+            Exports the version pages of the changed packages, and the package list if it has changed and has not
+            been exported during the last package_list_interval seconds.
+            @return: the number of pages written
+        """
+        pages_written = 0
+        if self._is_package_list_due(package_list_interval):
+            generation = self._get_generation()
+            if generation is None or generation != self._exported_generation:
+                pages_written += self._export_page(self._page_filename(), "package-list.html",
+                                                   package_name_list=self._list_package_names())
+                self._exported_generation = generation
+                self._package_list_exported_at = time.time()
+
+        with self._lock:
+            changed_names, self._changed_names = self._changed_names, set()
+        for name in sorted(changed_names):
+            if not _is_safe_name(name):
+                LOGGER.warn("Not exporting versions of package with unsafe name '{0}'".format(name))
+                continue
+            versions = list(self._list_versions(name))
+            if versions:
+                pages_written += self._export_page(self._page_filename(name), "version-list.html",
+                                                   package_name=name, versions_list=versions)
+            else:
+                self._remove_page(self._page_filename(name))
+
+        metrics.increment("export.pages_written", pages_written)
+        return pages_written
+
+    def start(self, interval=DEFAULT_EXPORT_INTERVAL_SECONDS):
+        """
+            Exports right away and then whenever a package changes, but at least every interval seconds. The
+            package list is exported at most every interval seconds.
+        """
+        self._stopped.clear()
+        self._changed.set()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="export-{0}".format(self._directory))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._changed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while True:
+            self._changed.wait(interval)
+            self._changed.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                pages_written = self.export_changes(interval)
+                if pages_written:
+                    LOGGER.info("Exported {0} page(s) to {1}".format(pages_written, self._directory))
+            except Exception as e:
+                LOGGER.exception("Failed to export to {0}: {1}".format(self._directory, e))
+
+    def _is_package_list_due(self, package_list_interval):
+        return (self._package_list_exported_at is None or
+                time.time() - self._package_list_exported_at >= package_list_interval)
+
+    def _page_filename(self, name=None):
+        if name is None:
+            return os.path.join(self._directory, "simple", INDEX_FILENAME)
+        return os.path.join(self._directory, "simple", name, INDEX_FILENAME)
+
+    def _export_page(self, filename, template_name, **template_parameters):
+        content = _templates.get_template(template_name).render(version=pypiproxy_version,
+                                                                **template_parameters).encode("utf8")
+        digest = hashlib.md5(content).digest()
+        if self._digests.get(filename) == digest:
+            return 0
+
+        write_atomically(filename, content, PAGE_MODE)
+        self._digests[filename] = digest
+        return 1
+
+    def _remove_page(self, filename):
+        self._digests.pop(filename, None)
+        try:
+            os.remove(filename)
+            os.rmdir(os.path.dirname(filename))
+        except OSError:
+            pass
+
+
+def _is_safe_name(name):
+    return name and not name.startswith(".") and "/" not in name and os.sep not in name
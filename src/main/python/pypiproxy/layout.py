@@ -0,0 +1,75 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    On-disk layout of the package directories.
+
+    Package files are stored sharded as <first letter>/<normalized name>/<file> below the package directory.
+    Older installations kept all files flat in the package directory; both layouts are read.
+"""
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import logging
+import os
+import re
+
+LOGGER = logging.getLogger("pypiproxy.layout")
+
+_NORMALIZE_PATTERN = re.compile(r"[-_.]+")
+_UNKNOWN_SHARD = "_"
+
+
+def normalize_name(name):
+    return _NORMALIZE_PATTERN.sub("-", name).lower()
+
+
+def shard_directory(directory, name):
+    normalized_name = normalize_name(name) or _UNKNOWN_SHARD
+    return os.path.join(directory, normalized_name[0], normalized_name)
+
+
+def sharded_path(directory, name, filename):
+    return os.path.join(shard_directory(directory, name), filename)
+
+
+def migrate_to_sharded_layout(directory, guess_name, file_suffix):
+    """
+        Moves all package files found flat in the given directory into their shard directories.
+        guess_name is called with the file name and returns the package name.
+        @return: the number of files moved
+    """
+    LOGGER.info("Migrating package directory '%s' to sharded layout", directory)
+
+    moved_files = 0
+    for filename in os.listdir(directory):
+        source = os.path.join(directory, filename)
+        if not filename.endswith(file_suffix) or not os.path.isfile(source):
+            continue
+        try:
+            name = guess_name(filename)
+        except ValueError as e:
+            LOGGER.warn("Not migrating file '{0}': {1}".format(source, e))
+            continue
+
+        target = sharded_path(directory, name, filename)
+        target_directory = os.path.dirname(target)
+        if not os.path.isdir(target_directory):
+            os.makedirs(target_directory)
+        os.rename(source, target)
+        moved_files += 1
+
+    LOGGER.info("Moved %d file(s) of '%s' into sharded layout", moved_files, directory)
+    return moved_files
@@ -0,0 +1,55 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Process wide counters and gauges of the proxy, exposed as JSON on /metrics.
+
+    Names are dotted, starting with the component that maintains them, e.g. "upstream.bytes_saved".
+"""
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import threading
+
+_lock = threading.Lock()
+_values = {}
+
+
+def increment(name, amount=1):
+    with _lock:
+        _values[name] = _values.get(name, 0) + amount
+
+
+def set_value(name, value):
+    with _lock:
+        _values[name] = value
+
+
+def get_value(name, default_value=0):
+    with _lock:
+        return _values.get(name, default_value)
+
+
+def snapshot():
+    """
+        @return: a copy of all values as a dictionary
+    """
+    with _lock:
+        return dict(_values)
+
+
+def reset():
+    with _lock:
+        _values.clear()
@@ -15,12 +15,23 @@
 
 __author__ = "Alexander Metzner, Michael Gruber, Maximilien Riehl"
 
-import itertools
+import bisect
+import collections
+import errno
+import hashlib
+import httplib
 import logging
-import glob
 import os
 import re
-import urllib2
+import tempfile
+import threading
+import time
+
+from . import layout, metrics, watcher
+from .cache import Validators
+from .singleflight import SingleFlight
+from .streaming import CHUNK_SIZE, CachingDownload, CountingReader, iterate_segments
+from .upstream import CircuitOpenError, MirrorSelector, UpstreamClient, UpstreamError
 
 LOGGER = logging.getLogger("pypiproxy.packageindex")
 
@@ -28,6 +39,7 @@ _PACKAGE_NAME_AND_VERSION_PATTERN = re.compile(r"^(.*?)(-([0-9.]+.*)).tar.gz$")
 _HREF_PATTERN = re.compile(r'href=[\'"]?([^\'" >]+)')
 
 FILE_SUFFIX = ".tar.gz"
+TEMPORARY_FILE_SUFFIX = ".tmp"
 
 
 def _guess_name_and_version(filename):
@@ -44,9 +56,70 @@ def _guess_name_and_version(filename):
     raise ValueError("Invalid package file name: '{0}'".format(filename))
 
 
+def migrate_to_sharded_layout(directory):
+    """
+        Moves the package files of a directory in the flat layout into the sharded layout.
+        @return: the number of files moved
+    """
+    return layout.migrate_to_sharded_layout(directory, lambda filename: _guess_name_and_version(filename)[0],
+                                            FILE_SUFFIX)
+
+
+def _create_directory(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _read_chunks(content):
+    if hasattr(content, "read"):
+        return iter(lambda: content.read(CHUNK_SIZE), b"")
+    return [content]
+
+
+def _read_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+PACKAGE_FILE_MODE = 0666 & ~_read_umask()
+
+
+def _fsync_directory(directory):
+    try:
+        directory_descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_descriptor)
+
+
+PackageFile = collections.namedtuple("PackageFile", ["path", "size", "mtime"])
+PackageStatistics = collections.namedtuple("PackageStatistics", ["files", "names", "bytes"])
+
+
 class PackageIndex(object):
+    """
+    Serves the package files stored in a directory.
+
+    New files are stored in the sharded layout (see pypiproxy.layout); files in the flat layout are served as
+    well until they have been migrated.
 
-    def __init__(self, name, directory):
+    The directory is scanned once and kept as an in-memory index mapping each package name to its sorted
+    versions and each (name, version) to its file. Files dropped into (or removed from) the directory by other
+    means are applied incrementally, either by a watcher started with start_watching or, without a watcher, when
+    the modification time of a directory changes. Without a watcher, each lookup stats the top level directory,
+    and the shard directories are checked at most every refresh_interval seconds.
+    """
+
+    def __init__(self, name, directory, refresh_interval=watcher.DEFAULT_POLLING_INTERVAL_SECONDS):
         self._name = name
         self._directory = directory
         LOGGER.info("Creating packageindex '%s' serving directory '%s'", name, self._directory)
@@ -54,138 +127,1055 @@ class PackageIndex(object):
         if not os.path.exists(self._directory):
             os.makedirs(self._directory)
 
+        self._lock = threading.RLock()
+        self._package_names = []
+        self._versions = {}
+        self._files = {}
+        self._keys_by_path = {}
+        self._paths_by_directory = {}
+        self._subdirectories = {self._directory: set()}
+        self._directory_mtimes = {}
+        self._refresh_interval = refresh_interval
+        self._refreshed_at = time.time()
+        self._watcher = None
+        self._generation = 0
+        self._total_bytes = 0
+        self._listeners = []
+        self._synchronize()
+
     @property
     def directory(self):
         return self._directory
 
-    def add_package(self, name, version, content):
+    @property
+    def generation(self):
+        """
+            A number that increases whenever a package file is added, replaced or removed.
+        """
+        with self._lock:
+            self._refresh_if_modified()
+            return self._generation
+
+    def add_package(self, name, version, content, expected_md5_digest=None):
+        """
+            Stores content (a string or a file-like object, which is read in chunks) as package file.
+            The content is written to a temporary file next to the package file, hashed on the way, synced to disk
+            and renamed into place, so that a package file is either complete or not there at all.
+            @return: a dictionary containing the "md5" and "sha256" hex digests of the content
+            @raise ValueError: if expected_md5_digest is given and does not match the content
+        """
+        package_writer = self.open_package_writer(name, version)
+        try:
+            for chunk in _read_chunks(content):
+                package_writer.write(chunk)
+            digests = package_writer.digests
+            if expected_md5_digest is not None and expected_md5_digest != digests["md5"]:
+                raise ValueError("MD5 digest of package {0} in version {1} does not match: expected {2}, got {3}"
+                                 .format(name, version, expected_md5_digest, digests["md5"]))
+            package_writer.commit()
+        except:
+            package_writer.discard()
+            raise
+
+        LOGGER.info("Added package {0} in version {1} with sha256 {2}".format(name, version, digests["sha256"]))
+        return digests
+
+    def open_package_writer(self, name, version):
+        """
+            @return: a PackageWriter that adds the package file once it is committed
+        """
         filename = self._filename_from_name_and_version(name, version)
 
         LOGGER.info("Adding package {0} in version {1} as file {2}".format(name, version, filename))
 
-        with open(filename, "wb") as package_file:
-            package_file.write(content)
+        _create_directory(os.path.dirname(filename))
+        return PackageWriter(self, name, version, filename)
 
     def contains(self, name, version="*"):
-        filename = self._filename_from_name_and_version(name, version)
-        list_of_files = glob.glob(filename)
-        return len(list_of_files) > 0
+        with self._lock:
+            self._refresh_if_modified()
+            if version == "*":
+                return name in self._versions
+            return (name, version) in self._files
 
     def count_packages(self):
-        return len([p for p in self._read_packages()])
+        with self._lock:
+            self._refresh_if_modified()
+            return len(self._files)
+
+    def add_listener(self, listener):
+        """
+            The listener is called with the package name whenever a file of the package is added, replaced or
+            removed. It is called while the index is locked and must not block.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def get_statistics(self):
+        """
+            The statistics are kept up to date while files are added and removed, so this does not scan anything.
+            @return: PackageStatistics with the number of package files, of unique package names and the total size
+        """
+        with self._lock:
+            self._refresh_if_modified()
+            return PackageStatistics(len(self._files), len(self._versions), self._total_bytes)
+
+    def get_package_file(self, name, version):
+        """
+            @return: the PackageFile for the given name and version or None
+        """
+        with self._lock:
+            self._refresh_if_modified()
+            return self._files.get((name, version))
+
+    def list_package_files(self):
+        """
+            @return: a list of tuples (name, version, PackageFile) of all files in the index
+        """
+        with self._lock:
+            self._refresh_if_modified()
+            return [(name, version, package_file) for (name, version), package_file in self._files.items()]
+
+    def remove_package(self, name, version):
+        """
+            Deletes the file of the given package. A file that has already been deleted by other means is only
+            dropped from the index.
+            @return: the PackageFile of the deleted file, or None if the package is not in the index or its file
+                had already been deleted
+        """
+        with self._lock:
+            package_file = self._files.get((name, version))
+            if package_file is None:
+                return None
+            try:
+                os.remove(package_file.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                package_file = None
+            self._remove_file(self._files[(name, version)].path)
+            return package_file
 
     def get_package_content(self, package, version):
-        filename = os.path.join(self._directory, package + "-" + version + FILE_SUFFIX)
-        if not self.contains(package, version):
+        package_file = self.get_package_file(package, version)
+        if package_file is None:
             return None
 
-        with open(filename, "rb") as f:
-            return f.read()
+        try:
+            with open(package_file.path, "rb") as f:
+                return f.read()
+        except IOError as e:
+            LOGGER.warn("Could not read package file {0}: {1}".format(package_file.path, e))
+            return None
 
     def list_available_package_names(self):
-        package_names = [p for p in itertools.imap(lambda name_and_version: name_and_version[0], self._read_packages())]
-        package_names = sorted(package_names)
-        return UniqueIterator(package_names.__iter__())
+        with self._lock:
+            self._refresh_if_modified()
+            return UniqueIterator(iter(list(self._package_names)))
 
     def list_versions(self, name):
         LOGGER.info("Listing versions for '{0}'".format(name))
 
-        return itertools.imap(lambda name_and_version: name_and_version[1],
-            itertools.ifilter(lambda name_and_version: name_and_version[0] == name, self._read_packages()))
+        with self._lock:
+            self._refresh_if_modified()
+            return list(self._versions.get(name, []))
+
+    def start_watching(self, polling_interval=watcher.DEFAULT_POLLING_INTERVAL_SECONDS):
+        """
+            Keeps the index up to date by watching the directory instead of checking it on every lookup. Changes
+            made since the index was built, e.g. before forking, are caught up on by synchronizing the directories
+            whose modification time has changed, without rescanning the others.
+        """
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = watcher.create_watcher(self._directory, self, polling_interval)
+                self._synchronize_modified_directories()
+                self._watcher.start()
+
+    def stop_watching(self):
+        with self._lock:
+            current_watcher, self._watcher = self._watcher, None
+        if current_watcher is not None:
+            current_watcher.stop()
+
+    def file_added(self, path):
+        filename = os.path.basename(path)
+        if not filename.endswith(FILE_SUFFIX):
+            return
+        try:
+            name, version = _guess_name_and_version(filename)
+        except ValueError as e:
+            LOGGER.warn("Ignoring file in directory '{0}': {1}".format(self._directory, e))
+            return
+
+        with self._lock:
+            try:
+                self._add_file(name, version, path)
+            except OSError as e:
+                LOGGER.warn("Could not stat package file {0}: {1}".format(path, e))
+
+    def file_removed(self, path):
+        with self._lock:
+            self._remove_file(path)
+
+    def directory_changed(self, directory=None):
+        with self._lock:
+            if directory is None:
+                self._synchronize()
+            else:
+                self._synchronize_directory(directory, recursive=False)
+
+    def _add_file(self, name, version, filename):
+        previous_file = self._files.get((name, version))
+        if previous_file is not None and previous_file.path != filename:
+            if previous_file.path == self._filename_from_name_and_version(name, version):
+                return  # a copy in the flat layout does not replace the file in the sharded layout
+            self._discard_path(previous_file.path)
+
+        stat = os.stat(filename)
+        package_file = PackageFile(filename, stat.st_size, stat.st_mtime)
+        if previous_file is not None:
+            self._total_bytes -= previous_file.size
+        if name not in self._versions:
+            bisect.insort(self._package_names, name)
+            self._versions[name] = []
+        if previous_file is None:
+            bisect.insort(self._versions[name], version)
+        if package_file != previous_file:
+            self._generation += 1
+            self._notify_listeners(name)
+        self._files[(name, version)] = package_file
+        self._total_bytes += package_file.size
+        self._keys_by_path[filename] = (name, version)
+        self._paths_by_directory.setdefault(os.path.dirname(filename), set()).add(filename)
+
+    def _remove_file(self, filename):
+        key = self._keys_by_path.get(filename)
+        if key is None:
+            return
+        name, version = key
+        self._discard_path(filename)
+        self._total_bytes -= self._files.pop(key).size
+        self._generation += 1
+        self._notify_listeners(name)
+
+        versions = self._versions[name]
+        del versions[bisect.bisect_left(versions, version)]
+        if not versions:
+            del self._versions[name]
+            del self._package_names[bisect.bisect_left(self._package_names, name)]
+
+    def _discard_path(self, filename):
+        del self._keys_by_path[filename]
+        directory = os.path.dirname(filename)
+        self._paths_by_directory[directory].discard(filename)
+        if not self._paths_by_directory[directory]:
+            del self._paths_by_directory[directory]
+
+    def _notify_listeners(self, name):
+        for listener in self._listeners:
+            try:
+                listener(name)
+            except Exception as e:
+                LOGGER.exception("Failed to notify listener of change of package {0}: {1}".format(name, e))
+
+    def _commit_package_file(self, name, version, temporary_filename, filename):
+        package_directory = os.path.dirname(filename)
+
+        parent_directories = [self._directory]
+        while len(package_directory) > len(self._directory):
+            parent_directories.append(package_directory)
+            package_directory = os.path.dirname(package_directory)
+
+        with self._lock:
+            unchanged_directories = [directory for directory in parent_directories
+                                     if self._read_directory_mtime(directory) == self._directory_mtimes.get(directory)]
+
+            os.rename(temporary_filename, filename)
+            _fsync_directory(os.path.dirname(filename))
+
+            for directory in reversed(parent_directories[1:]):
+                self._add_directory(directory)
+            self._add_file(name, version, filename)
+            for directory in unchanged_directories:
+                self._directory_mtimes[directory] = self._read_directory_mtime(directory)
 
     def _filename_from_name_and_version(self, name, version):
-        return os.path.join(self._directory, "{0}-{1}{2}".format(name, version, FILE_SUFFIX))
+        return layout.sharded_path(self._directory, name, "{0}-{1}{2}".format(name, version, FILE_SUFFIX))
+
+    def _read_directory_mtime(self, directory):
+        try:
+            return os.stat(directory).st_mtime
+        except OSError:
+            return None
+
+    def _refresh_if_modified(self):
+        if self._watcher is not None:
+            return
+        if self._read_directory_mtime(self._directory) != self._directory_mtimes.get(self._directory):
+            self._synchronize_directory(self._directory, recursive=False)
+        if time.time() - self._refreshed_at >= self._refresh_interval:
+            self._synchronize_modified_directories()
+
+    def _synchronize_modified_directories(self):
+        self._refreshed_at = time.time()
+        for directory in list(self._subdirectories):
+            if directory not in self._subdirectories:
+                continue  # forgotten while synchronizing its parent directory
+            if self._read_directory_mtime(directory) != self._directory_mtimes.get(directory):
+                self._synchronize_directory(directory, recursive=False)
+
+    def _synchronize(self):
+        LOGGER.debug("Synchronizing directory '%s' of packageindex '%s'", self._directory, self._name)
+
+        self._synchronize_directory(self._directory, recursive=True)
+
+    def _synchronize_directory(self, directory, recursive):
+        """
+            Applies the difference between the listing of the given directory and the index; only new files are
+            parsed. Subdirectories are synchronized if recursive is set or if they are new to the index.
+        """
+        self._directory_mtimes[directory] = self._read_directory_mtime(directory)
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            entries = []
 
-    def _read_files(self):
-        return itertools.ifilter(lambda f: f.endswith(FILE_SUFFIX), os.listdir(self._directory))
+        current_paths = set()
+        current_directories = set()
+        for entry in entries:
+            path = os.path.join(directory, entry)
+            if os.path.isdir(path):
+                current_directories.add(path)
+            elif entry.endswith(FILE_SUFFIX):
+                current_paths.add(path)
 
-    def _read_packages(self):
-        return itertools.imap(_guess_name_and_version, self._read_files())
+        known_paths = self._paths_by_directory.get(directory, set())
+        for path in known_paths - current_paths:
+            self._remove_file(path)
+        for path in current_paths - known_paths:
+            self.file_added(path)
+
+        for removed_directory in self._subdirectories.get(directory, set()) - current_directories:
+            self._forget_directory(removed_directory)
+        for subdirectory in current_directories:
+            if recursive or subdirectory not in self._subdirectories:
+                self._add_directory(subdirectory)
+                self._synchronize_directory(subdirectory, recursive=True)
+
+    def _add_directory(self, directory):
+        if directory not in self._subdirectories:
+            self._subdirectories[directory] = set()
+            self._subdirectories[os.path.dirname(directory)].add(directory)
+
+    def _forget_directory(self, directory):
+        for subdirectory in self._subdirectories.pop(directory, set()):
+            self._forget_directory(subdirectory)
+        self._subdirectories.get(os.path.dirname(directory), set()).discard(directory)
+        self._directory_mtimes.pop(directory, None)
+        for path in list(self._paths_by_directory.get(directory, [])):
+            self._remove_file(path)
+
+
+class PackageWriter(object):
+    """
+    Writes a package file of a PackageIndex chunk by chunk into a temporary file, hashing the content on the way.
+    The package file only becomes visible when the writer is committed. It gets the permissions of a file created
+    with open (PACKAGE_FILE_MODE), not the owner-only permissions of a temporary file.
+    """
+
+    def __init__(self, package_index, name, version, filename):
+        self._package_index = package_index
+        self._name = name
+        self._version = version
+        self._filename = filename
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+        self._size = 0
+
+        file_descriptor, self._temporary_filename = tempfile.mkstemp(
+            prefix=".", suffix=TEMPORARY_FILE_SUFFIX, dir=os.path.dirname(filename))
+        os.fchmod(file_descriptor, PACKAGE_FILE_MODE)
+        self._file = os.fdopen(file_descriptor, "wb")
+
+    @property
+    def digests(self):
+        return {"md5": self._md5.hexdigest(), "sha256": self._sha256.hexdigest()}
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def temporary_filename(self):
+        return self._temporary_filename
+
+    def flush(self):
+        self._file.flush()
+
+    def write(self, chunk):
+        self._md5.update(chunk)
+        self._sha256.update(chunk)
+        self._file.write(chunk)
+        self._size += len(chunk)
+
+    def commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._package_index._commit_package_file(self._name, self._version, self._temporary_filename, self._filename)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self._temporary_filename)
+        except OSError:
+            pass
 
 
 class ProxyPackageIndex(object):
     """
     Retrieves the packages from another pypi and stores them in a package index.
+
+    pypi_url is the url of the upstream pypi or a list of urls of mirrors of it. Each request goes to the fastest
+    available mirror and falls back to the others if it fails. With a hedge delay, a page of the simple index is
+    requested from a second mirror as well if the first one has not answered after hedge_delay seconds.
     """
-    def __init__(self, name, directory, pypi_url):
-        self._package_index = PackageIndex(name, directory)
-        self._pypi_url = pypi_url
+    def __init__(self, name, directory, pypi_url, stream_downloads=True, version_cache=None, upstream_client=None,
+                 index_snapshot=None, negative_cache=None, hedge_delay=0, access_tracker=None,
+                 refresh_interval=watcher.DEFAULT_POLLING_INTERVAL_SECONDS):
+        self._package_index = PackageIndex(name, directory, refresh_interval)
+        self._mirrors = MirrorSelector([pypi_url] if isinstance(pypi_url, basestring) else pypi_url)
+        self._pypi_url = self._mirrors.urls[0]
+        self._hedge_delay = hedge_delay
+        self._upstream_client = upstream_client or UpstreamClient()
+        self._stream_downloads = stream_downloads
+        self._version_cache = version_cache
+        self._refreshing_lock = threading.Lock()
+        self._refreshing = set()
+        self._index_snapshot = index_snapshot
+        self._upstream_index = None
+        self._upstream_generation = 0
+        self._snapshot_modification_time = None
+        if index_snapshot is not None:
+            self._snapshot_modification_time = index_snapshot.modification_time
+            snapshot = index_snapshot.load()
+            if snapshot is not None:
+                names, validators, fetched_at = snapshot
+                self._upstream_index = _UpstreamIndex(_sorted_unique(names), validators, fetched_at)
+        self._index_refresh_stopped = threading.Event()
+        self._index_refresher = None
+        self._package_fetches = SingleFlight()
+        self._url_fetches = SingleFlight()
+        self._downloads_lock = threading.Lock()
+        self._downloads = {}
+        self._listeners = []
+        self._negative_cache = negative_cache
+        self._access_tracker = access_tracker
+
+    @property
+    def generation(self):
+        """
+            Changes whenever the listed package names may have changed: when a different upstream index has been
+            fetched or, as long as there is no upstream index, when the cached packages change.
+        """
+        if self._upstream_index is not None:
+            return self._upstream_generation, None
+        return self._upstream_generation, self._package_index.generation
+
+    def add_listener(self, listener):
+        """
+            The listener is called with the package name whenever a cached file of the package changes or the
+            versions of the package in the version cache change.
+        """
+        self._listeners.append(listener)
+        self._package_index.add_listener(listener)
+
+    def forget_misses(self, name):
+        """
+            Forgets that upstream could not find the versions or files of the given package, e.g. because the
+            package has been uploaded.
+        """
+        if self._negative_cache is not None:
+            self._negative_cache.discard(name)
+
+    def list_cached_package_names(self):
+        return self._package_index.list_available_package_names()
+
+    @property
+    def refreshes_index_in_background(self):
+        """
+            True if the package names are listed from the index snapshot, so that the generation tells in advance
+            whether they have changed. Otherwise upstream is asked on every listing.
+        """
+        return self._index_snapshot is not None
+
+    def get_statistics(self):
+        return self._package_index.get_statistics()
+
+    def start_watching(self, polling_interval=watcher.DEFAULT_POLLING_INTERVAL_SECONDS):
+        self._package_index.start_watching(polling_interval)
+
+    def stop_watching(self):
+        self._package_index.stop_watching()
+
+    def file_removed(self, path):
+        """
+            Drops a cached file that has been deleted by other means, e.g. by the eviction in another process.
+        """
+        self._package_index.file_removed(path)
+
+    def start_refreshing_index(self, interval):
+        """
+            Refreshes the upstream index in the background every interval seconds, starting right away if the
+            index is missing or older than the interval.
+        """
+        self._index_refresh_stopped.clear()
+        self._index_refresher = threading.Thread(target=self._refresh_index_periodically, args=(interval,),
+                                                 name="refresh-index-{0}".format(self._pypi_url))
+        self._index_refresher.daemon = True
+        self._index_refresher.start()
+
+    def start_reloading_index(self, interval):
+        """
+            Reloads the upstream index from the index snapshot in the background whenever another process, which
+            refreshes the index, has stored a new snapshot. The snapshot is checked every interval seconds.
+        """
+        self._index_refresh_stopped.clear()
+        self._index_refresher = threading.Thread(target=self._reload_index_periodically, args=(interval,),
+                                                 name="reload-index-{0}".format(self._index_snapshot.filename))
+        self._index_refresher.daemon = True
+        self._index_refresher.start()
+
+    def stop_refreshing_index(self):
+        self._index_refresh_stopped.set()
+        if self._index_refresher is not None:
+            self._index_refresher.join()
+            self._index_refresher = None
+
+    def contains(self, name, version="*"):
+        """
+            @return: True if the given package is cached, without asking upstream
+        """
+        return self._package_index.contains(name, version)
+
+    def list_package_files(self):
+        return self._package_index.list_package_files()
+
+    def remove_package(self, name, version):
+        """
+            Deletes the cached file of the given package unless the package is being downloaded.
+            @return: the PackageFile of the deleted file or None
+        """
+        with self._downloads_lock:
+            if (name, version) in self._downloads:
+                return None
+            return self._package_index.remove_package(name, version)
 
     def get_package_content(self, name, version):
-        if not self._package_index.contains(name, version):
-            filename = "{0}-{1}{2}".format(name, version, FILE_SUFFIX)
-            package_url = "{0}/packages/source/{1}/{2}/{3}".format(self._pypi_url, name[0], name, filename)
-            LOGGER.info("Downloading package {0} in version {1} from {2}".format(name, version, package_url))
-            content = self._fetch_url(package_url, raw=True)
+        if not self._cache_package(name, version):
+            return None
+        content = self._package_index.get_package_content(name, version)
+        if content is not None:
+            self._record_access(name, version)
+        return content
 
-            self._package_index.add_package(name, version, content)
+    def get_package_file(self, name, version):
+        """
+            @return: the PackageFile of the cached package, downloading it first if needed, or None
+        """
+        package_file = self._get_package_file(name, version)
+        if package_file is not None:
+            self._record_access(name, version)
+        return package_file
 
-        return self._package_index.get_package_content(name, version)
+    def open_package(self, name, version):
+        """
+            Returns the PackageFile if the package is cached. Otherwise, when streaming downloads, starts
+            downloading the package and returns a CachingDownload that yields the content while it is written to
+            the cache; the package is cached when the download is complete. If the package is already being
+            downloaded for another request, an iterator following that download is returned instead.
+            @return: a PackageFile, an iterable with a size attribute or None
+        """
+        package = self._open_package(name, version)
+        if package is not None:
+            self._record_access(name, version)
+        return package
 
     def list_available_package_names(self):
-        pypi_index_url = "{0}/simple/".format(self._pypi_url)
-        LOGGER.info("Downloading index from {0}".format(pypi_index_url))
-
-        index_content = self._fetch_url(pypi_index_url)
-        if index_content is not None:
-            return self._extract_package_names(index_content)
+        """
+            Lists the package names of the upstream index, sorted and without duplicates. With an index snapshot,
+            the names are taken from the snapshot, which is refreshed in the background, and upstream is never
+            asked while listing. Falls back to the cached packages as long as no upstream index is available.
+        """
+        if self._index_snapshot is None:
+            upstream_index = self._refresh_index()
         else:
-            return sorted(list(self._package_index.list_available_package_names()))
+            upstream_index = self._upstream_index
+
+        if upstream_index is not None:
+            return list(upstream_index.names)
+        return list(self._package_index.list_available_package_names())
 
     def list_versions(self, name):
-        versions_url = "{0}/simple/{1}/".format(self._pypi_url, name)
-        LOGGER.info("Downloading versions from {0}".format(versions_url))
-        versions_content = self._fetch_url(versions_url)
+        """
+            Lists the versions of the given package on the upstream pypi. With a version cache, cached versions are
+            returned right away and refreshed in the background once they are stale. Falls back to the cached
+            versions and finally to the cached packages when upstream cannot be reached.
+        """
+        if self._version_cache is not None:
+            entry = self._version_cache.get(name)
+            if entry is not None:
+                if self._version_cache.is_stale(entry):
+                    self._refresh_versions_in_background(name)
+                return list(entry.versions)
 
-        if versions_content is not None:
-            LOGGER.info("Downloaded versions page for {0} from {1} is {2} bytes.".format(name, versions_url, len(versions_content)))
-            return self._extract_versions(versions_content)
+        versions = self._fetch_versions(name)
+        if versions is not None:
+            return versions
         else:
             return sorted(list(self._package_index.list_versions(name)))
 
-    def _extract_package_names(self, index_content):
-        result = []
-        for line in index_content.split('\n'):
+    def _record_access(self, name, version):
+        if self._access_tracker is not None:
+            self._access_tracker.record(name, version)
+
+    def _open_package(self, name, version):
+        package_file = self._package_index.get_package_file(name, version)
+        if package_file is not None or not self._stream_downloads:
+            return package_file or self._get_package_file(name, version)
+
+        key = (name, version)
+        with self._downloads_lock:
+            download = self._downloads.get(key)
+            if download is None:
+                starting_download = self._downloads[key] = _StartingDownload()
+
+        if download is None:
+            return self._start_download(key, starting_download)
+
+        LOGGER.info("Following running download of package {0} in version {1}".format(name, version))
+        if isinstance(download, _StartingDownload):
+            download = download.wait_for_start()
+        try:
+            following_download = download.follow() if download is not None else None
+        except IOError as e:
+            LOGGER.warn("Could not follow download of package {0} in version {1}: {2}".format(name, version, e))
+            following_download = None
+        if following_download is None:
+            return self._package_index.get_package_file(name, version)
+        return following_download
+
+    def _get_package_file(self, name, version):
+        if not self._cache_package(name, version):
+            return None
+        return self._package_index.get_package_file(name, version)
+
+    def _refresh_index(self):
+        LOGGER.info("Downloading index from upstream")
+
+        upstream_index = self._upstream_index
+        package_names, validators = self._fetch_page("/simple/", self._extract_package_names,
+                                                     upstream_index.validators if upstream_index else None)
+        if package_names is _NOT_MODIFIED:
+            LOGGER.info("Index on upstream has not been modified")
+            self._upstream_index = _UpstreamIndex(upstream_index.names, upstream_index.validators, time.time())
+        elif package_names is not None:
+            self._upstream_index = _UpstreamIndex(_sorted_unique(package_names), validators, time.time())
+            self._upstream_generation += 1
+            if self._index_snapshot is not None:
+                self._index_snapshot.store(*self._upstream_index)
+        return self._upstream_index
+
+    def _refresh_index_periodically(self, interval):
+        upstream_index = self._upstream_index
+        delay = 0 if upstream_index is None else max(0, upstream_index.fetched_at + interval - time.time())
+        while not self._index_refresh_stopped.wait(delay):
+            try:
+                self._refresh_index()
+            except Exception as e:
+                LOGGER.exception("Failed to refresh index from {0}: {1}".format(self._pypi_url, e))
+            delay = interval
+
+    def _reload_index(self):
+        """
+            @return: True if a new snapshot has been loaded
+        """
+        modification_time = self._index_snapshot.modification_time
+        if modification_time == self._snapshot_modification_time:
+            return False
+        self._snapshot_modification_time = modification_time
+        snapshot = self._index_snapshot.load()
+        if snapshot is None:
+            return False
+
+        names, validators, fetched_at = snapshot
+        names = _sorted_unique(names)
+        upstream_index = self._upstream_index
+        self._upstream_index = _UpstreamIndex(names, validators, fetched_at)
+        if upstream_index is None or upstream_index.names != names:
+            self._upstream_generation += 1
+        return True
+
+    def _reload_index_periodically(self, interval):
+        while not self._index_refresh_stopped.wait(interval):
+            try:
+                self._reload_index()
+            except Exception as e:
+                LOGGER.exception("Failed to reload index from {0}: {1}".format(self._index_snapshot.filename, e))
+
+    def _fetch_versions(self, name):
+        versions_path = "/simple/{0}/".format(name)
+        LOGGER.info("Downloading versions from {0}".format(versions_path))
+        entry = self._version_cache.get(name) if self._version_cache is not None else None
+        versions, validators = self._fetch_page(versions_path, self._extract_versions,
+                                                entry.validators if entry else None, name)
+
+        if versions is None:
+            return None
+        if versions is _NOT_MODIFIED:
+            LOGGER.info("Versions page for {0} has not been modified".format(name))
+            return self._version_cache.put(name, entry.versions, entry.validators).versions
+
+        if self._version_cache is not None:
+            self._version_cache.put(name, versions, validators)
+            if entry is None or entry.versions != versions:
+                for listener in self._listeners:
+                    listener(name)
+        return versions
+
+    def _refresh_versions(self, name):
+        try:
+            if self._fetch_versions(name) is None:
+                LOGGER.info("Could not refresh versions of {0}, keeping stale versions".format(name))
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(name)
+
+    def _refresh_versions_in_background(self, name):
+        with self._refreshing_lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+
+        refresh_thread = threading.Thread(target=self._refresh_versions, args=(name,),
+                                          name="refresh-versions-{0}".format(name))
+        refresh_thread.daemon = True
+        refresh_thread.start()
+
+    def _cache_package(self, name, version):
+        if self._package_index.contains(name, version):
+            return True
+
+        with self._downloads_lock:
+            download = self._downloads.get((name, version))
+        if isinstance(download, _StartingDownload):
+            download = download.wait_for_start()
+        if download is not None:
+            download.wait()
+            return self._package_index.contains(name, version)
+
+        return self._package_fetches.do((name, version), self._download_package, name, version)
+
+    def _download_package(self, name, version):
+        if self._package_index.contains(name, version):
+            return True
+
+        package_path = self._package_path(name, version)
+        LOGGER.info("Downloading package {0} in version {1} from {2}".format(name, version, package_path))
+        stream = self._open_url(package_path, name=name)
+        if stream is None:
+            return False
+
+        try:
+            self._package_index.add_package(name, version, stream)
+            return True
+        except IOError as e:
+            LOGGER.warn("Could not download {0}: {1}".format(package_path, e))
+            return False
+        finally:
+            stream.close()
+
+    def _extract_package_names(self, index_stream):
+        for line in iterate_segments(index_stream, "\n"):
             if line.startswith('<a href'):
-                name = self._extract_package_name_from_link(line)
-                result.append(name)
-        return result
+                yield self._extract_package_name_from_link(line.decode("utf8"))
 
     def _extract_package_name_from_link(self, line):
         return line[line.find('>') + 1:line.rfind('</a><br/>')]
 
-    def _extract_versions(self, versions_content):
-        result = []
-        hrefs = _HREF_PATTERN.findall(versions_content)
-        for href in hrefs :
-            if FILE_SUFFIX in href:
-                name = href.decode("utf8")
-                if "#md5" in name:
-                    name = name[0:name.rfind('#md5')]
-                version = _guess_name_and_version(name)[1]
-                result.append(version)
-        return result
-
-    def _fetch_url(self, url, raw=False):
-        stream = None
+    def _extract_versions(self, versions_stream):
+        for tag in iterate_segments(versions_stream, ">"):
+            for href in _HREF_PATTERN.findall(tag):
+                if FILE_SUFFIX in href:
+                    name = href.decode("utf8")
+                    if "#md5" in name:
+                        name = name[0:name.rfind('#md5')]
+                    yield _guess_name_and_version(name)[1]
+
+    def _forget_download(self, key, download):
+        with self._downloads_lock:
+            if self._downloads.get(key) is download:
+                del self._downloads[key]
+
+    def _open_download(self, key):
+        name, version = key
+        if self._package_index.contains(name, version):
+            return None
+
+        package_path = self._package_path(name, version)
+        LOGGER.info("Streaming package {0} in version {1} from {2}".format(name, version, package_path))
+        stream = self._open_url(package_path, name=name)
+        if stream is None:
+            return None
+
         try:
-            if 'http_proxy' in os.environ and 'https_proxy' in os.environ:
-                proxy = urllib2.ProxyHandler({'http': os.environ['http_proxy'], 'https': os.environ['https_proxy']})
-                opener = urllib2.build_opener(proxy)
-                stream = opener.open(url)
-            else:
-                stream = urllib2.urlopen(url)
-            raw_content = stream.read()
-            if raw:
-                return raw_content
-            else:
-                return raw_content.decode("utf8")
-        except urllib2.URLError as e:
+            package_writer = self._package_index.open_package_writer(name, version)
+        except:
+            stream.close()
+            raise
+        return CachingDownload(stream, package_writer, _read_content_length(stream),
+                               on_done=lambda download: self._forget_download(key, download))
+
+    def _start_download(self, key, starting_download):
+        download = None
+        try:
+            download = self._open_download(key)
+        finally:
+            with self._downloads_lock:
+                if download is None:
+                    del self._downloads[key]
+                else:
+                    self._downloads[key] = download
+            starting_download.started(download)
+
+        return download or self._package_index.get_package_file(*key)
+
+    def _fetch_page(self, path, parse, validators=None, name=None):
+        """
+            Fetches a page of the simple index from upstream, as a hedged request and as a conditional request if
+            the validators of an earlier response are given. The response is parsed while it is read: parse is
+            called with the response stream and yields the items found on the page.
+            @return: a tuple (items, validators); items is a list, _NOT_MODIFIED if the page has not changed since
+                the earlier response or None if the page could not be fetched
+        """
+        return self._url_fetches.do((path, validators), self._fetch_page_now, path, parse, validators, name)
+
+    def _fetch_page_now(self, path, parse, validators, name):
+        headers = _conditional_headers(validators)
+        if headers:
+            metrics.increment("upstream.conditional_requests")
+
+        stream = self._open_url(path, headers, name, hedge=True)
+        if stream is _NOT_MODIFIED:
+            metrics.increment("upstream.not_modified")
+            metrics.increment("upstream.bytes_saved", validators.size or 0)
+            return _NOT_MODIFIED, validators
+        if stream is None:
+            return None, None
+        counting_stream = CountingReader(stream)
+        try:
+            items = list(parse(counting_stream))
+            LOGGER.info("Downloaded {0} items in {1} bytes from {2}".format(len(items), counting_stream.count, path))
+            return items, _read_validators(stream, counting_stream.count)
+        except IOError as e:
+            LOGGER.warn("Could not fetch {0}: {1}".format(path, e))
+            return None, None
+        finally:
+            metrics.increment("upstream.bytes_downloaded", counting_stream.count)
+            stream.close()
+
+    def _open_url(self, path, headers=None, name=None, hedge=False):
+        """
+            Requests the given path from the upstream mirrors, see _open_on_mirrors.
+            If the path belongs to the package with the given name and there is a negative cache, a path upstream
+            could not find (404 or 410) is not requested again until its entry expires.
+            @return: the response stream, None if the path could not be opened or _NOT_MODIFIED if upstream answered
+                a conditional request with 304
+        """
+        negative_cache = self._negative_cache if name is not None else None
+        if negative_cache is not None and negative_cache.contains(path):
+            LOGGER.debug("Not fetching {0}, upstream could not find it recently".format(path))
+            return None
+
+        response = self._open_on_mirrors(path, headers or {}, hedge)
+        if response is None:
+            return None
+
+        if response.status == httplib.OK:
+            return response
+        response.close()
+        if response.status == httplib.NOT_MODIFIED:
+            return _NOT_MODIFIED
+        if response.status in (httplib.NOT_FOUND, httplib.GONE) and negative_cache is not None:
+            negative_cache.add(name, path)
+        LOGGER.warn("Could not fetch {0}: HTTP status {1}".format(path, response.status))
+        return None
+
+    def _open_on_mirrors(self, path, headers, hedge):
+        """
+            Sends the request to the mirrors in the order of the mirror selector until one of them answers without
+            a server error. With hedge and a hedge delay, the first two mirrors are raced: the second one is asked
+            as well if the first one has not answered after the hedge delay, and the first answer is taken.
+            @return: the response or None if no mirror answered
+        """
+        mirror_urls = self._mirrors.rank(self._upstream_client.is_available)
+        if hedge and self._hedge_delay > 0 and len(mirror_urls) > 1:
+            hedged_request = _HedgedRequest()
+            hedged_request.send(self._open_on_mirror, mirror_urls[0], path, headers)
+            response = hedged_request.wait(self._hedge_delay)
+            if response is None:
+                if hedged_request.pending:
+                    metrics.increment("upstream.hedged_requests")
+                hedged_request.send(self._open_on_mirror, mirror_urls[1], path, headers)
+                response = hedged_request.wait()
+            if response is not None:
+                return response
+            mirror_urls = mirror_urls[2:]
+
+        for mirror_url in mirror_urls:
+            response = self._open_on_mirror(mirror_url, path, headers)
+            if response is not None:
+                return response
+            metrics.increment("upstream.failed_mirror_requests")
+        return None
+
+    def _open_on_mirror(self, mirror_url, path, headers):
+        url = mirror_url + path
+        started_at = time.time()
+        try:
+            response = self._upstream_client.open(url, headers)
+        except CircuitOpenError as e:
+            LOGGER.debug(str(e))
+            return None
+        except UpstreamError as e:
             LOGGER.warn("Could not fetch {0}: {1}".format(url, e))
+            self._mirrors.record_failure(mirror_url)
             return None
+
+        if response.status >= httplib.INTERNAL_SERVER_ERROR:
+            response.close()
+            LOGGER.warn("Could not fetch {0}: HTTP status {1}".format(url, response.status))
+            self._mirrors.record_failure(mirror_url)
+            return None
+        self._mirrors.record_latency(mirror_url, time.time() - started_at)
+        response.add_failure_listener(lambda: self._mirrors.record_failure(mirror_url))
+        return response
+
+    def _package_path(self, name, version):
+        filename = "{0}-{1}{2}".format(name, version, FILE_SUFFIX)
+        return "/packages/source/{0}/{1}/{2}".format(name[0], name, filename)
+
+
+_NOT_MODIFIED = object()
+
+_UpstreamIndex = collections.namedtuple("_UpstreamIndex", ["names", "validators", "fetched_at"])
+
+
+def _sorted_unique(names):
+    return sorted(set(names))
+
+
+def _conditional_headers(validators):
+    headers = {}
+    if validators is not None:
+        if validators.etag:
+            headers["If-None-Match"] = validators.etag
+        if validators.last_modified:
+            headers["If-Modified-Since"] = validators.last_modified
+    return headers
+
+
+def _read_validators(stream, size):
+    try:
+        response_headers = stream.info()
+        etag = response_headers.get("ETag")
+        last_modified = response_headers.get("Last-Modified")
+    except AttributeError:
+        return None
+    if not etag and not last_modified:
+        return None
+    return Validators(etag, last_modified, size)
+
+
+class _HedgedRequest(object):
+    """
+    Runs concurrent requests for the same page in background threads and keeps the first response; responses
+    arriving later are closed.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._response = None
+
+    @property
+    def pending(self):
+        with self._condition:
+            return self._pending
+
+    def send(self, open_response, *arguments):
+        """
+            Calls open_response with the given arguments in a background thread; it returns a response or None.
+        """
+        with self._condition:
+            self._pending += 1
+        request_thread = threading.Thread(target=self._run, args=(open_response,) + arguments, name="hedged-request")
+        request_thread.daemon = True
+        request_thread.start()
+
+    def wait(self, timeout=None):
+        """
+            Waits for the first response, at most timeout seconds.
+            @return: the first response or None if there is none yet or all requests failed
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._response is None and self._pending > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._response
+
+    def _run(self, open_response, *arguments):
+        response = None
+        try:
+            response = open_response(*arguments)
         finally:
-            if stream is not None:
-                stream.close()
+            with self._condition:
+                self._pending -= 1
+                if self._response is None:
+                    self._response, response = response, None
+                self._condition.notify_all()
+            if response is not None:
+                response.close()
+
+
+class _StartingDownload(object):
+    """
+    Placeholder for a download whose upstream request has been sent but not answered yet.
+    """
+
+    def __init__(self):
+        self._started = threading.Event()
+        self._download = None
+
+    def started(self, download):
+        self._download = download
+        self._started.set()
+
+    def wait_for_start(self):
+        self._started.wait()
+        return self._download
+
+
+def _read_content_length(stream):
+    try:
+        return int(stream.info().get("Content-Length"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
 
 class UniqueIterator(object):
     """
@@ -0,0 +1,171 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    A pre-forking master process: the application is initialized once in the master, then worker processes are
+    forked that share the memory of the master copy-on-write and serve requests from one listening socket.
+"""
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import errno
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+LOGGER = logging.getLogger("pypiproxy.prefork")
+
+DEFAULT_BACKLOG = 128
+DEFAULT_GRACEFUL_TIMEOUT_SECONDS = 30.0
+
+MINIMUM_WORKER_LIFETIME_SECONDS = 1.0
+RESTART_DELAY_SECONDS = 1.0
+
+_SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15 if sys.platform.startswith("linux") else None)
+
+
+def create_listening_socket(host, port, backlog=DEFAULT_BACKLOG):
+    """
+        Binds a listening socket with SO_REUSEADDR and, where supported, SO_REUSEPORT, so that a new master can
+        bind the address while the previous one is still shutting down.
+    """
+    family, socket_type, protocol, _, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+    listening_socket = socket.socket(family, socket_type, protocol)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if _SO_REUSEPORT is not None:
+        try:
+            listening_socket.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+        except socket.error as e:
+            LOGGER.info("SO_REUSEPORT is not supported: {0}".format(e))
+    listening_socket.bind(address)
+    listening_socket.listen(backlog)
+    return listening_socket
+
+
+class PreforkMaster(object):
+    """
+    Keeps the given number of worker processes running. Each worker calls serve_worker(listening_socket,
+    worker_number), which serves until the worker receives SIGTERM and the requests in progress are done. The
+    workers are numbered from 0 to workers - 1; a worker that exits while the master is running is replaced by a
+    worker with the same number. On SIGTERM or SIGINT the master sends SIGTERM to all workers and waits up to
+    graceful_timeout seconds for them before killing them.
+    """
+
+    def __init__(self, listening_socket, serve_worker, workers, graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT_SECONDS):
+        self._listening_socket = listening_socket
+        self._serve_worker = serve_worker
+        self._number_of_workers = workers
+        self._graceful_timeout = graceful_timeout
+        self._workers = {}
+        self._worker_numbers = {}
+        self._stopping = False
+
+    @property
+    def workers(self):
+        return dict(self._workers)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        LOGGER.info("Starting {0} worker(s) on {1}".format(self._number_of_workers,
+                                                            self._listening_socket.getsockname()))
+        try:
+            while not self._stopping:
+                self._spawn_missing_workers()
+                self._wait_for_worker()
+        finally:
+            self._stop_workers()
+
+    def _stop(self, signal_number, frame):
+        LOGGER.info("Received signal {0}, shutting down".format(signal_number))
+        self._stopping = True
+
+    def _spawn_missing_workers(self):
+        while len(self._workers) < self._number_of_workers and not self._stopping:
+            used_numbers = set(self._worker_numbers.values())
+            worker_number = min(number for number in range(self._number_of_workers) if number not in used_numbers)
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker(worker_number)
+            self._workers[pid] = time.time()
+            self._worker_numbers[pid] = worker_number
+            LOGGER.info("Started worker {0} as number {1}".format(pid, worker_number))
+
+    def _run_worker(self, worker_number):
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self._serve_worker(self._listening_socket, worker_number)
+        except BaseException as e:
+            LOGGER.exception("Worker {0} failed: {1}".format(os.getpid(), e))
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _wait_for_worker(self):
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.ECHILD):
+                return
+            raise
+        started_at = self._workers.pop(pid, None)
+        self._worker_numbers.pop(pid, None)
+        if started_at is None or self._stopping:
+            return
+
+        LOGGER.warn("Worker {0} exited with status {1}, restarting it".format(pid, status))
+        if time.time() - started_at < MINIMUM_WORKER_LIFETIME_SECONDS:
+            time.sleep(RESTART_DELAY_SECONDS)
+
+    def _stop_workers(self):
+        for pid in self._workers:
+            self._signal_worker(pid, signal.SIGTERM)
+
+        deadline = time.time() + self._graceful_timeout
+        while self._workers and time.time() < deadline:
+            self._reap_workers()
+            time.sleep(0.1)
+
+        for pid in self._workers:
+            LOGGER.warn("Killing worker {0} after {1} seconds".format(pid, self._graceful_timeout))
+            self._signal_worker(pid, signal.SIGKILL)
+        while self._workers:
+            self._reap_workers(0)
+        LOGGER.info("All workers stopped")
+
+    def _reap_workers(self, options=os.WNOHANG):
+        for pid in list(self._workers):
+            try:
+                reaped_pid, _ = os.waitpid(pid, options)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                reaped_pid = pid
+            if reaped_pid == pid:
+                del self._workers[pid]
+                self._worker_numbers.pop(pid, None)
+
+    @staticmethod
+    def _signal_worker(pid, signal_number):
+        try:
+            os.kill(pid, signal_number)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
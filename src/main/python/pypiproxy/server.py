@@ -0,0 +1,146 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Runs the web application, either with the Flask development server or with gevent. gevent serves each request
+    in a greenlet and makes the blocking operations of the standard library (sockets, locks, sleeping) cooperative,
+    so that requests waiting for upstream do not hold a thread each. gevent is optional and only needed for the
+    gevent server mode.
+
+    In production, run_prefork serves from several pre-forked worker processes (see pypiproxy.prefork).
+"""
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import logging
+import signal
+import socket
+import threading
+import time
+
+from .prefork import DEFAULT_BACKLOG, DEFAULT_GRACEFUL_TIMEOUT_SECONDS, PreforkMaster, create_listening_socket
+
+LOGGER = logging.getLogger("pypiproxy.server")
+
+SERVER_MODE_FLASK = "flask"
+SERVER_MODE_GEVENT = "gevent"
+SERVER_MODES = (SERVER_MODE_FLASK, SERVER_MODE_GEVENT)
+
+DEFAULT_PORT = 5000
+DEFAULT_TIMEOUT_SECONDS = 60.0
+
+
+def prepare(server_mode):
+    """
+        Prepares the process for the given server mode. Must be called before the web application is imported and
+        before any thread is started: in gevent mode, the standard library is patched to cooperate with gevent.
+        @raise ValueError: if the server mode is unknown or gevent is not installed
+    """
+    _verify_server_mode(server_mode)
+    if server_mode == SERVER_MODE_GEVENT:
+        try:
+            from gevent import monkey
+        except ImportError:
+            raise ValueError("Server mode '{0}' requires gevent to be installed".format(server_mode))
+        monkey.patch_all()
+
+
+def run(application, server_mode=SERVER_MODE_FLASK, host=None, port=DEFAULT_PORT, **options):
+    """
+        Serves the application until the process is stopped. options are passed to the Flask server.
+        @raise ValueError: if the server mode is unknown
+    """
+    _verify_server_mode(server_mode)
+    if server_mode == SERVER_MODE_FLASK:
+        application.run(host=host, port=port, **options)
+        return
+
+    from gevent.pywsgi import WSGIServer
+
+    address = (host or "127.0.0.1", port)
+    LOGGER.info("Serving on {0}:{1} with gevent".format(*address))
+    WSGIServer(address, application).serve_forever()
+
+
+def run_prefork(application, server_mode, host, port, workers, backlog=DEFAULT_BACKLOG,
+                timeout=DEFAULT_TIMEOUT_SECONDS, graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT_SECONDS,
+                on_worker_start=None):
+    """
+        Serves the application from the given number of worker processes sharing one listening socket until the
+        process receives SIGTERM or SIGINT. The application should be initialized before, so that the workers
+        share its memory; on_worker_start is called with the worker number (see PreforkMaster) in each worker
+        before it serves, e.g. to start the threads that did not survive the fork. Client connections time out
+        after timeout seconds.
+        @raise ValueError: if the server mode is unknown
+    """
+    _verify_server_mode(server_mode)
+    listening_socket = create_listening_socket(host, port, backlog)
+
+    def serve(worker_socket, worker_number):
+        if on_worker_start is not None:
+            on_worker_start(worker_number)
+        serve_worker(application, worker_socket, server_mode, timeout, graceful_timeout)
+
+    PreforkMaster(listening_socket, serve, workers, graceful_timeout).run()
+
+
+def serve_worker(application, listening_socket, server_mode, timeout=DEFAULT_TIMEOUT_SECONDS,
+                 graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT_SECONDS):
+    """
+        Serves the application on an inherited listening socket until SIGTERM. Then the worker stops accepting
+        connections and waits up to graceful_timeout seconds for the requests in progress.
+    """
+    socket.setdefaulttimeout(timeout)
+    if server_mode == SERVER_MODE_GEVENT:
+        _serve_worker_with_gevent(application, listening_socket, graceful_timeout)
+    else:
+        _serve_worker_with_werkzeug(application, listening_socket, graceful_timeout)
+
+
+def _serve_worker_with_werkzeug(application, listening_socket, graceful_timeout):
+    from werkzeug.serving import make_server
+
+    host, port = listening_socket.getsockname()[:2]
+    worker_server = make_server(host, port, application, threaded=True, fd=listening_socket.fileno())
+    worker_server.daemon_threads = False
+
+    def shutdown(signal_number, frame):
+        threading.Thread(target=worker_server.shutdown, name="shutdown").start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    worker_server.serve_forever()
+    _join_request_threads(graceful_timeout)
+
+
+def _join_request_threads(timeout):
+    deadline = time.time() + timeout
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join(max(0, deadline - time.time()))
+
+
+def _serve_worker_with_gevent(application, listening_socket, graceful_timeout):
+    import gevent
+    from gevent.pywsgi import WSGIServer
+
+    worker_server = WSGIServer(listening_socket, application)
+    signal_handler = getattr(gevent, "signal_handler", None) or gevent.signal
+    signal_handler(signal.SIGTERM, worker_server.stop, graceful_timeout)
+    worker_server.serve_forever()
+
+
+def _verify_server_mode(server_mode):
+    if server_mode not in SERVER_MODES:
+        raise ValueError("Unknown server mode '{0}', expected one of {1}".format(server_mode, ", ".join(SERVER_MODES)))
@@ -15,30 +15,155 @@
 
 __author__ = "Michael Gruber, Alexander Metzner"
 
+import collections
+import hashlib
+import heapq
+import itertools
 import logging
 import os
 
+from .cache import (DEFAULT_NEGATIVE_CACHE_MAXIMUM_ENTRIES, DEFAULT_NEGATIVE_CACHE_TIME_TO_LIVE,
+                    DEFAULT_VERSION_CACHE_TIME_TO_LIVE, IndexSnapshot, NegativeCache, VersionCache)
+from .eviction import DEFAULT_EVICTION_INTERVAL_SECONDS, DEFAULT_GRACE_PERIOD_SECONDS, LRU, AccessTracker, CacheEvictor
+from .export import DEFAULT_EXPORT_INTERVAL_SECONDS, StaticExport
 from .packageindex import PackageIndex, ProxyPackageIndex
+from .upstream import (DEFAULT_CONNECT_TIMEOUT_SECONDS, DEFAULT_POOL_SIZE, DEFAULT_READ_TIMEOUT_SECONDS,
+                       DEFAULT_RESET_TIMEOUT_SECONDS, CircuitBreaker, UpstreamClient, read_proxy_settings)
+from .watcher import DEFAULT_POLLING_INTERVAL_SECONDS
 
 LOGGER = logging.getLogger("pypiproxy.services")
 
+_MergedPackageNames = collections.namedtuple("_MergedPackageNames", ["generations", "names", "digest"])
+
 _hosted_packages_index = None
 _proxy_packages_index = None
+_merged_package_names = None
+_static_export = None
+_background_tasks = []
+_replica_background_tasks = []
+_watch_tasks = []
+_watch_package_directories = False
+
+def initialize_services(hosted_packages_directory, cached_packages_directory, pypi_url,
+                        watch_package_directories=False, watch_polling_interval=DEFAULT_POLLING_INTERVAL_SECONDS,
+                        stream_upstream_downloads=True, version_cache_directory=None,
+                        version_cache_time_to_live=DEFAULT_VERSION_CACHE_TIME_TO_LIVE,
+                        upstream_pool_size=DEFAULT_POOL_SIZE, upstream_connect_timeout=DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                        upstream_read_timeout=DEFAULT_READ_TIMEOUT_SECONDS, upstream_index_snapshot=None,
+                        upstream_index_refresh_interval=0, static_export_directory=None,
+                        static_export_interval=DEFAULT_EXPORT_INTERVAL_SECONDS, defer_background_tasks=False,
+                        negative_cache_time_to_live=0,
+                        negative_cache_maximum_entries=DEFAULT_NEGATIVE_CACHE_MAXIMUM_ENTRIES,
+                        upstream_failure_threshold=0, upstream_reset_timeout=DEFAULT_RESET_TIMEOUT_SECONDS,
+                        upstream_hedge_delay=0, cached_packages_size_limit=0, eviction_policy=LRU,
+                        eviction_interval=DEFAULT_EVICTION_INTERVAL_SECONDS,
+                        eviction_grace_period=DEFAULT_GRACE_PERIOD_SECONDS):
+    """
+        Creates the package indexes; pypi_url is the url of the upstream pypi or an ordered list of mirror urls.
+        With a cached_packages_size_limit (in bytes), cached packages are evicted according to the eviction policy
+        once their total size exceeds the limit; hosted packages are never evicted. The background tasks (index
+        refresh, eviction, watchers, static export) are started right away unless defer_background_tasks is set;
+        then start_background_tasks has to be called, e.g. in each process forked after initializing, since
+        threads do not survive a fork.
+    """
+    global _background_tasks, _replica_background_tasks, _watch_tasks, _watch_package_directories
+    _background_tasks = []
+    _replica_background_tasks = []
+    _watch_tasks = []
+    _watch_package_directories = watch_package_directories
 
-def initialize_services(hosted_packages_directory, cached_packages_directory, pypi_url):
     global _hosted_packages_index
-    _hosted_packages_index = PackageIndex("hosted", hosted_packages_directory)
+    _hosted_packages_index = PackageIndex("hosted", hosted_packages_directory, watch_polling_interval)
+
+    version_cache = None
+    if version_cache_directory is not None and version_cache_time_to_live > 0:
+        version_cache = VersionCache(version_cache_directory, version_cache_time_to_live)
+
+    index_snapshot = None
+    if upstream_index_snapshot is not None and upstream_index_refresh_interval > 0:
+        index_snapshot = IndexSnapshot(upstream_index_snapshot)
+
+    negative_cache = None
+    if negative_cache_time_to_live > 0:
+        negative_cache = NegativeCache(negative_cache_time_to_live, negative_cache_maximum_entries)
+
+    proxies = read_proxy_settings(os.environ)
+    if proxies:
+        LOGGER.info("Using proxies {0} for upstream requests".format(proxies))
+    create_circuit_breaker = None
+    if upstream_failure_threshold > 0:
+        create_circuit_breaker = lambda host: CircuitBreaker(upstream_failure_threshold, upstream_reset_timeout, host)
+    upstream_client = UpstreamClient(upstream_pool_size, upstream_connect_timeout, upstream_read_timeout, proxies,
+                                     create_circuit_breaker)
+
+    access_tracker = AccessTracker() if cached_packages_size_limit > 0 else None
 
     global _proxy_packages_index
-    _proxy_packages_index = ProxyPackageIndex("cached", cached_packages_directory, pypi_url)
+    _proxy_packages_index = ProxyPackageIndex("cached", cached_packages_directory, pypi_url,
+                                              stream_downloads=stream_upstream_downloads,
+                                              version_cache=version_cache, upstream_client=upstream_client,
+                                              index_snapshot=index_snapshot, negative_cache=negative_cache,
+                                              hedge_delay=upstream_hedge_delay, access_tracker=access_tracker,
+                                              refresh_interval=watch_polling_interval)
+    _hosted_packages_index.add_listener(_proxy_packages_index.forget_misses)
+    if access_tracker is not None:
+        LOGGER.info("Evicting cached packages ({0}) beyond {1} bytes".format(eviction_policy,
+                                                                             cached_packages_size_limit))
+        cache_evictor = CacheEvictor(_proxy_packages_index, access_tracker, cached_packages_size_limit,
+                                     eviction_policy, eviction_grace_period)
+        _proxy_packages_index.add_listener(cache_evictor.package_changed)
+        _background_tasks.append(lambda: cache_evictor.start(eviction_interval))
+    if index_snapshot is not None:
+        _background_tasks.append(lambda: _proxy_packages_index.start_refreshing_index(upstream_index_refresh_interval))
+        _replica_background_tasks.append(lambda: _proxy_packages_index.start_reloading_index(watch_polling_interval))
+
+    _watch_tasks.append(lambda: _hosted_packages_index.start_watching(watch_polling_interval))
+    _watch_tasks.append(lambda: _proxy_packages_index.start_watching(watch_polling_interval))
+
+    global _static_export
+    _static_export = None
+    if static_export_directory is not None:
+        LOGGER.info("Exporting simple index to {0}".format(static_export_directory))
+        _static_export = StaticExport(static_export_directory, list_available_package_names, list_versions,
+                                      get_package_names_generation)
+        _hosted_packages_index.add_listener(_static_export.package_changed)
+        _proxy_packages_index.add_listener(_static_export.package_changed)
+        for name in itertools.chain(_hosted_packages_index.list_available_package_names(),
+                                    _proxy_packages_index.list_cached_package_names()):
+            _static_export.package_changed(name)
+        _background_tasks.append(lambda: _static_export.start(static_export_interval))
+
+    if not defer_background_tasks:
+        start_background_tasks()
 
-def add_package(name, version, content_stream):
+def start_background_tasks(worker_number=None):
+    """
+        Starts the background tasks in this process. In pre-forked workers, given their worker_number, the tasks
+        that must run only once (upstream index refresh, static export, eviction) are started in worker 0 only;
+        the other workers reload the upstream index snapshot that worker 0 stores. Pre-forked workers always watch
+        the package directories, so that they see the packages the other workers add and remove.
+    """
+    tasks = []
+    if worker_number is None or worker_number == 0:
+        tasks.extend(_background_tasks)
+    else:
+        tasks.extend(_replica_background_tasks)
+    if worker_number is not None or _watch_package_directories:
+        tasks.extend(_watch_tasks)
+
+    LOGGER.debug("Starting {0} background task(s)".format(len(tasks)))
+    for start_task in tasks:
+        start_task()
+
+def add_package(name, version, content_stream, md5_digest=None):
     """
         Adds a new package to the hosted package index.
         The package is described by name, version and content.
+        @return: a dictionary containing the "md5" and "sha256" hex digests of the content
+        @raise ValueError: if md5_digest is given and does not match the content
     """
     LOGGER.debug("Adding package '%s %s'", name, version)
-    _hosted_packages_index.add_package(name, version, content_stream)
+    return _hosted_packages_index.add_package(name, version, content_stream, md5_digest)
 
 def get_package_content(name, version):
     """
@@ -54,26 +179,124 @@ def get_package_content(name, version):
     LOGGER.debug("Package {0} is not hosted.".format(name))
     return _proxy_packages_index.get_package_content(name, version)
 
+def get_package_file(name, version):
+    """
+        Retrieves the file of the package identified by name and version without reading it.
+        @return: a PackageFile (path, size, mtime) or None
+    """
+    LOGGER.debug("Retrieving package file for '%s %s'", name, version)
+
+    package_file = _hosted_packages_index.get_package_file(name, version)
+    if package_file is not None:
+        LOGGER.debug("Package {0} is hosted.".format(name))
+        return package_file
+
+    LOGGER.debug("Package {0} is not hosted.".format(name))
+    return _proxy_packages_index.get_package_file(name, version)
+
+def open_package(name, version):
+    """
+        Retrieves the package identified by name and version for streaming it to a client.
+        @return: a PackageFile if the package is available locally, otherwise an iterable over the content of the
+            package that caches it on the way (see ProxyPackageIndex.open_package), or None
+    """
+    LOGGER.debug("Opening package '%s %s'", name, version)
+
+    package_file = _hosted_packages_index.get_package_file(name, version)
+    if package_file is not None:
+        LOGGER.debug("Package {0} is hosted.".format(name))
+        return package_file
+
+    LOGGER.debug("Package {0} is not hosted.".format(name))
+    return _proxy_packages_index.open_package(name, version)
+
+def forget_package_file(package_file):
+    """
+        Drops a package file that has been deleted behind the back of the indexes, e.g. by the eviction in another
+        process, so that a cached package is downloaded again instead of being looked up in the index.
+    """
+    _hosted_packages_index.file_removed(package_file.path)
+    _proxy_packages_index.file_removed(package_file.path)
+
+def get_proxy_packages_index():
+    """
+        @return: the ProxyPackageIndex caching the upstream packages, e.g. for warming up the cache
+    """
+    return _proxy_packages_index
+
 def get_package_statistics():
     """
         Used by the index page.
         @return: a tuple containing several statistics of the index:
             # of package files, # of unique package names
     """
-    LOGGER.debug("Calculating package statistics")
-    package_names = _hosted_packages_index.list_available_package_names()
-    number_of_unique_packages = len([p for p in package_names]) if package_names else 0
-    return _hosted_packages_index.count_packages(), number_of_unique_packages
+    LOGGER.debug("Reading package statistics")
+    statistics = _hosted_packages_index.get_statistics()
+    return statistics.files, statistics.names
+
+def get_index_statistics():
+    """
+        @return: a dictionary containing the PackageStatistics of the "hosted" and the "cached" index as
+            dictionaries of "files", "names" and "bytes"
+    """
+    LOGGER.debug("Reading index statistics")
+    return {"hosted": _hosted_packages_index.get_statistics()._asdict(),
+            "cached": _proxy_packages_index.get_statistics()._asdict()}
 
 def list_available_package_names():
     """
-        @return: sorted list of strings
+        Merges the sorted package names of both indexes, dropping names that are both hosted and cached.
+        If the generation of the package names is known in advance (see get_package_names_generation), the merged
+        names are remembered and returned without listing the indexes until the generation changes.
+        @return: iterator over the sorted package names
     """
     LOGGER.debug("Listing available packages")
+    generations = get_package_names_generation()
+    merged_names = _merged_package_names
+    if generations is not None and merged_names is not None and merged_names.generations == generations:
+        return iter(merged_names.names)
+
     cached_packages = _proxy_packages_index.list_available_package_names()
     hosted_packages = _hosted_packages_index.list_available_package_names()
+    return _merge_package_names(generations, cached_packages, hosted_packages)
+
+def get_package_names_generation():
+    """
+        @return: a value that changes whenever the listed package names may have changed, or None if the upstream
+            package names are only known after listing them
+    """
+    if not _proxy_packages_index.refreshes_index_in_background:
+        return None
+    return _proxy_packages_index.generation, _hosted_packages_index.generation
+
+def get_package_names_digest():
+    """
+        Unlike the generation, which counts changes in this process, the digest only depends on the listed package
+        names, so that it is the same in every process serving the same names; it is computed once per generation.
+        @return: the hex digest of the listed package names, or None if the upstream package names are only known
+            after listing them
+    """
+    generations = get_package_names_generation()
+    if generations is None:
+        return None
+    merged_names = _merged_package_names
+    if merged_names is None or merged_names.generations != generations:
+        for _ in list_available_package_names():
+            pass
+        merged_names = _merged_package_names
+    return merged_names.digest
 
-    return sorted(list(cached_packages) + list(hosted_packages))
+def _merge_package_names(generations, *sorted_package_names):
+    global _merged_package_names
+    package_names = []
+    digest = hashlib.md5()
+    for name in heapq.merge(*sorted_package_names):
+        if not package_names or package_names[-1] != name:
+            package_names.append(name)
+            digest.update(name.encode("utf8") if isinstance(name, unicode) else name)
+            digest.update("\n")
+            yield name
+    _merged_package_names = _MergedPackageNames(generations, package_names, digest.hexdigest())
 
 def list_versions(name):
     """
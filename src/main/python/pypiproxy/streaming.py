@@ -0,0 +1,271 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import logging
+import re
+import threading
+
+LOGGER = logging.getLogger("pypiproxy.streaming")
+
+CHUNK_SIZE = 64 * 1024
+
+_RUNNING = "running"
+_COMMITTED = "committed"
+_FAILED = "failed"
+
+_BYTE_RANGE_PATTERN = re.compile(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+class UnsatisfiableRange(Exception):
+    pass
+
+
+def parse_range(range_header, size):
+    """
+        Parses a HTTP Range header for a single byte range of a file with the given size.
+        @return: a tuple (first byte, last byte) or None if the whole file is to be sent
+        @raise UnsatisfiableRange: if the range does not overlap the file
+    """
+    if not range_header:
+        return None
+    match = _BYTE_RANGE_PATTERN.match(range_header)
+    if match is None:
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        suffix_length = int(last)
+        if suffix_length == 0 or size == 0:
+            raise UnsatisfiableRange()
+        return max(0, size - suffix_length), size - 1
+
+    first = int(first)
+    if first >= size:
+        raise UnsatisfiableRange()
+    if not last:
+        return first, size - 1
+    last = int(last)
+    if first > last:
+        return None
+    return first, min(last, size - 1)
+
+
+def iterate_segments(stream, separator, chunk_size=CHUNK_SIZE):
+    """
+        Reads the stream chunk by chunk and yields the segments between the separators, without the separators.
+        Only the current chunk and the incomplete segment at its end are kept in memory.
+    """
+    remainder = ""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        segments = (remainder + chunk).split(separator)
+        remainder = segments.pop()
+        for segment in segments:
+            yield segment
+    if remainder:
+        yield remainder
+
+
+class CountingReader(object):
+    """
+    Counts the bytes read from a stream.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.count = 0
+
+    def read(self, size):
+        data = self._stream.read(size)
+        self.count += len(data)
+        return data
+
+
+class FileRangeIterator(object):
+    """
+    Iterates over the bytes first to last (inclusive) of an open file in chunks and closes it when done.
+    """
+
+    def __init__(self, file_object, first, last, chunk_size=CHUNK_SIZE):
+        self._file = file_object
+        self._remaining = last - first + 1
+        self._chunk_size = chunk_size
+        self._file.seek(first)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._remaining <= 0:
+            self.close()
+            raise StopIteration()
+        chunk = self._file.read(min(self._chunk_size, self._remaining))
+        if not chunk:
+            self.close()
+            raise StopIteration()
+        self._remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self._file.close()
+
+
+class CachingDownload(object):
+    """
+    Iterates over the content of an upstream response in chunks while writing it to a package writer.
+    The package is committed once the response has been read completely and its length matches the announced
+    content length; an incomplete or failed download is discarded.
+
+    Concurrent requests for the same package can follow the download: they read the partially written file and
+    wait for more content as long as the download is running. If the request iterating over the download ends
+    before the download is complete, e.g. because its client disconnected, the download is completed in a
+    background thread, so that the package is cached and the following requests get the whole content.
+    """
+
+    def __init__(self, stream, package_writer, size=None, chunk_size=CHUNK_SIZE, on_done=None):
+        self._stream = stream
+        self._package_writer = package_writer
+        self._size = size
+        self._chunk_size = chunk_size
+        self._on_done = on_done
+        self._condition = threading.Condition()
+        self._state = _RUNNING
+
+    @property
+    def size(self):
+        return self._size
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._state != _RUNNING:
+            raise StopIteration()
+        try:
+            chunk = self._stream.read(self._chunk_size)
+            if chunk:
+                with self._condition:
+                    self._package_writer.write(chunk)
+                    self._package_writer.flush()
+                    self._condition.notify_all()
+                return chunk
+            self._finish()
+        except:
+            self._abort()
+            raise
+        raise StopIteration()
+
+    def close(self):
+        if self._state == _RUNNING:
+            LOGGER.info("Completing download in the background after {0} bytes".format(self._package_writer.size))
+            completing_thread = threading.Thread(target=self._complete, name="complete-download")
+            completing_thread.daemon = True
+            completing_thread.start()
+
+    def follow(self):
+        """
+            @return: an iterator over the complete content that waits for the download to make progress, or None
+                if the download has already been committed
+            @raise IOError: if the download failed
+        """
+        with self._condition:
+            if self._state == _COMMITTED:
+                return None
+            if self._state == _FAILED:
+                raise IOError("Download failed")
+            return _FollowingDownload(self, open(self._package_writer.temporary_filename, "rb"))
+
+    def wait(self):
+        """
+            Waits for the download to end.
+            @return: True if the package has been committed
+        """
+        with self._condition:
+            while self._state == _RUNNING:
+                self._condition.wait()
+            return self._state == _COMMITTED
+
+    def _wait_for_content_after(self, position):
+        with self._condition:
+            while self._state == _RUNNING and self._package_writer.size <= position:
+                self._condition.wait()
+            if self._state == _FAILED:
+                raise IOError("Download failed")
+            return self._package_writer.size - position
+
+    def _complete(self):
+        try:
+            for _ in self:
+                pass
+        except Exception as e:
+            LOGGER.warn("Could not complete download: {0}".format(e))
+
+    def _abort(self):
+        LOGGER.warn("Discarding download after {0} bytes".format(self._package_writer.size))
+        self._stream.close()
+        with self._condition:
+            self._package_writer.discard()
+            self._end(_FAILED)
+
+    def _finish(self):
+        self._stream.close()
+        if self._size is not None and self._package_writer.size != self._size:
+            raise IOError("Incomplete download: {0} of {1} bytes".format(self._package_writer.size, self._size))
+        with self._condition:
+            self._package_writer.commit()
+            self._end(_COMMITTED)
+
+    def _end(self, state):
+        self._state = state
+        self._condition.notify_all()
+        if self._on_done is not None:
+            self._on_done(self)
+
+
+class _FollowingDownload(object):
+    def __init__(self, download, file_object, chunk_size=CHUNK_SIZE):
+        self._download = download
+        self._file = file_object
+        self._chunk_size = chunk_size
+        self._position = 0
+
+    @property
+    def size(self):
+        return self._download.size
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            available = self._download._wait_for_content_after(self._position)
+        except:
+            self.close()
+            raise
+        if available <= 0:
+            self.close()
+            raise StopIteration()
+        chunk = self._file.read(min(available, self._chunk_size))
+        self._position += len(chunk)
+        return chunk
+
+    def close(self):
+        self._file.close()
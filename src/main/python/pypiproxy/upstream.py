@@ -0,0 +1,416 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import httplib
+import logging
+import socket
+import threading
+import time
+import urlparse
+
+from . import metrics
+
+LOGGER = logging.getLogger("pypiproxy.upstream")
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 10.0
+DEFAULT_READ_TIMEOUT_SECONDS = 60.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT_SECONDS = 30.0
+DEFAULT_LATENCY_SMOOTHING = 0.2
+DEFAULT_FAILURE_PENALTY_SECONDS = 10.0
+DEFAULT_PROBE_INTERVAL_SECONDS = 60.0
+
+_MAXIMUM_REDIRECTS = 5
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAXIMUM_DRAINED_BODY_SIZE = 64 * 1024
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class UpstreamError(IOError):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+def read_proxy_settings(environment):
+    """
+        Reads the proxies to use from the http_proxy and https_proxy variables of the given environment.
+        As before, proxies are only used if both variables are set.
+        @return: a dictionary mapping the schemes "http" and "https" to proxy urls, empty if no proxy is to be used
+    """
+    if "http_proxy" in environment and "https_proxy" in environment:
+        return {"http": environment["http_proxy"], "https": environment["https_proxy"]}
+    return {}
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to upstream after failure_threshold consecutive failures (the circuit opens). After
+    reset_timeout seconds a single trial request is let through (the circuit is half open); the circuit closes
+    again if it succeeds and opens again if it fails. The state is published as the metric
+    "upstream.circuit_state", followed by the name of the breaker if it has one.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT_SECONDS,
+                 name=None):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._state_metric = "upstream.circuit_state" if name is None else "upstream.circuit_state.{0}".format(name)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._set_state(CircuitBreaker.CLOSED)
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def is_open(self):
+        """
+            True if requests are rejected without a trial request.
+        """
+        with self._lock:
+            return self._state == CircuitBreaker.OPEN and time.time() - self._opened_at < self._reset_timeout
+
+    def allow_request(self):
+        with self._lock:
+            if self._state == CircuitBreaker.CLOSED:
+                return True
+            if self._state == CircuitBreaker.OPEN and time.time() - self._opened_at >= self._reset_timeout:
+                self._set_state(CircuitBreaker.HALF_OPEN)
+            if self._state == CircuitBreaker.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_running = False
+            if self._state != CircuitBreaker.CLOSED:
+                LOGGER.info("Upstream answers again, closing circuit")
+                self._set_state(CircuitBreaker.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == CircuitBreaker.HALF_OPEN or (self._state == CircuitBreaker.CLOSED and
+                                                           self._failures >= self._failure_threshold):
+                LOGGER.warn("Opening circuit after {0} failed upstream request(s)".format(self._failures))
+                metrics.increment("upstream.circuit_opened")
+                self._opened_at = time.time()
+                self._set_state(CircuitBreaker.OPEN)
+
+    def _set_state(self, state):
+        self._state = state
+        metrics.set_value(self._state_metric, state)
+
+
+class MirrorSelector(object):
+    """
+    Orders the urls of upstream mirrors for a request: mirrors the is_available function accepts come first,
+    ordered by the moving average of their response times, then the others. Mirrors without measurements count as
+    fastest, so that each mirror is tried; ties keep the configured order. A failed request counts as a response
+    time of failure_penalty seconds. The averages are published as the metrics "upstream.latency.<url>".
+
+    A mirror that has not been measured for probe_interval seconds, e.g. because a failure has demoted it, counts
+    as not measured again, so that the next request probes it and its average starts over from that response.
+    """
+
+    def __init__(self, urls, smoothing=DEFAULT_LATENCY_SMOOTHING, failure_penalty=DEFAULT_FAILURE_PENALTY_SECONDS,
+                 probe_interval=DEFAULT_PROBE_INTERVAL_SECONDS):
+        self._urls = [url.rstrip("/") for url in urls]
+        self._smoothing = smoothing
+        self._failure_penalty = failure_penalty
+        self._probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._measured_at = {}
+
+    @property
+    def urls(self):
+        return list(self._urls)
+
+    def get_latency(self, url):
+        """
+            @return: the moving average of the response times of the given mirror in seconds or None
+        """
+        with self._lock:
+            return self._latencies.get(url)
+
+    def rank(self, is_available=None):
+        with self._lock:
+            latencies = dict((url, self._latencies[url]) for url in self._latencies if not self._is_outdated(url))
+        available_urls = [url for url in self._urls if is_available is None or is_available(url)]
+        unavailable_urls = [url for url in self._urls if url not in available_urls]
+        return sorted(available_urls, key=lambda url: latencies.get(url, 0)) + unavailable_urls
+
+    def record_latency(self, url, seconds):
+        with self._lock:
+            latency = self._latencies.get(url)
+            if latency is None or self._is_outdated(url):
+                latency = seconds
+            else:
+                latency += self._smoothing * (seconds - latency)
+            self._latencies[url] = latency
+            self._measured_at[url] = time.time()
+        metrics.set_value("upstream.latency.{0}".format(url), latency)
+
+    def record_failure(self, url):
+        self.record_latency(url, self._failure_penalty)
+
+    def _is_outdated(self, url):
+        return time.time() - self._measured_at.get(url, 0) >= self._probe_interval
+
+
+class UpstreamClient(object):
+    """
+    HTTP client for the upstream pypi that keeps connections alive and reuses them.
+
+    Idle connections are pooled per scheme, host and port; at most pool_size idle connections are kept per host,
+    further connections are closed when their response has been read. Redirects are followed.
+
+    If create_circuit_breaker is given, it is called with the host and port of each upstream to create the circuit
+    breaker of that upstream. Requests that cannot be sent, time out or are answered with a server error count as
+    failures, and no request is sent to an upstream while its circuit is open.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout=DEFAULT_READ_TIMEOUT_SECONDS, proxies=None, create_circuit_breaker=None):
+        self._pool_size = pool_size
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._proxies = proxies or {}
+        self._create_circuit_breaker = create_circuit_breaker
+        self._circuit_breakers = {}
+        self._lock = threading.Lock()
+        self._idle_connections = {}
+
+    def is_available(self, url):
+        """
+            @return: False if the circuit of the upstream of the given url is open, so that a request is rejected
+        """
+        circuit_breaker = self._get_circuit_breaker(url)
+        return circuit_breaker is None or not circuit_breaker.is_open
+
+    def open(self, url, headers=None):
+        """
+            Sends a GET request for the given url.
+            @return: an UpstreamResponse of any status but a redirect; it has to be closed
+            @raise CircuitOpenError: if the circuit breaker does not let the request through
+            @raise UpstreamError: if the request could not be sent or no response was received
+        """
+        circuit_breaker = self._get_circuit_breaker(url)
+        if circuit_breaker is None:
+            return self._open(url, headers)
+
+        if not circuit_breaker.allow_request():
+            metrics.increment("upstream.rejected_requests")
+            raise CircuitOpenError("Not fetching {0}, circuit is open".format(url))
+        try:
+            response = self._open(url, headers)
+        except:
+            circuit_breaker.record_failure()
+            raise
+        if response.status >= httplib.INTERNAL_SERVER_ERROR:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+            response.add_failure_listener(circuit_breaker.record_failure)
+        return response
+
+    def _get_circuit_breaker(self, url):
+        if self._create_circuit_breaker is None:
+            return None
+        host = urlparse.urlsplit(url).netloc
+        with self._lock:
+            circuit_breaker = self._circuit_breakers.get(host)
+            if circuit_breaker is None:
+                circuit_breaker = self._circuit_breakers[host] = self._create_circuit_breaker(host)
+            return circuit_breaker
+
+    def _open(self, url, headers):
+        for _ in range(_MAXIMUM_REDIRECTS + 1):
+            response = self._request(url, headers or {})
+            if response.status not in _REDIRECT_STATUSES:
+                return response
+
+            location = response.getheader("Location")
+            response.close()
+            if not location:
+                raise UpstreamError("Redirect without location from {0}".format(url))
+            url = urlparse.urljoin(url, location)
+        raise UpstreamError("Too many redirects for {0}".format(url))
+
+    def close(self):
+        with self._lock:
+            idle_connections, self._idle_connections = self._idle_connections, {}
+        for connections in idle_connections.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, url, headers):
+        parsed_url = urlparse.urlsplit(url)
+        if parsed_url.scheme not in _DEFAULT_PORTS or not parsed_url.hostname:
+            raise UpstreamError("Unsupported url {0}".format(url))
+
+        key = (parsed_url.scheme, parsed_url.hostname, parsed_url.port or _DEFAULT_PORTS[parsed_url.scheme])
+        if parsed_url.scheme == "http" and "http" in self._proxies:
+            target = urlparse.urlunsplit(parsed_url[:4] + ("",))
+        else:
+            target = urlparse.urlunsplit(("", "", parsed_url.path or "/", parsed_url.query, ""))
+        request_headers = dict(headers)
+        request_headers["Accept-Encoding"] = "identity"
+
+        metrics.increment("upstream.requests")
+        connection, reused = self._acquire_connection(key)
+        try:
+            return self._send(key, connection, target, request_headers, url)
+        except (socket.error, httplib.HTTPException) as e:
+            connection.close()
+            if not reused:
+                raise UpstreamError("Could not fetch {0}: {1}".format(url, e))
+            LOGGER.debug("Reused connection failed for {0} ({1}), retrying on a new connection".format(url, e))
+
+        connection = self._open_connection(key)
+        try:
+            return self._send(key, connection, target, request_headers, url)
+        except (socket.error, httplib.HTTPException) as e:
+            connection.close()
+            raise UpstreamError("Could not fetch {0}: {1}".format(url, e))
+
+    def _send(self, key, connection, target, headers, url):
+        if connection.sock is None:
+            connection.connect()
+            connection.sock.settimeout(self._read_timeout)
+        connection.request("GET", target, headers=headers)
+        return UpstreamResponse(self, key, connection, connection.getresponse(), url)
+
+    def _acquire_connection(self, key):
+        with self._lock:
+            idle_connections = self._idle_connections.get(key)
+            connection = idle_connections.pop() if idle_connections else None
+        if connection is not None:
+            metrics.increment("upstream.connections_reused")
+            return connection, True
+        return self._open_connection(key), False
+
+    def _release_connection(self, key, connection):
+        with self._lock:
+            idle_connections = self._idle_connections.setdefault(key, [])
+            if len(idle_connections) < self._pool_size:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def _open_connection(self, key):
+        scheme, host, port = key
+        proxy = self._proxies.get(scheme)
+        metrics.increment("upstream.connections_opened")
+
+        if proxy is None:
+            connection_class = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+            return connection_class(host, port, timeout=self._connect_timeout)
+
+        proxy_host, proxy_port = _split_proxy_url(proxy)
+        if scheme == "https":
+            connection = httplib.HTTPSConnection(proxy_host, proxy_port, timeout=self._connect_timeout)
+            connection.set_tunnel(host, port)
+            return connection
+        return httplib.HTTPConnection(proxy_host, proxy_port, timeout=self._connect_timeout)
+
+
+class UpstreamResponse(object):
+    """
+    Response of the upstream client. The connection goes back to the pool when the response has been read
+    completely and closed.
+    """
+
+    def __init__(self, client, key, connection, response, url):
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._failure_listeners = []
+        self.url = url
+
+    @property
+    def status(self):
+        return self._response.status
+
+    def info(self):
+        return self._response.msg
+
+    def getheader(self, name, default_value=None):
+        return self._response.getheader(name, default_value)
+
+    def add_failure_listener(self, listener):
+        """
+            The listener is called without arguments when reading the body fails, e.g. to count the failure like
+            a failed request.
+        """
+        self._failure_listeners.append(listener)
+
+    def read(self, amount=None):
+        try:
+            if amount is None:
+                return self._response.read()
+            return self._response.read(amount)
+        except (socket.error, httplib.HTTPException) as e:
+            self._discard_connection()
+            for listener in self._failure_listeners:
+                listener()
+            raise UpstreamError("Could not read {0}: {1}".format(self.url, e))
+
+    def close(self):
+        if self._connection is None:
+            return
+        if not self._response.isclosed() and self._response.length is not None \
+                and self._response.length <= _MAXIMUM_DRAINED_BODY_SIZE:
+            try:
+                self._response.read()
+            except (socket.error, httplib.HTTPException):
+                pass
+
+        if self._response.isclosed() and not self._response.will_close:
+            self._client._release_connection(self._key, self._connection)
+            self._connection = None
+        else:
+            self._discard_connection()
+
+    def _discard_connection(self):
+        if self._connection is not None:
+            self._response.close()
+            self._connection.close()
+            self._connection = None
+
+
+def _split_proxy_url(proxy_url):
+    if "://" not in proxy_url:
+        proxy_url = "http://" + proxy_url
+    parsed_url = urlparse.urlsplit(proxy_url)
+    return parsed_url.hostname, parsed_url.port or _DEFAULT_PORTS.get(parsed_url.scheme, 80)
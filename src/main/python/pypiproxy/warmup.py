@@ -0,0 +1,159 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Warming up the cache: downloads the packages of requirements files into the cached package index before the
+    first clients ask for them.
+"""
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import collections
+import logging
+import os
+import re
+import time
+from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
+
+LOGGER = logging.getLogger("pypiproxy.warmup")
+
+DEFAULT_WORKERS = 4
+
+DOWNLOADED = "downloaded"
+CACHED = "cached"
+FAILED = "failed"
+
+_COMMENT_PATTERN = re.compile(r"(^|\s)#.*$")
+_OPTION_PATTERN = re.compile(r"\s--?\w.*$")
+_INCLUDE_PATTERN = re.compile(r"^\s*(?:-r|--requirement)[\s=]+(\S+)")
+_REQUIREMENT_PATTERN = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*(?:==\s*([^\s;,]+))?\s*(?:;.*)?$")
+
+WarmUpResult = collections.namedtuple("WarmUpResult", ["name", "version", "state", "size"])
+WarmUpReport = collections.namedtuple("WarmUpReport", ["downloaded", "cached", "failed", "bytes", "seconds"])
+
+
+def parse_requirements(lines):
+    """
+        Reads pinned requirements (name==version) and bare package names, e.g. from the lines of a requirements
+        file. Comments, options and requirements with other version specifiers are skipped.
+        @return: iterator over tuples (name, version); the version is None for a bare package name
+    """
+    for line in lines:
+        line = _OPTION_PATTERN.sub("", _COMMENT_PATTERN.sub("", line)).strip()
+        if not line or line.startswith("-"):
+            continue
+        match = _REQUIREMENT_PATTERN.match(line)
+        if match is None:
+            LOGGER.warn("Skipping requirement '{0}', only pinned versions and package names are supported".format(line))
+            continue
+        yield match.group(1), match.group(2)
+
+
+def read_requirements_file(filename):
+    """
+        Reads the requirements of a requirements file, following -r includes relative to the file.
+        @return: a list of tuples (name, version), see parse_requirements
+    """
+    with open(filename) as requirements_file:
+        lines = requirements_file.readlines()
+
+    requirements = []
+    for line in lines:
+        include = _INCLUDE_PATTERN.match(line)
+        if include is not None:
+            requirements.extend(read_requirements_file(os.path.join(os.path.dirname(filename), include.group(1))))
+    requirements.extend(parse_requirements(lines))
+    return requirements
+
+
+def format_report(report):
+    seconds = max(report.seconds, 0.001)
+    megabytes = report.bytes / 1024.0 / 1024.0
+    return ("Downloaded {0} package(s), {1:.1f} MB in {2:.1f} s ({3:.2f} MB/s, {4:.1f} packages/s); "
+            "{5} already cached, {6} failed").format(report.downloaded, megabytes, report.seconds,
+                                                     megabytes / seconds, report.downloaded / seconds,
+                                                     report.cached, report.failed)
+
+
+class WarmUp(object):
+    """
+    Downloads packages into a proxy package index with a pool of workers threads. Packages that are already cached
+    are skipped, so an interrupted warm-up resumes where it stopped when it is run again. Bare package names are
+    resolved to the latest version upstream lists.
+
+    Packages are committed to the cache directory atomically, so the warm-up can run while the server is serving
+    from the same directory.
+    """
+
+    def __init__(self, proxy_package_index, workers=DEFAULT_WORKERS):
+        self._proxy_package_index = proxy_package_index
+        self._workers = workers
+
+    def run(self, requirements, on_result=None):
+        """
+            Warms up the cache for the given tuples (name, version). on_result is called with the WarmUpResult of
+            each package as soon as it is done.
+            @return: a WarmUpReport
+        """
+        requirements = list(collections.OrderedDict.fromkeys(requirements))
+        LOGGER.info("Warming up cache for {0} package(s) with {1} worker(s)".format(len(requirements),
+                                                                                   self._workers))
+        counts = collections.Counter()
+        total_bytes = 0
+        started_at = time.time()
+
+        pool = ThreadPool(self._workers)
+        try:
+            for result in pool.imap_unordered(self._warm_up_package, requirements):
+                counts[result.state] += 1
+                total_bytes += result.size
+                if on_result is not None:
+                    on_result(result)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        report = WarmUpReport(counts[DOWNLOADED], counts[CACHED], counts[FAILED], total_bytes,
+                              time.time() - started_at)
+        LOGGER.info(format_report(report))
+        return report
+
+    def _warm_up_package(self, requirement):
+        name, version = requirement
+        try:
+            if version is None:
+                version = self._resolve_latest_version(name)
+                if version is None:
+                    LOGGER.warn("Could not find any version of {0}".format(name))
+                    return WarmUpResult(name, None, FAILED, 0)
+
+            if self._proxy_package_index.contains(name, version):
+                return WarmUpResult(name, version, CACHED, 0)
+
+            package_file = self._proxy_package_index.get_package_file(name, version)
+            if package_file is None:
+                LOGGER.warn("Could not download package {0} in version {1}".format(name, version))
+                return WarmUpResult(name, version, FAILED, 0)
+            return WarmUpResult(name, version, DOWNLOADED, package_file.size)
+        except Exception as e:
+            LOGGER.exception("Failed to warm up package {0} in version {1}: {2}".format(name, version, e))
+            return WarmUpResult(name, version, FAILED, 0)
+
+    def _resolve_latest_version(self, name):
+        versions = self._proxy_package_index.list_versions(name)
+        if not versions:
+            return None
+        return max(versions, key=LooseVersion)
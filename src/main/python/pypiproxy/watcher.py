@@ -0,0 +1,251 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+
+LOGGER = logging.getLogger("pypiproxy.watcher")
+
+DEFAULT_POLLING_INTERVAL_SECONDS = 2.0
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+_EVENT_HEADER = struct.Struct("iIII")
+_READ_BUFFER_SIZE = 64 * 1024
+_SELECT_TIMEOUT_SECONDS = 1.0
+
+
+def create_watcher(directory, handler, polling_interval=DEFAULT_POLLING_INTERVAL_SECONDS):
+    """
+        Creates a watcher for the given directory and all directories below it, using inotify if the platform
+        supports it and falling back to polling the modification times of the directories otherwise, or when not
+        all directories can be watched, e.g. because the inotify watches of the user are exhausted.
+
+        The handler is notified through file_added(path), file_removed(path) and directory_changed(directory).
+        The latter is called when individual events are not available (polling, new or removed subdirectories)
+        and with None when the whole tree has to be synchronized (event queue overflow).
+    """
+    try:
+        return InotifyWatcher(directory, handler, polling_interval)
+    except OSError as e:
+        LOGGER.info("inotify not available for '%s' (%s), falling back to polling every %s seconds",
+                    directory, e, polling_interval)
+        return PollingWatcher(directory, handler, polling_interval)
+
+
+class _Watcher(object):
+    def __init__(self, directory, handler):
+        self._directory = directory
+        self._handler = handler
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="watcher-{0}".format(self._directory))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _notify(self, method_name, *arguments):
+        try:
+            getattr(self._handler, method_name)(*arguments)
+        except Exception as e:
+            LOGGER.exception("Failed to apply change in '{0}': {1}".format(self._directory, e))
+
+    def _run(self):
+        raise NotImplementedError()
+
+
+class PollingWatcher(_Watcher):
+    """
+    Checks the modification times of a directory tree periodically and reports each directory whose
+    modification time differs.
+    """
+
+    def __init__(self, directory, handler, interval=DEFAULT_POLLING_INTERVAL_SECONDS):
+        super(PollingWatcher, self).__init__(directory, handler)
+        self._interval = interval
+        self._last_mtimes = self._read_mtimes()
+
+    def check(self):
+        mtimes = self._read_mtimes()
+        for directory, mtime in sorted(mtimes.items()):
+            if self._last_mtimes.get(directory) != mtime:
+                self._notify("directory_changed", directory)
+        self._last_mtimes = mtimes
+
+    def _read_mtimes(self):
+        mtimes = {}
+        for directory, _, _ in os.walk(self._directory):
+            try:
+                mtimes[directory] = os.stat(directory).st_mtime
+            except OSError:
+                pass
+        return mtimes
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.check()
+
+
+class InotifyWatcher(_Watcher):
+    """
+    Receives change events for a directory tree from the Linux kernel and reports them file by file.
+
+    Raises OSError if not all directories of the tree can be watched. If a directory created later cannot be
+    watched, the watcher switches to polling the whole tree every polling_interval seconds, after requesting a
+    synchronization of the whole tree.
+    """
+
+    _loaded_libc = None
+
+    def __init__(self, directory, handler, polling_interval=DEFAULT_POLLING_INTERVAL_SECONDS):
+        super(InotifyWatcher, self).__init__(directory, handler)
+        self._libc = InotifyWatcher._load_libc()
+        self._watched_directories = {}
+        self._polling_interval = polling_interval
+        self._polling_watcher = None
+
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise _os_error_from_errno()
+
+        try:
+            self._add_watch(directory)
+            self._add_watches_below(directory)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def stop(self):
+        super(InotifyWatcher, self).stop()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _run(self):
+        while self._polling_watcher is None and not self._stopped.is_set():
+            readable, _, _ = select.select([self._fd], [], [], _SELECT_TIMEOUT_SECONDS)
+            if readable:
+                self._dispatch(os.read(self._fd, _READ_BUFFER_SIZE))
+        while self._polling_watcher is not None and not self._stopped.wait(self._polling_interval):
+            self._polling_watcher.check()
+
+    def _add_watch(self, directory):
+        watch_descriptor = self._libc.inotify_add_watch(self._fd, directory, _WATCH_MASK)
+        if watch_descriptor < 0:
+            raise _os_error_from_errno()
+        self._watched_directories[watch_descriptor] = directory
+
+    def _add_watches_below(self, directory):
+        for parent_directory, subdirectories, _ in os.walk(directory):
+            for subdirectory in subdirectories:
+                try:
+                    self._add_watch(os.path.join(parent_directory, subdirectory))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise  # a directory removed in the meantime does not need to be watched
+
+    def _dispatch(self, buffer):
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buffer):
+            watch_descriptor, mask, _, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+
+            if self._polling_watcher is not None:
+                return
+            if mask & _IN_Q_OVERFLOW:
+                LOGGER.warn("inotify event queue overflowed for '%s'", self._directory)
+                self._notify("directory_changed", None)
+                continue
+            if mask & _IN_IGNORED:
+                self._watched_directories.pop(watch_descriptor, None)
+                continue
+
+            directory = self._watched_directories.get(watch_descriptor)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._watch_new_directory(path)
+                self._notify("directory_changed", directory)
+            elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                self._notify("file_added", path)
+            elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                self._notify("file_removed", path)
+
+    def _watch_new_directory(self, directory):
+        try:
+            self._add_watch(directory)
+            self._add_watches_below(directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self._fall_back_to_polling(directory, e)
+
+    def _fall_back_to_polling(self, directory, error):
+        LOGGER.warn("Could not watch directory '{0}' ({1}), falling back to polling '{2}' every {3} seconds".format(
+            directory, error, self._directory, self._polling_interval))
+        self._polling_watcher = PollingWatcher(self._directory, self._handler, self._polling_interval)
+        os.close(self._fd)
+        self._fd = None
+        self._notify("directory_changed", None)
+
+    @classmethod
+    def _load_libc(cls):
+        if cls._loaded_libc is None:
+            library_name = ctypes.util.find_library("c")
+            if library_name is None:
+                raise OSError(errno.ENOSYS, "libc not found")
+            libc = ctypes.CDLL(library_name, use_errno=True)
+            if not hasattr(libc, "inotify_init") or not hasattr(libc, "inotify_add_watch"):
+                raise OSError(errno.ENOSYS, "inotify is not supported")
+            cls._loaded_libc = libc
+        return cls._loaded_libc
+
+
+def _os_error_from_errno():
+    error_number = ctypes.get_errno()
+    return OSError(error_number, os.strerror(error_number))
@@ -15,25 +15,65 @@
 
 __author__ = "Michael Gruber, Alexander Metzner"
 
+import errno
+import hashlib
+import json
 import logging
-import StringIO
+import os
+from datetime import datetime
 
-from flask import Flask, request, render_template, abort, make_response
+from flask import Flask, Response, request, render_template, abort
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.wsgi import wrap_file
 
 from . import __version__ as pypiproxy_version
-from .services import (list_available_package_names, list_versions, get_package_content, add_package,
-                       get_package_statistics)
+from . import metrics
+from .compression import CompressedPages
+from .packageindex import PackageFile
+from .services import (list_available_package_names, list_versions, open_package, add_package, forget_package_file,
+                       get_package_statistics, get_index_statistics, get_package_names_digest)
+from .streaming import CHUNK_SIZE, FileRangeIterator, UnsatisfiableRange, parse_range
 
 
 LOGGER = logging.getLogger("pypiproxy.webapp")
 
+PACKAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+SIMPLE_PAGE_CACHE_CONTROL = "public, max-age=60"
+
 application = Flask(__name__)
 
+_compressed_pages = CompressedPages()
+
 def render_application_template(template_name, **template_parameters):
     template_parameters["version"] = pypiproxy_version
     return render_template(template_name, **template_parameters)
 
 
+def stream_application_template(template_name, **template_parameters):
+    """
+        Renders the template while the response is sent, so that a large page is never held in memory as a whole.
+        The rendered fragments are sent in chunks of about CHUNK_SIZE bytes.
+    """
+    template_parameters["version"] = pypiproxy_version
+    application.update_template_context(template_parameters)
+    template = application.jinja_env.get_template(template_name)
+    return Response(_join_fragments(template.generate(**template_parameters)), 200,
+                    {"Content-Type": "text/html; charset=utf-8"})
+
+
+def _join_fragments(fragments, chunk_size=CHUNK_SIZE):
+    chunk, length = [], 0
+    for fragment in fragments:
+        fragment = fragment.encode("utf8")
+        chunk.append(fragment)
+        length += len(fragment)
+        if length >= chunk_size:
+            yield "".join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
 @application.route("/")
 def handle_index():
     LOGGER.debug("Handling request for index")
@@ -42,18 +82,104 @@ def handle_index():
     return render_application_template("index.html", **locals())
 
 
-@application.route("/package/<package_name>/<version>/<file_name>")
+@application.route("/metrics")
+def handle_metrics():
+    LOGGER.debug("Handling request for metrics")
+
+    return Response(json.dumps(metrics.snapshot(), sort_keys=True), 200, {"Content-Type": "application/json"})
+
+
+@application.route("/stats")
+def handle_stats():
+    LOGGER.debug("Handling request for statistics")
+
+    return Response(json.dumps(get_index_statistics(), sort_keys=True), 200, {"Content-Type": "application/json"})
+
+
+@application.route("/package/<package_name>/<version>/<file_name>", methods=["GET", "HEAD"])
 def handle_package_content(package_name, version, file_name):
     LOGGER.debug("Handling request to download package %s", file_name)
 
-    content = get_package_content(package_name, version)
-    if content is None:
+    package = _open_package(package_name, version)
+    headers = {"Content-Disposition": "attachment; filename={0}".format(file_name),
+               "Content-Type": "application/x-gzip"}
+    if isinstance(package, PackageFile):
+        response = _package_file_response(package, dict(headers))
+        if response is not None:
+            return response
+        LOGGER.info("Package file {0} has been deleted, opening package {1} in version {2} again".format(
+            package.path, package_name, version))
+        forget_package_file(package)
+        package = _open_package(package_name, version)
+        if isinstance(package, PackageFile):
+            return _package_file_response(package, headers) or abort(404)
+
+    headers["Cache-Control"] = PACKAGE_CACHE_CONTROL
+    if package.size is not None:
+        headers["Content-Length"] = str(package.size)
+    if request.method == "HEAD":
+        package.close()  # a download is completed in the background and fills the cache
+        return Response([], 200, headers, direct_passthrough=True)
+    return Response(package, 200, headers, direct_passthrough=True)
+
+
+def _open_package(package_name, version):
+    package = open_package(package_name, version)
+    if package is None:
         abort(404)
+    return package
 
-    response = make_response(content)
-    response.headers["Content-Disposition"] = "attachment; filename={0}".format(file_name)
-    response.headers["Content-Type"] = "application/x-gzip"
-    return response
+
+def _package_file_response(package_file, headers):
+    """
+        @return: the response sending the package file, or None if the file has been deleted since it was indexed,
+            e.g. by the eviction in another process
+    """
+    last_modified = datetime.utcfromtimestamp(int(package_file.mtime))
+    validators = {"Cache-Control": PACKAGE_CACHE_CONTROL,
+                  "ETag": '"{0:x}-{1:x}"'.format(package_file.size, int(package_file.mtime)),
+                  "Last-Modified": http_date(last_modified)}
+    if not is_resource_modified(request.environ, validators["ETag"], last_modified=last_modified):
+        return Response("", 304, validators)
+    headers.update(validators)
+
+    try:
+        if request.method == "HEAD":
+            package_stream = None
+            size = os.stat(package_file.path).st_size
+        else:
+            package_stream = open(package_file.path, "rb")
+            size = os.fstat(package_stream.fileno()).st_size
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            return None
+        LOGGER.warn("Could not open package file {0}: {1}".format(package_file.path, e))
+        abort(404)
+
+    headers["Accept-Ranges"] = "bytes"
+    try:
+        byte_range = parse_range(request.headers.get("Range"), size)
+    except UnsatisfiableRange:
+        if package_stream is not None:
+            package_stream.close()
+        headers["Content-Range"] = "bytes */{0}".format(size)
+        return Response("", 416, headers)
+
+    if byte_range is None:
+        status, first, last = 200, 0, size - 1
+    else:
+        status, (first, last) = 206, byte_range
+        headers["Content-Range"] = "bytes {0}-{1}/{2}".format(first, last, size)
+    headers["Content-Length"] = str(last - first + 1)
+
+    if package_stream is None:
+        body = []
+    elif byte_range is None:
+        body = wrap_file(request.environ, package_stream, CHUNK_SIZE)
+    else:
+        body = FileRangeIterator(package_stream, first, last)
+
+    return Response(body, status, headers, direct_passthrough=True)
 
 
 @application.route("/simple/<package_name>")
@@ -66,9 +192,9 @@ def handle_version_list(package_name):
     if not len(version_list):
         return "", 404
 
-    return render_application_template("version-list.html",
-        package_name=package_name,
-        versions_list=version_list)
+    etag = _simple_page_etag("version-list.html", package_name, version_list)
+    return _simple_page_response("version-list.html", package_name, etag,
+                                 lambda: {"package_name": package_name, "versions_list": version_list})
 
 
 @application.route("/simple")
@@ -76,7 +202,51 @@ def handle_version_list(package_name):
 def handle_package_list():
     LOGGER.debug("Handling request to list all packages")
 
-    return render_application_template("package-list.html", package_name_list=list_available_package_names())
+    digest = get_package_names_digest()
+    etag = _simple_page_etag("package-list.html", digest) if digest is not None else None
+    return _simple_page_response("package-list.html", None, etag,
+                                 lambda: {"package_name_list": list_available_package_names()})
+
+
+def _simple_page_etag(*content):
+    """
+        Derives the entity tag of a simple page from what the page is rendered from and the version of pypiproxy,
+        which determines the templates.
+    """
+    return '"{0}"'.format(hashlib.md5(repr((pypiproxy_version,) + content)).hexdigest())
+
+
+def _simple_page_response(template_name, key, etag, get_template_parameters):
+    """
+        Sends a simple page, or 304 if the client has it already. A page with an entity tag is sent compressed if
+        the client accepts a compressed encoding; it is compressed once per entity tag. Pages without an entity
+        tag are streamed uncompressed. get_template_parameters is only called if the page has to be rendered.
+    """
+    headers = {"Cache-Control": SIMPLE_PAGE_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    encoding = None
+    if etag is not None:
+        encoding = request.accept_encodings.best_match(_compressed_pages.encodings)
+        headers["ETag"] = _encoded_etag(etag, encoding)
+        if not is_resource_modified(request.environ, headers["ETag"]):
+            return Response("", 304, headers)
+
+    if encoding is None:
+        response = stream_application_template(template_name, **get_template_parameters())
+        response.headers.extend(headers)
+        return response
+
+    content = _compressed_pages.get(
+        (template_name, key), etag, encoding,
+        lambda: render_application_template(template_name, **get_template_parameters()).encode("utf8"))
+    headers.update({"Content-Type": "text/html; charset=utf-8", "Content-Encoding": encoding,
+                    "Content-Length": str(len(content))})
+    return Response(content, 200, headers)
+
+
+def _encoded_etag(etag, encoding):
+    if encoding is None:
+        return etag
+    return '{0}-{1}"'.format(etag[:-1], encoding)
 
 
 @application.route("/", methods=["POST"])
@@ -94,8 +264,9 @@ def handle_upload_package():
     # TODO: Validate content type
 
     content = request.files["content"]
-    content_buffer = StringIO.StringIO()
-    content.save(content_buffer)
-
-    add_package(name, version, content_buffer.getvalue())
+    try:
+        add_package(name, version, content.stream, request.form.get("md5_digest") or None)
+    except ValueError as e:
+        LOGGER.warn("Rejecting upload of package {0} in version {1}: {2}".format(name, version, e))
+        abort(400)
     return ""
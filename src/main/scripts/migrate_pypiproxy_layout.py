@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+
+import sys
+
+from pypiproxy.configuration import Configuration
+from pypiproxy.packageindex import migrate_to_sharded_layout
+
+config_file = sys.argv[1] if len(sys.argv) > 1 else "/etc/pypiproxy/pypiproxy.cfg"
+configuration = Configuration(config_file)
+
+for directory in (configuration.hosted_packages_directory, configuration.cached_packages_directory):
+    print("Moved {0} file(s) in {1}".format(migrate_to_sharded_layout(directory), directory))
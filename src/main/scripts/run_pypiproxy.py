@@ -1,8 +1,20 @@
 #!/usr/bin/env python
 
 import socket
+
+from pypiproxy.configuration import Configuration
+from pypiproxy import server
+
+CONFIG_FILE = "/etc/pypiproxy/pypiproxy.cfg"
+
+configuration = Configuration(CONFIG_FILE)
+server.prepare(configuration.server_mode)
+
 from pypiproxy.webapp import application
-from pypiproxy import initialize
+from pypiproxy import initialize, services
 
-initialize("/etc/pypiproxy/pypiproxy.cfg")
-application.run(host=socket.getfqdn())
+initialize(CONFIG_FILE, defer_background_tasks=True)
+server.run_prefork(application, configuration.server_mode, configuration.server_host or socket.getfqdn(),
+                   configuration.server_port, configuration.server_workers, backlog=configuration.server_backlog,
+                   timeout=configuration.server_timeout, graceful_timeout=configuration.server_graceful_timeout,
+                   on_worker_start=services.start_background_tasks)
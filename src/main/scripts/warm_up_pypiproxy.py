@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+from pypiproxy import initialize, services
+from pypiproxy.warmup import DEFAULT_WORKERS, WarmUp, format_report, parse_requirements, read_requirements_file
+
+parser = argparse.ArgumentParser(description="Downloads packages missing in the cache of pypiproxy. Already "
+                                             "cached packages are skipped, so an interrupted run can be repeated.")
+parser.add_argument("-c", "--config", default="/etc/pypiproxy/pypiproxy.cfg", help="configuration file")
+parser.add_argument("-r", "--requirement", action="append", default=[], metavar="FILE",
+                    help="requirements file with name==version pins, may be given several times")
+parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help="number of parallel downloads")
+parser.add_argument("packages", nargs="*", metavar="NAME==VERSION", help="package to download")
+arguments = parser.parse_args()
+
+requirements = list(parse_requirements(arguments.packages))
+for requirements_file in arguments.requirement:
+    requirements.extend(read_requirements_file(requirements_file))
+
+initialize(arguments.config, defer_background_tasks=True)
+warm_up = WarmUp(services.get_proxy_packages_index(), arguments.workers)
+
+
+def print_result(result):
+    print("{0:<10} {1} {2}".format(result.state, result.name, result.version or ""))
+    sys.stdout.flush()
+
+
+report = warm_up.run(requirements, print_result)
+print(format_report(report))
+sys.exit(1 if report.failed else 0)
@@ -0,0 +1,177 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import os
+import time
+
+from pyfix import test, given
+from pyfix.fixtures import TemporaryDirectoryFixture
+from pyassert import assert_that
+
+from pypiproxy import metrics
+from pypiproxy.cache import IndexSnapshot, NegativeCache, Validators, VersionCache
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def get_should_return_none_when_package_has_not_been_cached(temp_dir):
+    version_cache = VersionCache(temp_dir.join("versions"), 60)
+
+    assert_that(version_cache.get("spam")).is_none()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def get_should_not_remember_package_that_has_not_been_cached(temp_dir):
+    version_cache = VersionCache(temp_dir.join("versions"), 60)
+    version_cache.get("spam")
+
+    VersionCache(temp_dir.join("versions"), 60).put("spam", ["0.1.2"])
+
+    assert_that(version_cache.get("spam").versions).is_equal_to(["0.1.2"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def get_should_return_fresh_entry_after_put(temp_dir):
+    version_cache = VersionCache(temp_dir.join("versions"), 60)
+
+    version_cache.put("spam", ["0.1.2", "1.2.3"])
+    entry = version_cache.get("spam")
+
+    assert_that(entry.versions).is_equal_to(["0.1.2", "1.2.3"])
+    assert_that(version_cache.is_stale(entry)).is_false()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def put_should_persist_entry_for_new_cache_on_same_directory(temp_dir):
+    VersionCache(temp_dir.join("versions"), 60).put("Spam_Eggs", ["0.1.2"])
+
+    assert_that(temp_dir.join("versions", "s", "spam-eggs", "spam-eggs.json")).is_a_file()
+    entry = VersionCache(temp_dir.join("versions"), 60).get("Spam_Eggs")
+    assert_that(entry.versions).is_equal_to(["0.1.2"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def put_should_persist_validators_of_upstream_response(temp_dir):
+    VersionCache(temp_dir.join("versions"), 60).put("spam", ["0.1.2"], Validators('"abc"', None, 123))
+
+    entry = VersionCache(temp_dir.join("versions"), 60).get("spam")
+    assert_that(entry.validators).is_equal_to(Validators('"abc"', None, 123))
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def is_stale_should_return_true_when_entry_is_older_than_time_to_live(temp_dir):
+    version_cache = VersionCache(temp_dir.join("versions"), 60)
+
+    entry = version_cache.put("spam", ["0.1.2"])
+    entry.fetched_at = time.time() - 61
+
+    assert_that(version_cache.is_stale(entry)).is_true()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def get_should_ignore_unreadable_cache_file(temp_dir):
+    os.makedirs(temp_dir.join("versions", "s", "spam"))
+    with open(temp_dir.join("versions", "s", "spam", "spam.json"), "w") as cache_file:
+        cache_file.write("{not json")
+
+    assert_that(VersionCache(temp_dir.join("versions"), 60).get("spam")).is_none()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def index_snapshot_should_load_stored_names_and_validators(temp_dir):
+    IndexSnapshot(temp_dir.join("index.gz")).store([u"spam", u"eggs"], Validators(None, "yesterday", 42), 123.0)
+
+    names, validators, fetched_at = IndexSnapshot(temp_dir.join("index.gz")).load()
+
+    assert_that(names).is_equal_to([u"spam", u"eggs"])
+    assert_that(validators).is_equal_to(Validators(None, "yesterday", 42))
+    assert_that(fetched_at).is_equal_to(123.0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def index_snapshot_should_load_empty_index(temp_dir):
+    IndexSnapshot(temp_dir.join("index.gz")).store([], None, 123.0)
+
+    assert_that(IndexSnapshot(temp_dir.join("index.gz")).load()).is_equal_to(([], None, 123.0))
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def index_snapshot_should_ignore_unreadable_file(temp_dir):
+    temp_dir.create_file("index.gz", "spam")
+
+    assert_that(IndexSnapshot(temp_dir.join("index.gz")).load()).is_none()
+
+
+@test
+def negative_cache_should_contain_added_url_and_count_hits_and_misses():
+    metrics.reset()
+    negative_cache = NegativeCache()
+    negative_cache.add("spam", "http://pypi/simple/spam/")
+
+    assert_that(negative_cache.contains("http://pypi/simple/spam/")).is_true()
+    assert_that(negative_cache.contains("http://pypi/simple/eggs/")).is_false()
+    assert_that(metrics.get_value("negative_cache.hits")).is_equal_to(1)
+    assert_that(metrics.get_value("negative_cache.misses")).is_equal_to(1)
+
+
+@test
+def negative_cache_should_not_contain_expired_url():
+    negative_cache = NegativeCache(time_to_live=0)
+    negative_cache.add("spam", "http://pypi/simple/spam/")
+
+    assert_that(negative_cache.contains("http://pypi/simple/spam/")).is_false()
+    assert_that(len(negative_cache)).is_equal_to(0)
+
+
+@test
+def negative_cache_should_drop_oldest_url_when_maximum_is_exceeded():
+    negative_cache = NegativeCache(maximum_entries=2)
+    negative_cache.add("spam", "http://pypi/simple/spam/")
+    negative_cache.add("eggs", "http://pypi/simple/eggs/")
+    negative_cache.add("ham", "http://pypi/simple/ham/")
+
+    assert_that(len(negative_cache)).is_equal_to(2)
+    assert_that(negative_cache.contains("http://pypi/simple/spam/")).is_false()
+    assert_that(negative_cache.contains("http://pypi/simple/ham/")).is_true()
+
+
+@test
+def negative_cache_should_discard_all_urls_of_package():
+    negative_cache = NegativeCache()
+    negative_cache.add("Spam_Eggs", "http://pypi/simple/Spam_Eggs/")
+    negative_cache.add("spam-eggs", "http://pypi/packages/source/s/spam-eggs/spam-eggs-0.1.tar.gz")
+    negative_cache.add("ham", "http://pypi/simple/ham/")
+
+    negative_cache.discard("spam.eggs")
+
+    assert_that(len(negative_cache)).is_equal_to(1)
+    assert_that(negative_cache.contains("http://pypi/simple/ham/")).is_true()
+
+
+if __name__ == "__main__":
+    from pyfix import run_tests
+
+    run_tests()
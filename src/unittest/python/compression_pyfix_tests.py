@@ -0,0 +1,96 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import gzip
+from StringIO import StringIO
+
+from pyfix import test, run_tests
+from pyassert import assert_that
+
+from pypiproxy.compression import CompressedPages, gzip_compress
+
+
+class _Renderer(object):
+    def __init__(self, content):
+        self.content = content
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.content
+
+
+def _gunzip(content):
+    return gzip.GzipFile(fileobj=StringIO(content)).read()
+
+
+@test
+def gzip_compress_should_compress_content():
+    assert_that(_gunzip(gzip_compress("spam" * 100))).is_equal_to("spam" * 100)
+
+
+@test
+def encodings_should_contain_gzip():
+    assert_that(CompressedPages().encodings).contains("gzip")
+
+
+@test
+def get_should_return_compressed_page():
+    compressed_pages = CompressedPages()
+
+    content = compressed_pages.get("page", "1", "gzip", _Renderer("spam"))
+
+    assert_that(_gunzip(content)).is_equal_to("spam")
+
+
+@test
+def get_should_render_page_only_once_per_version():
+    compressed_pages = CompressedPages()
+    render = _Renderer("spam")
+
+    compressed_pages.get("page", "1", "gzip", render)
+    compressed_pages.get("page", "1", "gzip", render)
+
+    assert_that(render.calls).is_equal_to(1)
+
+
+@test
+def get_should_render_page_again_when_version_changes():
+    compressed_pages = CompressedPages()
+    compressed_pages.get("page", "1", "gzip", _Renderer("spam"))
+
+    content = compressed_pages.get("page", "2", "gzip", _Renderer("eggs"))
+
+    assert_that(_gunzip(content)).is_equal_to("eggs")
+
+
+@test
+def get_should_drop_least_recently_used_page_when_maximum_is_exceeded():
+    compressed_pages = CompressedPages(maximum_pages=2)
+    render = _Renderer("spam")
+    compressed_pages.get("spam", "1", "gzip", render)
+    compressed_pages.get("eggs", "1", "gzip", _Renderer("eggs"))
+    compressed_pages.get("spam", "1", "gzip", render)
+    compressed_pages.get("ham", "1", "gzip", _Renderer("ham"))
+
+    compressed_pages.get("spam", "1", "gzip", render)
+
+    assert_that(render.calls).is_equal_to(1)
+
+
+if __name__ == "__main__":
+    run_tests()
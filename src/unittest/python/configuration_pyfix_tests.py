@@ -15,6 +15,8 @@
 
 __author__ = "Alexander Metzner"
 
+import multiprocessing
+
 from pyfix import test, given
 from pyfix.fixtures import TemporaryDirectoryFixture
 from pyassert import assert_that
@@ -90,6 +92,28 @@ def should_return_given_pypi_url_when_pypi_url_option_is_given(temp_dir):
     assert_that(config.pypi_url).is_equal_to("spam.log")
 
 
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_pypi_urls_in_given_order_when_several_urls_are_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=http://spam\n    http://eggs http://ham\n{2}=0.2".format(
+            Configuration.SECTION, Configuration.OPTION_PYPI_URL, Configuration.OPTION_UPSTREAM_HEDGE_DELAY))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.pypi_urls).is_equal_to(["http://spam", "http://eggs", "http://ham"])
+    assert_that(config.upstream_hedge_delay).is_equal_to(0.2)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_default_pypi_url_as_only_pypi_url_when_no_pypi_url_option_is_given(temp_dir):
+    temp_dir.create_file("config.cfg", "[{0}]".format(Configuration.SECTION))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.pypi_urls).is_equal_to([Configuration.DEFAULT_PYPI_URL])
+    assert_that(config.upstream_hedge_delay).is_equal_to(0.5)
+
+
 @test
 @given(temp_dir=TemporaryDirectoryFixture)
 def should_raise_exception_when_no_hosted_packages_directory_option_is_given_and_directory_is_retrieved(temp_dir):
@@ -136,6 +160,258 @@ def should_return_given_cached_packages_directory_when_packages_directory_option
     assert_that(config.cached_packages_directory).is_equal_to("packages/cached")
 
 
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_not_watch_package_directories_when_no_watch_option_is_given(temp_dir):
+    temp_dir.create_file("config.cfg", "[{0}]".format(Configuration.SECTION))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.watch_package_directories).is_equal_to(False)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_watch_package_directories_when_watch_option_is_enabled(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=true\n{2}=0.5".format(Configuration.SECTION, Configuration.OPTION_WATCH_PACKAGE_DIRECTORIES,
+                                         Configuration.OPTION_WATCH_POLLING_INTERVAL))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.watch_package_directories).is_equal_to(True)
+    assert_that(config.watch_polling_interval).is_equal_to(0.5)
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_version_cache_directory_next_to_cached_packages_directory_when_no_option_is_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=packages/cached/".format(Configuration.SECTION, Configuration.OPTION_CACHED_PACKAGES_DIRECTORY))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.version_cache_directory).is_equal_to("packages/cached-versions")
+    assert_that(config.version_cache_time_to_live).is_equal_to(Configuration.DEFAULT_VERSION_CACHE_TIME_TO_LIVE)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_given_version_cache_options_when_options_are_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=versions\n{2}=30".format(Configuration.SECTION, Configuration.OPTION_VERSION_CACHE_DIRECTORY,
+                                             Configuration.OPTION_VERSION_CACHE_TIME_TO_LIVE))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.version_cache_directory).is_equal_to("versions")
+    assert_that(config.version_cache_time_to_live).is_equal_to(30.0)
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_given_upstream_options_when_options_are_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=4\n{2}=1.5\n{3}=30".format(Configuration.SECTION, Configuration.OPTION_UPSTREAM_POOL_SIZE,
+                                               Configuration.OPTION_UPSTREAM_CONNECT_TIMEOUT,
+                                               Configuration.OPTION_UPSTREAM_READ_TIMEOUT))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.upstream_pool_size).is_equal_to(4)
+    assert_that(config.upstream_connect_timeout).is_equal_to(1.5)
+    assert_that(config.upstream_read_timeout).is_equal_to(30.0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_not_refresh_upstream_index_in_background_when_no_option_is_given(temp_dir):
+    temp_dir.create_file("config.cfg", "[{0}]".format(Configuration.SECTION))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.upstream_index_refresh_interval).is_equal_to(0.0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_raise_exception_when_upstream_pool_size_is_not_an_integer(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=spam".format(Configuration.SECTION, Configuration.OPTION_UPSTREAM_POOL_SIZE))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+
+    def callback():
+        config.upstream_pool_size
+
+    assert_that(callback).raises(ValueError)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_not_export_when_no_static_export_directory_is_given(temp_dir):
+    temp_dir.create_file("config.cfg", "[{0}]\n".format(Configuration.SECTION))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.static_export_directory).is_none()
+    assert_that(config.static_export_interval).is_equal_to(Configuration.DEFAULT_STATIC_EXPORT_INTERVAL)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_given_static_export_options_when_options_are_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=export\n{2}=5".format(Configuration.SECTION, Configuration.OPTION_STATIC_EXPORT_DIRECTORY,
+                                           Configuration.OPTION_STATIC_EXPORT_INTERVAL))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.static_export_directory).is_equal_to("export")
+    assert_that(config.static_export_interval).is_equal_to(5.0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_flask_server_mode_when_no_option_is_given(temp_dir):
+    temp_dir.create_file("config.cfg", "[{0}]\n".format(Configuration.SECTION))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.server_mode).is_equal_to("flask")
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_given_server_mode_when_option_is_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=gevent".format(Configuration.SECTION, Configuration.OPTION_SERVER_MODE))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.server_mode).is_equal_to("gevent")
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_raise_exception_when_server_mode_is_unknown(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=spam".format(Configuration.SECTION, Configuration.OPTION_SERVER_MODE))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+
+    def callback():
+        config.server_mode
+
+    assert_that(callback).raises(ValueError)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_default_server_options_when_no_options_are_given(temp_dir):
+    temp_dir.create_file("config.cfg", "[{0}]\n".format(Configuration.SECTION))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.server_host).is_none()
+    assert_that(config.server_port).is_equal_to(Configuration.DEFAULT_SERVER_PORT)
+    assert_that(config.server_workers).is_equal_to(multiprocessing.cpu_count())
+    assert_that(config.server_backlog).is_equal_to(Configuration.DEFAULT_SERVER_BACKLOG)
+    assert_that(config.server_timeout).is_equal_to(Configuration.DEFAULT_SERVER_TIMEOUT)
+    assert_that(config.server_graceful_timeout).is_equal_to(Configuration.DEFAULT_SERVER_GRACEFUL_TIMEOUT)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_given_server_options_when_options_are_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=0.0.0.0\n{2}=8080\n{3}=3\n{4}=64\n{5}=5\n{6}=10".format(
+            Configuration.SECTION, Configuration.OPTION_SERVER_HOST, Configuration.OPTION_SERVER_PORT,
+            Configuration.OPTION_SERVER_WORKERS, Configuration.OPTION_SERVER_BACKLOG,
+            Configuration.OPTION_SERVER_TIMEOUT, Configuration.OPTION_SERVER_GRACEFUL_TIMEOUT))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.server_host).is_equal_to("0.0.0.0")
+    assert_that(config.server_port).is_equal_to(8080)
+    assert_that(config.server_workers).is_equal_to(3)
+    assert_that(config.server_backlog).is_equal_to(64)
+    assert_that(config.server_timeout).is_equal_to(5.0)
+    assert_that(config.server_graceful_timeout).is_equal_to(10.0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_given_negative_cache_options_when_options_are_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=30\n{2}=100".format(Configuration.SECTION, Configuration.OPTION_NEGATIVE_CACHE_TIME_TO_LIVE,
+                                         Configuration.OPTION_NEGATIVE_CACHE_SIZE))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.negative_cache_time_to_live).is_equal_to(30.0)
+    assert_that(config.negative_cache_size).is_equal_to(100)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_default_circuit_breaker_options_when_options_are_not_given(temp_dir):
+    temp_dir.create_file("config.cfg", "[{0}]".format(Configuration.SECTION))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.upstream_failure_threshold).is_equal_to(5)
+    assert_that(config.upstream_reset_timeout).is_equal_to(30.0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_given_circuit_breaker_options_when_options_are_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=0\n{2}=5".format(Configuration.SECTION, Configuration.OPTION_UPSTREAM_FAILURE_THRESHOLD,
+                                     Configuration.OPTION_UPSTREAM_RESET_TIMEOUT))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.upstream_failure_threshold).is_equal_to(0)
+    assert_that(config.upstream_reset_timeout).is_equal_to(5.0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_default_eviction_options_when_options_are_not_given(temp_dir):
+    temp_dir.create_file("config.cfg", "[{0}]".format(Configuration.SECTION))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.cached_packages_size_limit).is_equal_to(0)
+    assert_that(config.cached_packages_eviction_policy).is_equal_to("lru")
+    assert_that(config.cached_packages_eviction_interval).is_equal_to(60.0)
+    assert_that(config.cached_packages_eviction_grace_period).is_equal_to(300.0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_given_eviction_options_when_options_are_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=20G\n{2}=LFU\n{3}=10\n{4}=30".format(
+            Configuration.SECTION, Configuration.OPTION_CACHED_PACKAGES_SIZE_LIMIT,
+            Configuration.OPTION_CACHED_PACKAGES_EVICTION_POLICY,
+            Configuration.OPTION_CACHED_PACKAGES_EVICTION_INTERVAL,
+            Configuration.OPTION_CACHED_PACKAGES_EVICTION_GRACE_PERIOD))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.cached_packages_size_limit).is_equal_to(20 * 1024 ** 3)
+    assert_that(config.cached_packages_eviction_policy).is_equal_to("lfu")
+    assert_that(config.cached_packages_eviction_interval).is_equal_to(10.0)
+    assert_that(config.cached_packages_eviction_grace_period).is_equal_to(30.0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_return_size_limit_in_bytes_when_no_unit_is_given(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=1024".format(Configuration.SECTION, Configuration.OPTION_CACHED_PACKAGES_SIZE_LIMIT))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+    assert_that(config.cached_packages_size_limit).is_equal_to(1024)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def should_raise_exception_when_size_limit_is_invalid(temp_dir):
+    temp_dir.create_file("config.cfg",
+        "[{0}]\n{1}=lots".format(Configuration.SECTION, Configuration.OPTION_CACHED_PACKAGES_SIZE_LIMIT))
+
+    config = Configuration(temp_dir.join("config.cfg"))
+
+    def callback():
+        config.cached_packages_size_limit
+
+    assert_that(callback).raises(ValueError)
+
 
 if __name__ == '__main__':
     from pyfix import run_tests
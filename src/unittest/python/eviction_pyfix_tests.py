@@ -0,0 +1,164 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import os
+import time
+
+from pyfix import test, given
+from pyfix.fixtures import TemporaryDirectoryFixture
+from pyassert import assert_that
+
+from pypiproxy import metrics
+from pypiproxy.eviction import LFU, LRU, AccessTracker, CacheEvictor
+from pypiproxy.packageindex import PackageFile, ProxyPackageIndex
+
+
+def _create_cache(temp_dir, *packages):
+    """
+        Caches packages given as tuples (name, version, size, age of the file in seconds).
+    """
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"), "http://pypi.python.org")
+    for name, version, size, age in packages:
+        proxy_package_index._package_index.add_package(name, version, "x" * size)
+        filename = proxy_package_index._package_index.get_package_file(name, version).path
+        os.utime(filename, (time.time() - age, time.time() - age))
+        proxy_package_index._package_index.file_added(filename)
+    return proxy_package_index
+
+
+def _cached_names(proxy_package_index):
+    return sorted(name for name, _, _ in proxy_package_index.list_package_files())
+
+
+@test
+def access_tracker_should_count_accesses_and_default_to_modification_time():
+    access_tracker = AccessTracker()
+    access_tracker.record("spam", "0.1")
+    access_tracker.record("spam", "0.1")
+
+    count, last_access = access_tracker.get("spam", "0.1", PackageFile("spam-0.1.tar.gz", 1, 42))
+    assert_that(count).is_equal_to(2)
+    assert_that(time.time() - last_access < 10).is_true()
+    assert_that(access_tracker.get("eggs", "0.1", PackageFile("eggs-0.1.tar.gz", 1, 42))).is_equal_to((0, 42))
+
+
+@test
+def access_tracker_should_see_accesses_recorded_by_forked_process():
+    access_tracker = AccessTracker()
+    process_id = os.fork()
+    if process_id == 0:
+        access_tracker.record("spam", "0.1")
+        os._exit(0)
+    os.waitpid(process_id, 0)
+
+    assert_that(access_tracker.get("spam", "0.1", PackageFile("spam-0.1.tar.gz", 1, 42))[0]).is_equal_to(1)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def evict_should_not_delete_anything_below_limit(temp_dir):
+    proxy_package_index = _create_cache(temp_dir, ("spam", "0.1", 10, 3600), ("eggs", "0.1", 10, 3600))
+
+    assert_that(CacheEvictor(proxy_package_index, AccessTracker(), 20).evict()).is_equal_to(0)
+    assert_that(_cached_names(proxy_package_index)).is_equal_to(["eggs", "spam"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def evict_should_delete_least_recently_used_packages_until_below_low_watermark(temp_dir):
+    metrics.reset()
+    proxy_package_index = _create_cache(temp_dir, ("spam", "0.1", 10, 3000), ("eggs", "0.1", 10, 3600),
+                                        ("ham", "0.1", 10, 2000))
+    access_tracker = AccessTracker()
+    access_tracker.record("eggs", "0.1")
+
+    evicted_packages = CacheEvictor(proxy_package_index, access_tracker, 15, LRU, grace_period=0).evict()
+
+    assert_that(evicted_packages).is_equal_to(2)
+    assert_that(_cached_names(proxy_package_index)).is_equal_to(["eggs"])
+    assert_that(metrics.get_value("eviction.evicted_packages")).is_equal_to(2)
+    assert_that(metrics.get_value("eviction.freed_bytes")).is_equal_to(20)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def evict_should_delete_least_frequently_used_packages_first(temp_dir):
+    proxy_package_index = _create_cache(temp_dir, ("spam", "0.1", 10, 3600), ("eggs", "0.1", 10, 3600))
+    access_tracker = AccessTracker()
+    access_tracker.record("spam", "0.1")
+    access_tracker.record("spam", "0.1")
+    access_tracker.record("eggs", "0.1")
+
+    CacheEvictor(proxy_package_index, access_tracker, 15, LFU, grace_period=0).evict()
+
+    assert_that(_cached_names(proxy_package_index)).is_equal_to(["spam"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def evict_should_keep_packages_accessed_within_grace_period(temp_dir):
+    proxy_package_index = _create_cache(temp_dir, ("spam", "0.1", 10, 3600), ("eggs", "0.1", 10, 3600))
+    access_tracker = AccessTracker()
+    access_tracker.record("spam", "0.1")
+
+    CacheEvictor(proxy_package_index, access_tracker, 5, LRU, grace_period=60).evict()
+
+    assert_that(_cached_names(proxy_package_index)).is_equal_to(["spam"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def proxy_package_index_should_record_accesses_to_cached_packages(temp_dir):
+    access_tracker = AccessTracker()
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"), "http://pypi.python.org",
+                                            access_tracker=access_tracker)
+    proxy_package_index._package_index.add_package("spam", "0.1", "content")
+    package_file = proxy_package_index._package_index.get_package_file("spam", "0.1")
+
+    proxy_package_index.get_package_file("spam", "0.1")
+    proxy_package_index.get_package_content("spam", "0.1")
+    proxy_package_index.open_package("spam", "0.1")
+
+    assert_that(access_tracker.get("spam", "0.1", package_file)[0]).is_equal_to(3)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def proxy_package_index_should_not_record_accesses_to_packages_it_cannot_serve(temp_dir):
+    access_tracker = AccessTracker()
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"), "http://pypi.python.org",
+                                            access_tracker=access_tracker)
+    proxy_package_index._open_url = lambda *arguments, **keyword_arguments: None
+
+    assert_that(proxy_package_index.open_package("spam", "0.1")).is_none()
+    assert_that(proxy_package_index.get_package_file("spam", "0.1")).is_none()
+
+    assert_that(access_tracker.get("spam", "0.1", PackageFile("spam-0.1.tar.gz", 1, 42))).is_equal_to((0, 42))
+
+
+@test
+def cache_evictor_should_reject_unknown_policy():
+    def callback():
+        CacheEvictor(None, AccessTracker(), 1, "fifo")
+
+    assert_that(callback).raises(ValueError)
+
+
+if __name__ == "__main__":
+    from pyfix import run_tests
+
+    run_tests()
@@ -0,0 +1,151 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import os
+import stat
+
+from pyfix import test, given, run_tests
+from pyfix.fixtures import TemporaryDirectoryFixture
+from pyassert import assert_that
+
+from pypiproxy.export import StaticExport
+
+
+class _Packages(object):
+    def __init__(self, versions, generation=1):
+        self.versions = versions
+        self.generation = generation
+        self.package_name_listings = 0
+
+    def list_package_names(self):
+        self.package_name_listings += 1
+        return sorted(self.versions.keys())
+
+    def list_versions(self, name):
+        return self.versions.get(name, [])
+
+    def get_generation(self):
+        return self.generation
+
+
+def _create_export(temp_dir, packages):
+    return StaticExport(temp_dir.join("export"), packages.list_package_names, packages.list_versions,
+                        packages.get_generation)
+
+
+def _read(temp_dir, *path):
+    with open(temp_dir.join("export", *path)) as page_file:
+        return page_file.read()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def export_changes_should_write_package_list_and_changed_version_pages(temp_dir):
+    static_export = _create_export(temp_dir, _Packages({"spam": ["0.1"], "eggs": ["1.0"]}))
+    static_export.package_changed("spam")
+
+    assert_that(static_export.export_changes()).is_equal_to(2)
+
+    assert_that(_read(temp_dir, "simple", "index.html")).contains('<a href="/simple/eggs">eggs</a><br/>')
+    assert_that(_read(temp_dir, "simple", "spam", "index.html")).contains("spam-0.1.tar.gz")
+    assert_that(os.path.exists(temp_dir.join("export", "simple", "eggs"))).is_false()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def export_changes_should_make_pages_readable_for_everyone(temp_dir):
+    static_export = _create_export(temp_dir, _Packages({"spam": ["0.1"]}))
+
+    static_export.export_changes()
+
+    mode = os.stat(temp_dir.join("export", "simple", "index.html")).st_mode
+    assert_that(mode & stat.S_IROTH).is_equal_to(stat.S_IROTH)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def export_changes_should_not_write_package_list_again_when_generation_is_unchanged(temp_dir):
+    packages = _Packages({"spam": ["0.1"]})
+    static_export = _create_export(temp_dir, packages)
+    static_export.export_changes()
+    packages.versions["eggs"] = ["1.0"]
+
+    assert_that(static_export.export_changes()).is_equal_to(0)
+
+    packages.generation = 2
+    assert_that(static_export.export_changes()).is_equal_to(1)
+    assert_that(_read(temp_dir, "simple", "index.html")).contains("eggs")
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def export_changes_should_export_package_list_with_unknown_generation_at_most_every_interval(temp_dir):
+    packages = _Packages({"spam": ["0.1"]}, generation=None)
+    static_export = _create_export(temp_dir, packages)
+    static_export.export_changes(package_list_interval=60)
+    packages.versions["eggs"] = ["1.0"]
+    static_export.package_changed("eggs")
+
+    assert_that(static_export.export_changes(package_list_interval=60)).is_equal_to(1)
+    assert_that(packages.package_name_listings).is_equal_to(1)
+
+    static_export._package_list_exported_at -= 60
+
+    assert_that(static_export.export_changes(package_list_interval=60)).is_equal_to(1)
+    assert_that(_read(temp_dir, "simple", "index.html")).contains("eggs")
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def export_changes_should_not_write_unchanged_version_page(temp_dir):
+    static_export = _create_export(temp_dir, _Packages({"spam": ["0.1"]}))
+    static_export.package_changed("spam")
+    static_export.export_changes()
+
+    static_export.package_changed("spam")
+
+    assert_that(static_export.export_changes()).is_equal_to(0)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def export_changes_should_remove_version_page_of_package_without_versions(temp_dir):
+    packages = _Packages({"spam": ["0.1"]})
+    static_export = _create_export(temp_dir, packages)
+    static_export.package_changed("spam")
+    static_export.export_changes()
+    del packages.versions["spam"]
+
+    static_export.package_changed("spam")
+    static_export.export_changes()
+
+    assert_that(os.path.exists(temp_dir.join("export", "simple", "spam"))).is_false()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def export_changes_should_not_export_package_with_unsafe_name(temp_dir):
+    static_export = _create_export(temp_dir, _Packages({"../spam": ["0.1"]}, generation=None))
+    static_export.package_changed("../spam")
+
+    assert_that(static_export.export_changes()).is_equal_to(1)
+
+    assert_that(os.path.exists(temp_dir.join("export", "spam"))).is_false()
+
+
+if __name__ == "__main__":
+    run_tests()
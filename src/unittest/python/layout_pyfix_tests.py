@@ -0,0 +1,56 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+from pyfix import test, given
+from pyfix.fixtures import TemporaryDirectoryFixture
+from pyassert import assert_that
+
+from pypiproxy.layout import normalize_name, sharded_path
+from pypiproxy.packageindex import migrate_to_sharded_layout
+
+
+@test
+def normalize_name_should_lower_case_name_and_replace_separators_with_dash():
+    assert_that(normalize_name("Spam_and.Eggs--Ham")).is_equal_to("spam-and-eggs-ham")
+
+
+@test
+def sharded_path_should_put_file_below_first_letter_and_normalized_name():
+    assert_that(sharded_path("packages", "Spam_Eggs", "Spam_Eggs-1.0.tar.gz")).is_equal_to(
+        "packages/s/spam-eggs/Spam_Eggs-1.0.tar.gz")
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def migrate_to_sharded_layout_should_move_flat_package_files_into_shards(temp_dir):
+    temp_dir.create_directory("packages")
+    temp_dir.touch("packages", "spam-0.1.2.tar.gz")
+    temp_dir.touch("packages", "eggs-0.1.2.tar.gz")
+    temp_dir.touch("packages", "README")
+
+    moved_files = migrate_to_sharded_layout(temp_dir.join("packages"))
+
+    assert_that(moved_files).is_equal_to(2)
+    assert_that(temp_dir.join("packages", "s", "spam", "spam-0.1.2.tar.gz")).is_a_file()
+    assert_that(temp_dir.join("packages", "e", "eggs", "eggs-0.1.2.tar.gz")).is_a_file()
+    assert_that(temp_dir.join("packages", "README")).is_a_file()
+
+
+if __name__ == "__main__":
+    from pyfix import run_tests
+
+    run_tests()
@@ -0,0 +1,55 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+from pyfix import test, after
+from pyassert import assert_that
+
+from pypiproxy import metrics
+
+
+@test
+@after(metrics.reset)
+def increment_should_add_amount_to_counter():
+    metrics.increment("spam")
+    metrics.increment("spam", 41)
+
+    assert_that(metrics.get_value("spam")).is_equal_to(42)
+
+
+@test
+@after(metrics.reset)
+def get_value_should_return_default_value_for_unknown_name():
+    assert_that(metrics.get_value("spam")).is_equal_to(0)
+    assert_that(metrics.get_value("spam", None)).is_none()
+
+
+@test
+@after(metrics.reset)
+def snapshot_should_return_copy_of_all_values():
+    metrics.increment("spam")
+    metrics.set_value("eggs", "open")
+
+    values = metrics.snapshot()
+    metrics.increment("spam")
+
+    assert_that(values).is_equal_to({"spam": 1, "eggs": "open"})
+
+
+if __name__ == "__main__":
+    from pyfix import run_tests
+
+    run_tests()
@@ -15,6 +15,10 @@
 
 __author__ = "Alexander Metzner"
 
+import hashlib
+import os
+import shutil
+import stat
 import StringIO
 
 from pyfix import test, given, Fixture
@@ -22,7 +26,7 @@ from pyfix.fixtures import TemporaryDirectoryFixture
 from pyassert import assert_that
 
 
-from pypiproxy.packageindex import PackageIndex, _guess_name_and_version
+from pypiproxy.packageindex import PACKAGE_FILE_MODE, PackageIndex, PackageStatistics, _guess_name_and_version
 
 
 class PackageData(Fixture):
@@ -194,11 +198,245 @@ def add_package_should_write_package_file(temp_dir, package_data):
     index = PackageIndex("any_name", temp_dir.join("packages"))
     index.add_package("spam", "version", package_data)
 
-    expected_file_name = temp_dir.join("packages", "spam-version.tar.gz")
+    expected_file_name = temp_dir.join("packages", "s", "spam", "spam-version.tar.gz")
     assert_that(expected_file_name).is_a_file()
     assert_that(expected_file_name).has_file_length_of(17)
 
 
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def add_package_should_write_package_file_from_stream_and_return_digests(temp_dir):
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+
+    digests = index.add_package("spam", "version", StringIO.StringIO("spam"))
+
+    assert_that(temp_dir.join("packages", "s", "spam", "spam-version.tar.gz")).has_file_length_of(4)
+    assert_that(digests["md5"]).is_equal_to(hashlib.md5("spam").hexdigest())
+    assert_that(digests["sha256"]).is_equal_to(hashlib.sha256("spam").hexdigest())
+    assert_that(os.listdir(temp_dir.join("packages", "s", "spam"))).is_equal_to(["spam-version.tar.gz"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def add_package_should_write_package_file_with_permissions_of_umask(temp_dir):
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+
+    index.add_package("spam", "version", "spam")
+
+    mode = os.stat(temp_dir.join("packages", "s", "spam", "spam-version.tar.gz")).st_mode
+    assert_that(stat.S_IMODE(mode)).is_equal_to(PACKAGE_FILE_MODE)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def add_package_should_raise_exception_and_not_write_package_file_when_md5_digest_does_not_match(temp_dir):
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+
+    def callback():
+        index.add_package("spam", "version", StringIO.StringIO("spam"), "eggs")
+
+    assert_that(callback).raises(ValueError)
+    assert_that(os.listdir(temp_dir.join("packages", "s", "spam"))).is_empty()
+    assert_that(index.contains("spam")).is_equal_to(False)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def list_versions_should_return_versions_from_flat_and_sharded_layout(temp_dir):
+    temp_dir.create_directory("packages", "s", "spam")
+    temp_dir.touch("packages", "spam-0.1.2.tar.gz")
+    temp_dir.touch("packages", "s", "spam", "spam-0.1.3.tar.gz")
+
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+
+    assert_that(index.list_versions("spam")).is_equal_to(["0.1.2", "0.1.3"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def get_package_file_should_prefer_sharded_layout_when_package_is_in_both_layouts(temp_dir):
+    temp_dir.create_directory("packages")
+    temp_dir.touch("packages", "spam-0.1.2.tar.gz")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.add_package("spam", "0.1.2", "12345")
+    index.directory_changed(temp_dir.join("packages"))
+
+    assert_that(index.get_package_file("spam", "0.1.2").path).is_equal_to(
+        temp_dir.join("packages", "s", "spam", "spam-0.1.2.tar.gz"))
+    assert_that(index.get_statistics()).is_equal_to(PackageStatistics(1, 1, 5))
+
+    index.remove_package("spam", "0.1.2")
+    index.directory_changed(temp_dir.join("packages"))
+
+    assert_that(index.get_package_file("spam", "0.1.2").path).is_equal_to(
+        temp_dir.join("packages", "spam-0.1.2.tar.gz"))
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def directory_changed_should_forget_packages_of_removed_shard_directory(temp_dir):
+    temp_dir.create_directory("packages", "s", "spam")
+    temp_dir.touch("packages", "s", "spam", "spam-0.1.3.tar.gz")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.start_watching()
+    try:
+        shutil.rmtree(temp_dir.join("packages", "s"))
+        index.directory_changed(temp_dir.join("packages"))
+
+        assert_that(index.contains("spam")).is_equal_to(False)
+    finally:
+        index.stop_watching()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture, package_data=PackageData)
+def add_package_should_make_package_available_without_rescanning_directory(temp_dir, package_data):
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.add_package("spam", "0.1.3", package_data)
+    index.add_package("spam", "0.1.2", package_data)
+
+    assert_that(index.contains("spam", "0.1.2")).is_equal_to(True)
+    assert_that(index.list_versions("spam")).is_equal_to(["0.1.2", "0.1.3"])
+    assert_that([name for name in index.list_available_package_names()]).is_equal_to(["spam"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def list_versions_should_return_package_file_dropped_into_directory_after_creation_of_index(temp_dir):
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    temp_dir.touch("packages", "spam-0.1.2.tar.gz")
+
+    assert_that(index.list_versions("spam")).is_equal_to(["0.1.2"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def contains_should_follow_changes_in_shard_directories_made_by_another_index(temp_dir):
+    index = PackageIndex("any_name", temp_dir.join("packages"), refresh_interval=0)
+    other_index = PackageIndex("other_name", temp_dir.join("packages"), refresh_interval=0)
+    index.add_package("spam", "0.1.2", "12345")
+
+    assert_that(other_index.contains("spam", "0.1.2")).is_true()
+
+    index.add_package("spam", "0.1.3", "12345")
+    other_index.remove_package("spam", "0.1.2")
+
+    assert_that(index.contains("spam", "0.1.2")).is_false()
+    assert_that(other_index.list_versions("spam")).is_equal_to(["0.1.3"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def contains_should_check_shard_directories_at_most_every_refresh_interval(temp_dir):
+    index = PackageIndex("any_name", temp_dir.join("packages"), refresh_interval=3600)
+    other_index = PackageIndex("other_name", temp_dir.join("packages"))
+    index.add_package("spam", "0.1.2", "12345")
+    other_index.add_package("spam", "0.1.3", "12345")
+
+    assert_that(index.contains("spam", "0.1.3")).is_false()
+
+    index._refreshed_at -= 3600
+
+    assert_that(index.contains("spam", "0.1.3")).is_true()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def start_watching_should_only_synchronize_directories_changed_since_index_was_built(temp_dir):
+    other_index = PackageIndex("other_name", temp_dir.join("packages"))
+    other_index.add_package("spam", "0.1.2", "12345")
+    other_index.add_package("eggs", "0.1.2", "12345")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    other_index.add_package("spam", "0.1.3", "12345")
+    synchronized_directories = []
+    synchronize_directory = index._synchronize_directory
+
+    def record_synchronization(directory, recursive):
+        synchronized_directories.append(directory)
+        synchronize_directory(directory, recursive)
+
+    index._synchronize_directory = record_synchronization
+    index.start_watching()
+    try:
+        assert_that(synchronized_directories).is_equal_to([temp_dir.join("packages", "s", "spam")])
+        assert_that(index.list_versions("spam")).is_equal_to(["0.1.2", "0.1.3"])
+    finally:
+        index.stop_watching()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def get_package_file_should_return_path_and_size_of_package_file(temp_dir):
+    temp_dir.create_directory("packages")
+    temp_dir.create_file(["packages", "eggs-0.1.2.tar.gz"], "spam and eggs", binary=True)
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+
+    package_file = index.get_package_file("eggs", "0.1.2")
+
+    assert_that(package_file.path).is_equal_to(temp_dir.join("packages", "eggs-0.1.2.tar.gz"))
+    assert_that(package_file.size).is_equal_to(13)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def count_packages_should_ignore_files_with_invalid_names(temp_dir):
+    temp_dir.create_directory("packages")
+    temp_dir.touch("packages", "spam.tar.gz")
+    temp_dir.touch("packages", "spam-eggs.tar.gz")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+
+    assert_that(index.count_packages()).is_equal_to(1)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def file_removed_should_remove_package_from_index(temp_dir):
+    temp_dir.create_directory("packages")
+    temp_dir.touch("packages", "spam-0.1.2.tar.gz")
+    temp_dir.touch("packages", "spam-0.1.3.tar.gz")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.start_watching()
+    try:
+        index.file_removed(temp_dir.join("packages", "spam-0.1.2.tar.gz"))
+        index.file_removed(temp_dir.join("packages", "spam-0.1.3.tar.gz"))
+
+        assert_that(index.contains("spam")).is_equal_to(False)
+        assert_that([name for name in index.list_available_package_names()]).is_empty()
+    finally:
+        index.stop_watching()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def file_added_should_add_package_to_index(temp_dir):
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.start_watching()
+    try:
+        temp_dir.touch("packages", "spam-0.1.2.tar.gz")
+        index.file_added(temp_dir.join("packages", "spam-0.1.2.tar.gz"))
+
+        assert_that(index.list_versions("spam")).is_equal_to(["0.1.2"])
+    finally:
+        index.stop_watching()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def directory_changed_should_apply_added_and_removed_files(temp_dir):
+    temp_dir.create_directory("packages")
+    temp_dir.touch("packages", "spam-0.1.2.tar.gz")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.start_watching()
+    try:
+        os.remove(temp_dir.join("packages", "spam-0.1.2.tar.gz"))
+        temp_dir.touch("packages", "eggs-0.1.2.tar.gz")
+        index.directory_changed()
+
+        assert_that([name for name in index.list_available_package_names()]).is_equal_to(["eggs"])
+    finally:
+        index.stop_watching()
+
+
 @test
 @given(temp_dir=TemporaryDirectoryFixture)
 def count_packages_should_return_zero_when_directory_is_empty(temp_dir):
@@ -244,6 +482,101 @@ def contains_should_return_true_if_package_in_specific_version_available(temp_di
 
     assert_that(index.contains("spam", "0.1.2")).is_equal_to(True)
 
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def generation_should_change_when_package_is_added_or_removed(temp_dir):
+    temp_dir.create_directory("packages")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    initial_generation = index.generation
+
+    index.add_package("spam", "0.1.2", "content")
+    generation_after_adding = index.generation
+    index.file_removed(index.get_package_file("spam", "0.1.2").path)
+
+    assert_that(generation_after_adding).is_not_equal_to(initial_generation)
+    assert_that(index.generation).is_not_equal_to(generation_after_adding)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def generation_should_not_change_when_unchanged_directory_is_synchronized(temp_dir):
+    temp_dir.create_directory("packages")
+    temp_dir.touch("packages", "spam-0.1.2.tar.gz")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    initial_generation = index.generation
+
+    index.directory_changed()
+
+    assert_that(index.generation).is_equal_to(initial_generation)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def get_statistics_should_count_files_names_and_bytes(temp_dir):
+    temp_dir.create_directory("packages")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.add_package("spam", "0.1.2", "12345")
+    index.add_package("spam", "0.1.3", "123")
+    index.add_package("eggs", "0.1", "1")
+
+    assert_that(index.get_statistics()).is_equal_to(PackageStatistics(3, 2, 9))
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def get_statistics_should_follow_replaced_and_removed_files(temp_dir):
+    temp_dir.create_directory("packages")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.add_package("spam", "0.1.2", "12345")
+    index.add_package("spam", "0.1.2", "12")
+    index.add_package("eggs", "0.1", "1")
+    index.file_removed(index.get_package_file("eggs", "0.1").path)
+
+    assert_that(index.get_statistics()).is_equal_to(PackageStatistics(1, 1, 2))
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def listener_should_be_notified_when_package_is_added_or_removed(temp_dir):
+    temp_dir.create_directory("packages")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    changed_names = []
+    index.add_listener(changed_names.append)
+
+    index.add_package("spam", "0.1.2", "content")
+    index.file_removed(index.get_package_file("spam", "0.1.2").path)
+
+    assert_that(changed_names).is_equal_to(["spam", "spam"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def remove_package_should_delete_file_and_drop_it_from_index(temp_dir):
+    temp_dir.create_directory("packages")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.add_package("spam", "0.1.2", "12345")
+    index.add_package("eggs", "0.1", "1")
+    package_file = index.get_package_file("spam", "0.1.2")
+
+    assert_that(index.remove_package("spam", "0.1.2")).is_equal_to(package_file)
+    assert_that(os.path.exists(package_file.path)).is_false()
+    assert_that(index.contains("spam")).is_false()
+    assert_that([name for name, _, _ in index.list_package_files()]).is_equal_to(["eggs"])
+    assert_that(index.get_statistics()).is_equal_to(PackageStatistics(1, 1, 1))
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def remove_package_should_drop_file_deleted_by_other_means_from_index(temp_dir):
+    temp_dir.create_directory("packages")
+    index = PackageIndex("any_name", temp_dir.join("packages"))
+    index.add_package("spam", "0.1.2", "12345")
+    os.remove(index.get_package_file("spam", "0.1.2").path)
+
+    assert_that(index.remove_package("spam", "0.1.2")).is_none()
+    assert_that(index.remove_package("spam", "0.1.2")).is_none()
+    assert_that(index.get_statistics()).is_equal_to(PackageStatistics(0, 0, 0))
+
 
 if __name__ == "__main__":
     from pyfix import run_tests
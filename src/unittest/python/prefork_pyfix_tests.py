@@ -0,0 +1,131 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import os
+import signal
+import socket
+import time
+
+from pyfix import test, run_tests
+from pyassert import assert_that
+
+from pypiproxy.prefork import PreforkMaster, create_listening_socket
+
+
+def _serve_process_id(listening_socket, worker_number):
+    stopped = []
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: stopped.append(signal_number))
+    listening_socket.settimeout(0.1)
+    while not stopped:
+        try:
+            connection, _ = listening_socket.accept()
+        except (socket.timeout, socket.error):
+            continue
+        message = connection.recv(16)
+        if message == "exit":
+            os._exit(1)
+        connection.sendall(str(worker_number) if message == "number" else str(os.getpid()))
+        connection.close()
+
+
+def _request(port, message="pid"):
+    connection = socket.create_connection(("127.0.0.1", port))
+    try:
+        connection.sendall(message)
+        return connection.recv(16)
+    finally:
+        connection.close()
+
+
+def _start_master(listening_socket, workers):
+    master_pid = os.fork()
+    if master_pid == 0:
+        try:
+            PreforkMaster(listening_socket, _serve_process_id, workers, graceful_timeout=2).run()
+        finally:
+            os._exit(0)
+    listening_socket.close()
+    time.sleep(0.5)
+    return master_pid
+
+
+def _stop_master(master_pid):
+    os.kill(master_pid, signal.SIGTERM)
+    _, status = os.waitpid(master_pid, 0)
+    return status
+
+
+@test
+def create_listening_socket_should_listen_on_given_address():
+    listening_socket = create_listening_socket("127.0.0.1", 0)
+    try:
+        assert_that(listening_socket.getsockname()[0]).is_equal_to("127.0.0.1")
+        socket.create_connection(listening_socket.getsockname()).close()
+    finally:
+        listening_socket.close()
+
+
+@test
+def master_should_serve_from_workers_and_stop_on_sigterm():
+    listening_socket = create_listening_socket("127.0.0.1", 0)
+    port = listening_socket.getsockname()[1]
+    master_pid = _start_master(listening_socket, 2)
+    try:
+        worker_pids = set(_request(port) for _ in range(20))
+    finally:
+        status = _stop_master(master_pid)
+
+    assert_that(len(worker_pids)).is_greater_than(0)
+    assert_that(str(master_pid) in worker_pids).is_false()
+    assert_that(status).is_equal_to(0)
+
+
+@test
+def master_should_restart_exited_worker():
+    listening_socket = create_listening_socket("127.0.0.1", 0)
+    port = listening_socket.getsockname()[1]
+    master_pid = _start_master(listening_socket, 1)
+    try:
+        first_worker_pid = _request(port)
+        _request(port, "exit")
+        time.sleep(1.5)
+        second_worker_pid = _request(port)
+    finally:
+        _stop_master(master_pid)
+
+    assert_that(second_worker_pid).is_not_equal_to(first_worker_pid)
+
+
+@test
+def master_should_give_restarted_worker_number_of_exited_worker():
+    listening_socket = create_listening_socket("127.0.0.1", 0)
+    port = listening_socket.getsockname()[1]
+    master_pid = _start_master(listening_socket, 1)
+    try:
+        first_worker_number = _request(port, "number")
+        _request(port, "exit")
+        time.sleep(1.5)
+        second_worker_number = _request(port, "number")
+    finally:
+        _stop_master(master_pid)
+
+    assert_that(first_worker_number).is_equal_to("0")
+    assert_that(second_worker_number).is_equal_to("0")
+
+
+if __name__ == "__main__":
+    run_tests()
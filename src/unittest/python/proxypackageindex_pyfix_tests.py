@@ -16,15 +16,53 @@
 __author__ = "Michael Gruber, Maximilien Riehl"
 
 import os
+import threading
+import time
+
 from pyfix import after, test, given
 from pyfix.fixtures import TemporaryDirectoryFixture
 from pyassert import assert_that
 from mockito import when, mock, unstub, verify, any as any_value
 from StringIO import StringIO
-from urllib2 import URLError
 
-from pypiproxy.packageindex import ProxyPackageIndex
-import pypiproxy.packageindex
+from pypiproxy import metrics
+from pypiproxy.cache import IndexSnapshot, NegativeCache, Validators, VersionCache
+from pypiproxy.packageindex import ProxyPackageIndex, _UpstreamIndex
+from pypiproxy.streaming import CHUNK_SIZE
+from pypiproxy.upstream import CircuitOpenError, UpstreamError
+
+
+def _read_in_background(package, results):
+    def read():
+        try:
+            results.append("".join(package))
+        except IOError as e:
+            results.append(e)
+
+    reading_thread = threading.Thread(target=read)
+    reading_thread.start()
+    return reading_thread
+
+
+class _UpstreamResponse(StringIO):
+    def __init__(self, content, status=200, headers=None):
+        StringIO.__init__(self, content)
+        self.status = status
+        self._headers = headers or {}
+        self.failure_listeners = []
+
+    def info(self):
+        return self._headers
+
+    def add_failure_listener(self, listener):
+        self.failure_listeners.append(listener)
+
+
+class _FailingUpstreamResponse(_UpstreamResponse):
+    def read(self, size=-1):
+        for listener in self.failure_listeners:
+            listener()
+        raise UpstreamError("Connection reset")
 
 
 @test
@@ -68,9 +106,9 @@ def ensure_proxy_gets_package_content_from_pypi_if_it_is_not_cached(temp_dir):
     proxy_package_index = ProxyPackageIndex(
         "cached", temp_dir.join("packages"), "http://pypi.python.org")
     proxy_package_index._package_index = mock()
+    package_stream = StringIO("package content")
     package_content = mock()
-    when(proxy_package_index)._fetch_url(
-        any_value(), raw=any_value()).thenReturn(package_content)
+    when(proxy_package_index)._open_url(any_value(), name=any_value()).thenReturn(package_stream)
     when(proxy_package_index._package_index).contains(
         any_value(), any_value()).thenReturn(False)
     when(proxy_package_index._package_index).get_package_content(
@@ -80,10 +118,10 @@ def ensure_proxy_gets_package_content_from_pypi_if_it_is_not_cached(temp_dir):
         "pyassert", "0.2.5")
 
     assert_that(actual_package).is_equal_to(package_content)
-    verify(proxy_package_index)._fetch_url(
-        "http://pypi.python.org/packages/source/p/pyassert/pyassert-0.2.5.tar.gz", raw=True)
+    verify(proxy_package_index)._open_url(
+        "/packages/source/p/pyassert/pyassert-0.2.5.tar.gz", name="pyassert")
     verify(proxy_package_index._package_index).add_package(
-        "pyassert", "0.2.5", package_content)
+        "pyassert", "0.2.5", package_stream)
     verify(proxy_package_index._package_index).get_package_content(
         "pyassert", "0.2.5")
 
@@ -91,53 +129,198 @@ def ensure_proxy_gets_package_content_from_pypi_if_it_is_not_cached(temp_dir):
 @test
 @given(temp_dir=TemporaryDirectoryFixture)
 @after(unstub)
-def ensure_list_available_package_names_retrieves_index_from_pypi(temp_dir):
+def ensure_proxy_returns_no_package_file_when_download_from_pypi_fails(temp_dir):
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org")
+    when(proxy_package_index)._open_url(any_value(), name=any_value()).thenReturn(None)
+
+    actual_file = proxy_package_index.get_package_file("pyassert", "0.2.5")
+
+    assert_that(actual_file).is_none()
+    assert_that(proxy_package_index._package_index.contains("pyassert")).is_equal_to(False)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_proxy_returns_no_package_file_when_reading_package_from_pypi_fails(temp_dir):
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org")
+    package_stream = mock()
+    when(package_stream).read(any_value()).thenReturn("package").thenRaise(IOError("connection reset"))
+    when(proxy_package_index)._open_url(any_value(), name=any_value()).thenReturn(package_stream)
+
+    actual_file = proxy_package_index.get_package_file("pyassert", "0.2.5")
+
+    assert_that(actual_file).is_none()
+    assert_that(proxy_package_index._package_index.contains("pyassert")).is_equal_to(False)
+    verify(package_stream).close()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_open_package_streams_package_from_pypi_into_cache_when_it_is_not_cached(temp_dir):
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org")
+    when(proxy_package_index)._open_url(any_value(), name=any_value()).thenReturn(StringIO("package content"))
+
+    download = proxy_package_index.open_package("pyassert", "0.2.5")
+
+    assert_that(proxy_package_index._package_index.contains("pyassert", "0.2.5")).is_equal_to(False)
+    assert_that("".join(download)).is_equal_to("package content")
+    assert_that(proxy_package_index._package_index.get_package_content("pyassert", "0.2.5")).is_equal_to(
+        "package content")
+    verify(proxy_package_index)._open_url("/packages/source/p/pyassert/pyassert-0.2.5.tar.gz", name="pyassert")
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_concurrent_open_package_requests_package_from_pypi_once_and_yields_identical_content(temp_dir):
+    package_content = "x" * (2 * CHUNK_SIZE + 1)
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org")
+    when(proxy_package_index)._open_url(any_value(), name=any_value()).thenReturn(StringIO(package_content))
+
+    download = proxy_package_index.open_package("pyassert", "0.2.5")
+    following_downloads = [proxy_package_index.open_package("pyassert", "0.2.5") for _ in range(3)]
+    results = []
+    reading_threads = [_read_in_background(following_download, results)
+                       for following_download in following_downloads]
+    content = "".join(download)
+    for reading_thread in reading_threads:
+        reading_thread.join()
+
+    assert_that(content).is_equal_to(package_content)
+    assert_that(results).is_equal_to([package_content] * 3)
+    assert_that(proxy_package_index._package_index.get_package_content("pyassert", "0.2.5")).is_equal_to(
+        package_content)
+    verify(proxy_package_index, times=1)._open_url(any_value(), name=any_value())
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_following_download_fails_when_download_fails(temp_dir):
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org")
+    package_stream = mock()
+    when(package_stream).read(any_value()).thenReturn("package").thenRaise(IOError("connection reset"))
+    when(proxy_package_index)._open_url(any_value(), name=any_value()).thenReturn(package_stream)
+
+    download = proxy_package_index.open_package("pyassert", "0.2.5")
+    results = []
+    reading_thread = _read_in_background(proxy_package_index.open_package("pyassert", "0.2.5"), results)
+
+    def callback():
+        "".join(download)
+
+    assert_that(callback).raises(IOError)
+    reading_thread.join()
+    assert_that(isinstance(results[0], IOError)).is_true()
+    assert_that(proxy_package_index._package_index.contains("pyassert", "0.2.5")).is_false()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_following_download_yields_whole_content_when_leading_request_ends_early(temp_dir):
+    package_content = "x" * (2 * CHUNK_SIZE + 1)
     proxy_package_index = ProxyPackageIndex(
         "cached", temp_dir.join("packages"), "http://pypi.python.org")
-    package_stream = StringIO("""<!doctype html><html><body>
+    when(proxy_package_index)._open_url(any_value(), name=any_value()).thenReturn(StringIO(package_content))
+
+    download = proxy_package_index.open_package("pyassert", "0.2.5")
+    results = []
+    reading_thread = _read_in_background(proxy_package_index.open_package("pyassert", "0.2.5"), results)
+    download.next()
+    download.close()
+    reading_thread.join()
+
+    assert_that(results).is_equal_to([package_content])
+    assert_that(download.wait()).is_true()
+    assert_that(proxy_package_index._package_index.get_package_content("pyassert", "0.2.5")).is_equal_to(
+        package_content)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_open_package_returns_package_file_when_package_is_cached(temp_dir):
+    temp_dir.create_directory("packages")
+    temp_dir.touch("packages", "pyassert-0.2.5.tar.gz")
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org")
+
+    package_file = proxy_package_index.open_package("pyassert", "0.2.5")
+
+    assert_that(package_file.path).is_equal_to(temp_dir.join("packages", "pyassert-0.2.5.tar.gz"))
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_open_package_downloads_package_again_after_deleted_file_has_been_dropped(temp_dir):
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org")
+    proxy_package_index._package_index.add_package("pyassert", "0.2.5", "old content")
+    package_file = proxy_package_index.open_package("pyassert", "0.2.5")
+    os.remove(package_file.path)
+    when(proxy_package_index)._open_url(any_value(), name=any_value()).thenReturn(StringIO("package content"))
+
+    proxy_package_index.file_removed(package_file.path)
+    download = proxy_package_index.open_package("pyassert", "0.2.5")
+
+    assert_that("".join(download)).is_equal_to("package content")
+    assert_that(proxy_package_index._package_index.get_package_content("pyassert", "0.2.5")).is_equal_to(
+        "package content")
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_list_available_package_names_retrieves_index_from_pypi(temp_dir):
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", upstream_client=upstream_client)
+    package_stream = _UpstreamResponse("""<!doctype html><html><body>
 <a href='alpha'>alpha</a><br/>
 <a href='beta'>beta</a><br/>
 <a href='gamma'>gamma</a><br/>
 </body></html>""")
-    cached_environment = os.environ
-    os.environ = {}
-    when(pypiproxy.packageindex.urllib2).urlopen(
-        any_value()).thenReturn(package_stream)
+    when(upstream_client).open(any_value(), any_value()).thenReturn(package_stream)
 
     actual_list = proxy_package_index.list_available_package_names()
 
     assert_that(actual_list).is_equal_to(['alpha', 'beta', 'gamma'])
-    verify(pypiproxy.packageindex.urllib2).urlopen(
-        "http://pypi.python.org/simple/")
-    os.environ = cached_environment
+    verify(upstream_client).open("http://pypi.python.org/simple/", {})
 
 
 @test
 @given(temp_dir=TemporaryDirectoryFixture)
 @after(unstub)
 def ensure_list_available_package_names_delegates_to_cached_index_when_failing_to_download_index(temp_dir):
+    upstream_client = mock()
     proxy_package_index = ProxyPackageIndex(
-        "cached", temp_dir.join("packages"), "http://pypi.python.org")
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", upstream_client=upstream_client)
     temp_dir.touch("packages", "spam-0.1.2.tar.gz")
     temp_dir.touch("packages", "eggs-0.1.2.tar.gz")
-    cached_environment = os.environ
-    os.environ = {}
-    when(pypiproxy.packageindex.urllib2).urlopen(
-        any_value()).thenRaise(URLError("Failed!"))
+    when(upstream_client).open(any_value(), any_value()).thenRaise(UpstreamError("Failed!"))
 
     actual_list = proxy_package_index.list_available_package_names()
 
     assert_that(actual_list).is_equal_to(['eggs', 'spam'])
-    os.environ = cached_environment
 
 
 @test
 @given(temp_dir=TemporaryDirectoryFixture)
 @after(unstub)
 def ensure_list_versions_retrieves_versions_from_pypi(temp_dir):
+    upstream_client = mock()
     proxy_package_index = ProxyPackageIndex(
-        "cached", temp_dir.join("packages"), "http://pypi.python.org")
-    package_stream = StringIO("""<!doctype html><html><body>
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", upstream_client=upstream_client)
+    package_stream = _UpstreamResponse("""<!doctype html><html><body>
 <a href='package-0.1.2.tar.gz'>package-0.1.2.tar.gz</a><br/>
 <a href='package-1.2.3.tar.gz'>package-1.2.3.tar.gz</a><br/>
 <a href='package-1.2.3.egg'>package-1.2.3.egg</a><br/>
@@ -146,51 +329,43 @@ def ensure_list_versions_retrieves_versions_from_pypi(temp_dir):
 <a href="package-3.01.tar.gz" rel="download">3.01 download_url</a><br/>
 <a href="package" rel="homepage">3.02 home_page</a><br/>
 </body></html>""")
-    cached_environment = os.environ
-    os.environ = {}
-    when(pypiproxy.packageindex.urllib2).urlopen(
-        any_value()).thenReturn(package_stream)
+    when(upstream_client).open(any_value(), any_value()).thenReturn(package_stream)
 
     actual_list = proxy_package_index.list_versions("package")
 
     assert_that(actual_list).is_equal_to(['0.1.2', '1.2.3', '2.3.4', '3.01'])
-    verify(pypiproxy.packageindex.urllib2).urlopen(
-        "http://pypi.python.org/simple/package/")
-    os.environ = cached_environment
+    verify(upstream_client).open("http://pypi.python.org/simple/package/", {})
 
 
 @test
 @given(temp_dir=TemporaryDirectoryFixture)
 @after(unstub)
 def ensure_list_versions_delegates_to_cached_versions_when_to_download_versions_from_pypi(temp_dir):
+    upstream_client = mock()
     proxy_package_index = ProxyPackageIndex(
-        "cached", temp_dir.join("packages"), "http://pypi.python.org")
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", upstream_client=upstream_client)
     temp_dir.touch("packages", "spam-0.1.2.tar.gz")
     temp_dir.touch("packages", "spam-2.3.4.tar.gz")
     temp_dir.touch("packages", "spam-2.3.4.egg")
     temp_dir.touch("packages", "spam-1.2.3.tar.gz")
     temp_dir.touch("packages", "eggs-0.1.2.tar.gz")
     temp_dir.touch("packages", "eggs-0.1.2.egg")
-    cached_environment = os.environ
-    os.environ = {}
-    when(pypiproxy.packageindex.urllib2).urlopen(
-        any_value()).thenRaise(URLError("Failed!"))
+    when(upstream_client).open(any_value(), any_value()).thenRaise(UpstreamError("Failed!"))
 
     actual_list = proxy_package_index.list_versions("spam")
 
     assert_that(actual_list).is_equal_to(['0.1.2', '1.2.3', '2.3.4'])
-    verify(pypiproxy.packageindex.urllib2).urlopen(
-        "http://pypi.python.org/simple/spam/")
-    os.environ = cached_environment
+    verify(upstream_client).open("http://pypi.python.org/simple/spam/", {})
 
 
 @test
 @given(temp_dir=TemporaryDirectoryFixture)
 @after(unstub)
 def ensure_list_versions_retrieves_versions_from_pypi_with_md5_hash_in_href(temp_dir):
+    upstream_client = mock()
     proxy_package_index = ProxyPackageIndex(
-        "cached", temp_dir.join("packages"), "http://pypi.python.org")
-    package_stream = StringIO("""<!doctype html><html><body>
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", upstream_client=upstream_client)
+    package_stream = _UpstreamResponse("""<!doctype html><html><body>
 <a href='package-0.1.2.tar.gz#md5=foobar'>package-0.1.2.tar.gz</a><br/>
 <a href='package-1.2.3.tar.gz#md5=foobar'>package-1.2.3.tar.gz</a><br/>
 <a href='package-1.2.3.egg#md5=foobar'>package-1.2.3.egg</a><br/>
@@ -199,17 +374,345 @@ def ensure_list_versions_retrieves_versions_from_pypi_with_md5_hash_in_href(temp
 <a href="package-3.01.tar.gz#md5=foobar" rel="download">3.01 download_url</a><br/>
 <a href="package" rel="homepage">3.02 home_page</a><br/>
 </body></html>""")
-    cached_environment = os.environ
-    os.environ = {}
-    when(pypiproxy.packageindex.urllib2).urlopen(
-        any_value()).thenReturn(package_stream)
+    when(upstream_client).open(any_value(), any_value()).thenReturn(package_stream)
 
     actual_list = proxy_package_index.list_versions("package")
 
     assert_that(actual_list).is_equal_to(['0.1.2', '1.2.3', '2.3.4', '3.01'])
-    verify(pypiproxy.packageindex.urllib2).urlopen(
-        "http://pypi.python.org/simple/package/")
-    os.environ = cached_environment
+    verify(upstream_client).open("http://pypi.python.org/simple/package/", {})
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_list_versions_stores_versions_from_pypi_in_version_cache(temp_dir):
+    version_cache = VersionCache(temp_dir.join("versions"), 60)
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", version_cache=version_cache,
+        upstream_client=upstream_client)
+    when(upstream_client).open(any_value(), any_value()).thenReturn(
+        _UpstreamResponse("<a href='spam-0.1.2.tar.gz'>spam-0.1.2.tar.gz</a>"))
+
+    actual_list = proxy_package_index.list_versions("spam")
+
+    assert_that(actual_list).is_equal_to(['0.1.2'])
+    assert_that(version_cache.get("spam").versions).is_equal_to(['0.1.2'])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_list_versions_serves_fresh_versions_from_version_cache_without_asking_pypi(temp_dir):
+    version_cache = VersionCache(temp_dir.join("versions"), 60)
+    version_cache.put("spam", ["0.1.2", "1.2.3"])
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", version_cache=version_cache,
+        upstream_client=upstream_client)
+    when(upstream_client).open(any_value(), any_value()).thenRaise(UpstreamError("Failed!"))
+
+    actual_list = proxy_package_index.list_versions("spam")
+
+    assert_that(actual_list).is_equal_to(['0.1.2', '1.2.3'])
+    verify(upstream_client, times=0).open(any_value(), any_value())
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_list_versions_keeps_stale_versions_when_refresh_from_pypi_fails(temp_dir):
+    version_cache = VersionCache(temp_dir.join("versions"), 60)
+    version_cache.put("spam", ["0.1.2"]).fetched_at = 0
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", version_cache=version_cache,
+        upstream_client=upstream_client)
+    when(upstream_client).open(any_value(), any_value()).thenRaise(UpstreamError("Failed!"))
+
+    proxy_package_index._refresh_versions("spam")
+    actual_list = proxy_package_index.list_versions("spam")
+
+    assert_that(actual_list).is_equal_to(['0.1.2'])
+    assert_that(version_cache.is_stale(version_cache.get("spam"))).is_true()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_refresh_of_versions_sends_conditional_request_and_keeps_versions_when_not_modified(temp_dir):
+    metrics.reset()
+    version_cache = VersionCache(temp_dir.join("versions"), 60)
+    version_cache.put("spam", ["0.1.2"], Validators('"abc"', None, 123)).fetched_at = 0
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", version_cache=version_cache,
+        upstream_client=upstream_client)
+    when(upstream_client).open(any_value(), any_value()).thenReturn(
+        _UpstreamResponse("", status=304))
+
+    proxy_package_index._refresh_versions("spam")
+
+    entry = version_cache.get("spam")
+    assert_that(entry.versions).is_equal_to(["0.1.2"])
+    assert_that(version_cache.is_stale(entry)).is_false()
+    assert_that(metrics.get_value("upstream.not_modified")).is_equal_to(1)
+    assert_that(metrics.get_value("upstream.bytes_saved")).is_equal_to(123)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_list_available_package_names_returns_previous_names_when_index_is_not_modified(temp_dir):
+    metrics.reset()
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", upstream_client=upstream_client)
+    proxy_package_index._upstream_index = _UpstreamIndex(["spam", "eggs"], Validators(None, "yesterday", 1024), 0)
+    when(upstream_client).open(any_value(), any_value()).thenReturn(
+        _UpstreamResponse("", status=304))
+
+    actual_list = proxy_package_index.list_available_package_names()
+
+    assert_that(actual_list).is_equal_to(["spam", "eggs"])
+    assert_that(metrics.get_value("upstream.conditional_requests")).is_equal_to(1)
+    assert_that(metrics.get_value("upstream.bytes_saved")).is_equal_to(1024)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_list_available_package_names_returns_names_from_index_snapshot_without_asking_pypi(temp_dir):
+    index_snapshot = IndexSnapshot(temp_dir.join("index.gz"))
+    index_snapshot.store(["spam", "eggs", "spam"], None, 0)
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", upstream_client=upstream_client,
+        index_snapshot=index_snapshot)
+
+    actual_list = proxy_package_index.list_available_package_names()
+
+    assert_that(actual_list).is_equal_to(["eggs", "spam"])
+    verify(upstream_client, times=0).open(any_value(), any_value())
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_refresh_of_index_stores_names_from_pypi_in_index_snapshot(temp_dir):
+    index_snapshot = IndexSnapshot(temp_dir.join("index.gz"))
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", upstream_client=upstream_client,
+        index_snapshot=index_snapshot)
+    when(upstream_client).open(any_value(), any_value()).thenReturn(
+        _UpstreamResponse("<a href='alpha'>alpha</a><br/>\n<a href='beta'>beta</a><br/>\n",
+                          headers={"ETag": '"abc"'}))
+
+    proxy_package_index._refresh_index()
+
+    assert_that(proxy_package_index.list_available_package_names()).is_equal_to(["alpha", "beta"])
+    names, validators, _ = index_snapshot.load()
+    assert_that(names).is_equal_to(["alpha", "beta"])
+    assert_that(validators.etag).is_equal_to('"abc"')
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def ensure_reload_of_index_loads_snapshot_stored_by_another_process(temp_dir):
+    index_snapshot = IndexSnapshot(temp_dir.join("index.gz"))
+    index_snapshot.store(["spam"], None, 0)
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", index_snapshot=index_snapshot)
+    initial_generation = proxy_package_index.generation
+
+    assert_that(proxy_package_index._reload_index()).is_false()
+
+    IndexSnapshot(temp_dir.join("index.gz")).store(["spam", "eggs"], None, 1)
+    os.utime(temp_dir.join("index.gz"), (time.time() + 10, time.time() + 10))
+
+    assert_that(proxy_package_index._reload_index()).is_true()
+    assert_that(proxy_package_index.list_available_package_names()).is_equal_to(["eggs", "spam"])
+    assert_that(proxy_package_index.generation).is_not_equal_to(initial_generation)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_refresh_of_index_sorts_names_and_changes_generation_only_when_index_changed(temp_dir):
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex(
+        "cached", temp_dir.join("packages"), "http://pypi.python.org", upstream_client=upstream_client)
+    initial_generation = proxy_package_index.generation
+    when(upstream_client).open(any_value(), any_value()).thenReturn(
+        _UpstreamResponse("<a href='gamma'>gamma</a><br/>\n<a href='alpha'>alpha</a><br/>\n"
+                          "<a href='gamma'>gamma</a><br/>\n", headers={"ETag": '"abc"'})).thenReturn(
+        _UpstreamResponse("", status=304))
+
+    assert_that(proxy_package_index.list_available_package_names()).is_equal_to(["alpha", "gamma"])
+    generation_after_refresh = proxy_package_index.generation
+    assert_that(proxy_package_index.list_available_package_names()).is_equal_to(["alpha", "gamma"])
+
+    assert_that(generation_after_refresh).is_not_equal_to(initial_generation)
+    assert_that(proxy_package_index.generation).is_equal_to(generation_after_refresh)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_versions_upstream_could_not_find_are_not_requested_again(temp_dir):
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"), "http://pypi.python.org",
+                                            upstream_client=upstream_client, negative_cache=NegativeCache())
+    when(upstream_client).open(any_value(), any_value()).thenReturn(_UpstreamResponse("", status=404))
+
+    assert_that(proxy_package_index.list_versions("spam")).is_equal_to([])
+    assert_that(proxy_package_index.list_versions("spam")).is_equal_to([])
+
+    verify(upstream_client, times=1).open("http://pypi.python.org/simple/spam/", {})
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_versions_are_requested_again_when_upstream_failed(temp_dir):
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"), "http://pypi.python.org",
+                                            upstream_client=upstream_client, negative_cache=NegativeCache())
+    when(upstream_client).open(any_value(), any_value()).thenReturn(_UpstreamResponse("", status=503))
+
+    proxy_package_index.list_versions("spam")
+    proxy_package_index.list_versions("spam")
+
+    verify(upstream_client, times=2).open("http://pypi.python.org/simple/spam/", {})
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_package_upstream_could_not_find_is_requested_again_after_forgetting_misses(temp_dir):
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"), "http://pypi.python.org",
+                                            upstream_client=upstream_client, negative_cache=NegativeCache())
+    when(upstream_client).open(any_value(), any_value()).thenReturn(_UpstreamResponse("", status=404))
+    package_url = "http://pypi.python.org/packages/source/s/spam/spam-0.1.tar.gz"
+
+    assert_that(proxy_package_index.open_package("spam", "0.1")).is_none()
+    assert_that(proxy_package_index.open_package("spam", "0.1")).is_none()
+    proxy_package_index.forget_misses("spam")
+    proxy_package_index.open_package("spam", "0.1")
+
+    verify(upstream_client, times=2).open(package_url, {})
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_list_versions_serves_stale_versions_from_version_cache_when_circuit_is_open(temp_dir):
+    upstream_client = mock()
+    version_cache = VersionCache(temp_dir.join("versions"), time_to_live=0)
+    version_cache.put("spam", ["0.1", "0.2"])
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"), "http://pypi.python.org",
+                                            upstream_client=upstream_client, version_cache=version_cache)
+    when(upstream_client).open(any_value(), any_value()).thenRaise(CircuitOpenError("Circuit is open"))
+
+    assert_that(proxy_package_index.list_versions("spam")).is_equal_to(["0.1", "0.2"])
+    assert_that(proxy_package_index.open_package("spam", "0.3")).is_none()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_versions_are_fetched_from_next_mirror_when_first_mirror_fails(temp_dir):
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"),
+                                            ["http://first.mirror", "http://second.mirror"],
+                                            upstream_client=upstream_client)
+    when(upstream_client).is_available(any_value()).thenReturn(True)
+    when(upstream_client).open("http://first.mirror/simple/spam/", {}).thenRaise(UpstreamError("Failed!"))
+    when(upstream_client).open("http://second.mirror/simple/spam/", {}).thenReturn(
+        _UpstreamResponse("<a href='spam-0.1.tar.gz'>"))
+
+    assert_that(proxy_package_index.list_versions("spam")).is_equal_to(["0.1"])
+    assert_that(proxy_package_index._mirrors.rank()).is_equal_to(["http://second.mirror", "http://first.mirror"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_mirror_is_ranked_last_when_reading_its_response_fails(temp_dir):
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"),
+                                            ["http://first.mirror", "http://second.mirror"],
+                                            upstream_client=upstream_client)
+    when(upstream_client).is_available(any_value()).thenReturn(True)
+    when(upstream_client).open("http://first.mirror/simple/spam/", {}).thenReturn(_FailingUpstreamResponse(""))
+
+    assert_that(proxy_package_index.list_versions("spam")).is_equal_to([])
+    assert_that(proxy_package_index._mirrors.rank()).is_equal_to(["http://second.mirror", "http://first.mirror"])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def ensure_versions_are_fetched_from_mirror_with_open_circuit_last(temp_dir):
+    upstream_client = mock()
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"),
+                                            ["http://first.mirror", "http://second.mirror"],
+                                            upstream_client=upstream_client)
+    when(upstream_client).is_available("http://first.mirror").thenReturn(False)
+    when(upstream_client).is_available("http://second.mirror").thenReturn(True)
+    when(upstream_client).open("http://second.mirror/simple/spam/", {}).thenReturn(
+        _UpstreamResponse("<a href='spam-0.1.tar.gz'>"))
+
+    assert_that(proxy_package_index.list_versions("spam")).is_equal_to(["0.1"])
+    verify(upstream_client, times=0).open("http://first.mirror/simple/spam/", {})
+
+
+class _SlowUpstreamClient(object):
+    def __init__(self, delays):
+        self._delays = delays
+        self.responses = []
+
+    def is_available(self, url):
+        return True
+
+    def open(self, url, headers):
+        time.sleep(self._delays[url.split("/")[2]])
+        response = _UpstreamResponse("<a href='{0}-0.1.tar.gz'>".format(url.split("/")[2].split(".")[0]))
+        self.responses.append(response)
+        return response
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def ensure_versions_page_is_requested_from_second_mirror_when_first_does_not_answer_within_hedge_delay(temp_dir):
+    metrics.reset()
+    upstream_client = _SlowUpstreamClient({"slow.mirror": 0.5, "fast.mirror": 0})
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"),
+                                            ["http://slow.mirror", "http://fast.mirror"],
+                                            upstream_client=upstream_client, hedge_delay=0.05)
+
+    assert_that(proxy_package_index.list_versions("fast")).is_equal_to(["0.1"])
+    assert_that(metrics.get_value("upstream.hedged_requests")).is_equal_to(1)
+
+    time.sleep(0.6)
+    assert_that([response.closed for response in upstream_client.responses]).is_equal_to([True, True])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def ensure_no_hedged_request_is_sent_when_first_mirror_answers_within_hedge_delay(temp_dir):
+    metrics.reset()
+    upstream_client = _SlowUpstreamClient({"first.mirror": 0, "second.mirror": 0})
+    proxy_package_index = ProxyPackageIndex("cached", temp_dir.join("packages"),
+                                            ["http://first.mirror", "http://second.mirror"],
+                                            upstream_client=upstream_client, hedge_delay=1)
+
+    assert_that(proxy_package_index.list_versions("first")).is_equal_to(["0.1"])
+    assert_that(metrics.get_value("upstream.hedged_requests")).is_equal_to(0)
+    assert_that(len(upstream_client.responses)).is_equal_to(1)
+
 
 if __name__ == "__main__":
     from pyfix import run_tests
@@ -0,0 +1,56 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+from pyfix import test, run_tests
+from pyassert import assert_that
+from mockito import mock, verify
+
+from pypiproxy import server
+
+
+@test
+def run_should_run_flask_server_in_flask_mode():
+    application = mock()
+
+    server.run(application, server.SERVER_MODE_FLASK, host="localhost", port=8080, debug=True)
+
+    verify(application).run(host="localhost", port=8080, debug=True)
+
+
+@test
+def run_should_raise_exception_when_server_mode_is_unknown():
+    def callback():
+        server.run(mock(), "spam")
+
+    assert_that(callback).raises(ValueError)
+
+
+@test
+def prepare_should_raise_exception_when_server_mode_is_unknown():
+    def callback():
+        server.prepare("spam")
+
+    assert_that(callback).raises(ValueError)
+
+
+@test
+def prepare_should_accept_flask_mode():
+    server.prepare(server.SERVER_MODE_FLASK)
+
+
+if __name__ == "__main__":
+    run_tests()
@@ -17,27 +17,118 @@ __author__ = "Alexander Metzner"
 
 from pyfix import test, after
 from pyassert import assert_that
-from mockito import mock, verify, unstub, when, any as any_value
+from mockito import mock, verify, unstub, when, never, any as any_value
 
 import pypiproxy.services
+from pypiproxy.packageindex import PackageStatistics
 
 @test
 @after(unstub)
 def ensure_that_list_available_package_names_delegates_to_hosted_packages_index_and_proxy():
-    pypiproxy.services._hosted_packages_index = mock()
-    when(pypiproxy.services._hosted_packages_index).list_available_package_names().thenReturn(["spam", "eggs"])
-
-    pypiproxy.services._proxy_packages_index = mock()
-    when(pypiproxy.services._proxy_packages_index).list_available_package_names().thenReturn(["ham", "salt", "pepper"])
+    _mock_package_indexes(["eggs", "spam"], ["ham", "pepper", "salt"])
 
-    actual_list = pypiproxy.services.list_available_package_names()
+    actual_names = pypiproxy.services.list_available_package_names()
 
-    assert_that(actual_list).is_equal_to(["eggs", "ham", "pepper", "salt", "spam"])
+    assert_that(list(actual_names)).is_equal_to(["eggs", "ham", "pepper", "salt", "spam"])
 
     verify(pypiproxy.services._hosted_packages_index).list_available_package_names()
     verify(pypiproxy.services._proxy_packages_index).list_available_package_names()
 
 
+@test
+@after(unstub)
+def ensure_that_list_available_package_names_lists_names_both_hosted_and_cached_once():
+    _mock_package_indexes(["eggs", "spam"], ["eggs", "ham"])
+
+    actual_names = pypiproxy.services.list_available_package_names()
+
+    assert_that(list(actual_names)).is_equal_to(["eggs", "ham", "spam"])
+
+
+@test
+@after(unstub)
+def ensure_that_list_available_package_names_remembers_merged_names_while_generations_do_not_change():
+    _mock_package_indexes(["eggs", "spam"], ["ham"])
+    list(pypiproxy.services.list_available_package_names())
+
+    when(pypiproxy.services._hosted_packages_index).list_available_package_names().thenReturn(["salt"])
+    actual_names = pypiproxy.services.list_available_package_names()
+
+    assert_that(list(actual_names)).is_equal_to(["eggs", "ham", "spam"])
+    verify(pypiproxy.services._proxy_packages_index, times=1).list_available_package_names()
+
+    pypiproxy.services._hosted_packages_index.generation = 2
+    actual_names = pypiproxy.services.list_available_package_names()
+
+    assert_that(list(actual_names)).is_equal_to(["ham", "salt"])
+
+
+@test
+@after(unstub)
+def ensure_that_list_available_package_names_lists_indexes_every_time_when_upstream_is_asked_while_listing():
+    _mock_package_indexes(["eggs", "spam"], ["ham"])
+    pypiproxy.services._proxy_packages_index.refreshes_index_in_background = False
+    list(pypiproxy.services.list_available_package_names())
+
+    when(pypiproxy.services._hosted_packages_index).list_available_package_names().thenReturn(["salt"])
+    actual_names = pypiproxy.services.list_available_package_names()
+
+    assert_that(list(actual_names)).is_equal_to(["ham", "salt"])
+    verify(pypiproxy.services._proxy_packages_index, times=2).list_available_package_names()
+
+
+@test
+@after(unstub)
+def ensure_that_package_names_digest_depends_only_on_package_names():
+    _mock_package_indexes(["eggs", "spam"], ["ham"])
+    digest = pypiproxy.services.get_package_names_digest()
+
+    _mock_package_indexes(["eggs"], ["ham", "spam"])
+    pypiproxy.services._proxy_packages_index.generation = (7, None)
+    pypiproxy.services._hosted_packages_index.generation = 3
+
+    assert_that(pypiproxy.services.get_package_names_digest()).is_equal_to(digest)
+
+    _mock_package_indexes(["eggs"], ["ham"])
+
+    assert_that(pypiproxy.services.get_package_names_digest()).is_not_equal_to(digest)
+
+
+@test
+@after(unstub)
+def ensure_that_package_names_digest_is_computed_once_per_generation():
+    _mock_package_indexes(["eggs", "spam"], ["ham"])
+
+    digest = pypiproxy.services.get_package_names_digest()
+
+    assert_that(pypiproxy.services.get_package_names_digest()).is_equal_to(digest)
+    verify(pypiproxy.services._hosted_packages_index, times=1).list_available_package_names()
+
+
+@test
+@after(unstub)
+def ensure_that_package_names_digest_is_unknown_when_upstream_is_asked_while_listing():
+    _mock_package_indexes(["eggs", "spam"], ["ham"])
+    pypiproxy.services._proxy_packages_index.refreshes_index_in_background = False
+
+    assert_that(pypiproxy.services.get_package_names_digest()).is_none()
+    verify(pypiproxy.services._hosted_packages_index, never).list_available_package_names()
+
+
+def _mock_package_indexes(hosted_package_names, cached_package_names):
+    pypiproxy.services._merged_package_names = None
+
+    pypiproxy.services._hosted_packages_index = mock()
+    pypiproxy.services._hosted_packages_index.generation = 1
+    when(pypiproxy.services._hosted_packages_index).list_available_package_names().thenReturn(hosted_package_names)
+
+    pypiproxy.services._proxy_packages_index = mock()
+    pypiproxy.services._proxy_packages_index.generation = (1, None)
+    pypiproxy.services._proxy_packages_index.refreshes_index_in_background = True
+    when(pypiproxy.services._proxy_packages_index).list_available_package_names().thenReturn(cached_package_names)
+
+
+
 @test
 @after(unstub)
 def ensure_that_list_versions_delegates_to_hosted_packages_index_when_package_is_hosted():
@@ -116,18 +207,107 @@ def ensure_that_add_package_delegates_to_hosted_packages_index():
 
     pypiproxy.services.add_package("spam", "0.1.1", "any_buffer")
 
-    verify(pypiproxy.services._hosted_packages_index).add_package("spam", "0.1.1", "any_buffer")
+    verify(pypiproxy.services._hosted_packages_index).add_package("spam", "0.1.1", "any_buffer", None)
+
+
+@test
+def ensure_that_start_background_tasks_starts_all_tasks():
+    started_tasks = _mock_background_tasks(watch_package_directories=True)
+
+    pypiproxy.services.start_background_tasks()
+
+    assert_that(started_tasks).is_equal_to(["spam", "eggs", "watch"])
+
+
+@test
+def ensure_that_start_background_tasks_runs_tasks_once_in_first_worker_and_watches_in_all_workers():
+    started_tasks = _mock_background_tasks(watch_package_directories=False)
+
+    pypiproxy.services.start_background_tasks(0)
+    pypiproxy.services.start_background_tasks(1)
+
+    assert_that(started_tasks).is_equal_to(["spam", "eggs", "watch", "reload", "watch"])
+
+
+def _mock_background_tasks(watch_package_directories):
+    started_tasks = []
+    pypiproxy.services._background_tasks = [lambda: started_tasks.append("spam"), lambda: started_tasks.append("eggs")]
+    pypiproxy.services._replica_background_tasks = [lambda: started_tasks.append("reload")]
+    pypiproxy.services._watch_tasks = [lambda: started_tasks.append("watch")]
+    pypiproxy.services._watch_package_directories = watch_package_directories
+    return started_tasks
+
+
+@test
+@after(unstub)
+def ensure_that_get_package_names_generation_combines_generations_of_both_indexes():
+    _mock_package_indexes([], [])
+    pypiproxy.services._proxy_packages_index.refreshes_index_in_background = True
+
+    assert_that(pypiproxy.services.get_package_names_generation()).is_equal_to(
+        (pypiproxy.services._proxy_packages_index.generation, pypiproxy.services._hosted_packages_index.generation))
+
+
+@test
+@after(unstub)
+def ensure_that_get_package_names_generation_is_unknown_when_upstream_is_asked_while_listing():
+    _mock_package_indexes([], [])
+    pypiproxy.services._proxy_packages_index.refreshes_index_in_background = False
+
+    assert_that(pypiproxy.services.get_package_names_generation()).is_none()
 
 
 @test
 @after(unstub)
 def ensure_that_get_package_statistics_delegates_to_hosted_packages_index():
     pypiproxy.services._hosted_packages_index = mock()
-    when(pypiproxy.services._hosted_packages_index).count_packages().thenReturn(0)
+    when(pypiproxy.services._hosted_packages_index).get_statistics().thenReturn(PackageStatistics(3, 2, 1024))
 
     actual = pypiproxy.services.get_package_statistics()
 
-    assert_that(actual).is_equal_to((0, 0))
+    assert_that(actual).is_equal_to((3, 2))
 
-    verify(pypiproxy.services._hosted_packages_index).list_available_package_names()
-    verify(pypiproxy.services._hosted_packages_index).count_packages()
+    verify(pypiproxy.services._hosted_packages_index, never).count_packages()
+    verify(pypiproxy.services._hosted_packages_index, never).list_available_package_names()
+
+
+@test
+@after(unstub)
+def ensure_that_get_index_statistics_returns_statistics_of_both_indexes():
+    pypiproxy.services._hosted_packages_index = mock()
+    pypiproxy.services._proxy_packages_index = mock()
+    when(pypiproxy.services._hosted_packages_index).get_statistics().thenReturn(PackageStatistics(3, 2, 1024))
+    when(pypiproxy.services._proxy_packages_index).get_statistics().thenReturn(PackageStatistics(1, 1, 42))
+
+    actual = pypiproxy.services.get_index_statistics()
+
+    assert_that(actual).is_equal_to({"hosted": {"files": 3, "names": 2, "bytes": 1024},
+                                     "cached": {"files": 1, "names": 1, "bytes": 42}})
+
+
+@test
+@after(unstub)
+def ensure_that_get_package_file_returns_hosted_package_file():
+    pypiproxy.services._hosted_packages_index = mock()
+    pypiproxy.services._proxy_packages_index = mock()
+    package_file = mock()
+    when(pypiproxy.services._hosted_packages_index).get_package_file(any_value(), any_value()).thenReturn(package_file)
+
+    actual_file = pypiproxy.services.get_package_file("spam", "0.1.1")
+
+    assert_that(actual_file).is_equal_to(package_file)
+    verify(pypiproxy.services._proxy_packages_index, never).get_package_file(any_value(), any_value())
+
+
+@test
+@after(unstub)
+def ensure_that_get_package_file_uses_proxy_if_package_not_hosted():
+    pypiproxy.services._hosted_packages_index = mock()
+    pypiproxy.services._proxy_packages_index = mock()
+    package_file = mock()
+    when(pypiproxy.services._hosted_packages_index).get_package_file(any_value(), any_value()).thenReturn(None)
+    when(pypiproxy.services._proxy_packages_index).get_package_file(any_value(), any_value()).thenReturn(package_file)
+
+    actual_file = pypiproxy.services.get_package_file("spam", "0.1.1")
+
+    assert_that(actual_file).is_equal_to(package_file)
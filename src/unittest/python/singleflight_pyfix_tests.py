@@ -0,0 +1,83 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import threading
+import time
+
+from pyfix import test
+from pyassert import assert_that
+
+from pypiproxy.singleflight import SingleFlight
+
+
+@test
+def do_should_return_result_of_function():
+    assert_that(SingleFlight().do("key", lambda value: value * 2, 21)).is_equal_to(42)
+
+
+@test
+def do_should_call_function_once_for_concurrent_calls_with_the_same_key():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def function():
+        calls.append(1)
+        release.wait()
+        return "result"
+
+    leader = threading.Thread(target=lambda: results.append(single_flight.do("key", function)))
+    leader.start()
+    while not calls:
+        time.sleep(0.01)
+    followers = [threading.Thread(target=lambda: results.append(single_flight.do("key", function)))
+                 for _ in range(4)]
+    for follower in followers:
+        follower.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert_that(results).is_equal_to(["result"] * 5)
+    assert_that(calls).is_equal_to([1])
+
+
+@test
+def do_should_call_function_again_when_previous_call_has_finished():
+    single_flight = SingleFlight()
+    calls = []
+
+    single_flight.do("key", calls.append, 1)
+    single_flight.do("key", calls.append, 2)
+
+    assert_that(calls).is_equal_to([1, 2])
+
+
+@test
+def do_should_raise_exception_of_function():
+    def function():
+        raise ValueError("failed")
+
+    assert_that(lambda: SingleFlight().do("key", function)).raises(ValueError)
+
+
+if __name__ == "__main__":
+    from pyfix import run_tests
+
+    run_tests()
@@ -0,0 +1,149 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import StringIO
+
+from pyfix import test
+from pyassert import assert_that
+from mockito import mock, verify, never
+
+from pypiproxy.streaming import (CachingDownload, CountingReader, FileRangeIterator, UnsatisfiableRange,
+                                 iterate_segments, parse_range)
+
+
+@test
+def parse_range_should_return_none_when_no_range_is_given():
+    assert_that(parse_range(None, 10)).is_none()
+
+
+@test
+def parse_range_should_return_none_when_range_cannot_be_parsed():
+    assert_that(parse_range("bytes=0-1,5-6", 10)).is_none()
+
+
+@test
+def parse_range_should_return_first_and_last_byte_of_closed_range():
+    assert_that(parse_range("bytes=2-5", 10)).is_equal_to((2, 5))
+
+
+@test
+def parse_range_should_return_range_up_to_last_byte_when_range_is_open():
+    assert_that(parse_range("bytes=2-", 10)).is_equal_to((2, 9))
+
+
+@test
+def parse_range_should_return_trailing_bytes_when_suffix_range_is_given():
+    assert_that(parse_range("bytes=-3", 10)).is_equal_to((7, 9))
+
+
+@test
+def parse_range_should_limit_last_byte_to_size():
+    assert_that(parse_range("bytes=2-20", 10)).is_equal_to((2, 9))
+
+
+@test
+def parse_range_should_raise_exception_when_range_starts_beyond_size():
+    def callback():
+        parse_range("bytes=10-", 10)
+
+    assert_that(callback).raises(UnsatisfiableRange)
+
+
+@test
+def parse_range_should_return_none_when_last_byte_is_before_first_byte():
+    assert_that(parse_range("bytes=5-2", 10)).is_none()
+
+
+@test
+def file_range_iterator_should_yield_requested_bytes_in_chunks():
+    chunks = [chunk for chunk in FileRangeIterator(StringIO.StringIO("spam and eggs"), 2, 9, chunk_size=3)]
+
+    assert_that(chunks).is_equal_to(["am ", "and", " e"])
+
+
+@test
+def caching_download_should_write_chunks_and_commit_package_when_download_is_complete():
+    package_writer = mock()
+    package_writer.size = 13
+    download = CachingDownload(StringIO.StringIO("spam and eggs"), package_writer, 13, chunk_size=8)
+
+    chunks = [chunk for chunk in download]
+
+    assert_that(chunks).is_equal_to(["spam and", " eggs"])
+    verify(package_writer).write("spam and")
+    verify(package_writer).write(" eggs")
+    verify(package_writer).commit()
+
+
+@test
+def caching_download_should_discard_package_when_download_is_shorter_than_announced():
+    package_writer = mock()
+    package_writer.size = 13
+    download = CachingDownload(StringIO.StringIO("spam and eggs"), package_writer, 20)
+
+    def callback():
+        [chunk for chunk in download]
+
+    assert_that(callback).raises(IOError)
+    verify(package_writer).discard()
+    verify(package_writer, never).commit()
+
+
+@test
+def caching_download_should_complete_download_when_closed_before_download_is_complete():
+    package_writer = mock()
+    package_writer.size = 13
+    download = CachingDownload(StringIO.StringIO("spam and eggs"), package_writer, 13, chunk_size=4)
+
+    download.next()
+    download.close()
+
+    assert_that(download.wait()).is_true()
+    verify(package_writer).write(" egg")
+    verify(package_writer).write("s")
+    verify(package_writer).commit()
+    verify(package_writer, never).discard()
+
+
+@test
+def iterate_segments_should_yield_segments_split_across_chunks():
+    stream = StringIO.StringIO("alpha\nbeta\ngamma")
+
+    assert_that(list(iterate_segments(stream, "\n", chunk_size=3))).is_equal_to(["alpha", "beta", "gamma"])
+
+
+@test
+def iterate_segments_should_yield_empty_segments_between_separators():
+    stream = StringIO.StringIO("alpha\n\nbeta\n")
+
+    assert_that(list(iterate_segments(stream, "\n", chunk_size=4))).is_equal_to(["alpha", "", "beta"])
+
+
+@test
+def counting_reader_should_count_bytes_read():
+    counting_reader = CountingReader(StringIO.StringIO("content"))
+
+    counting_reader.read(4)
+    counting_reader.read(10)
+
+    assert_that(counting_reader.count).is_equal_to(7)
+
+
+if __name__ == "__main__":
+    from pyfix import run_tests
+
+    run_tests()
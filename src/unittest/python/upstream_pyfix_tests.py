@@ -0,0 +1,285 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+from mockito import when, unstub
+from pyfix import test, given, Fixture
+from pyassert import assert_that
+
+from pypiproxy import metrics
+from pypiproxy.upstream import (CircuitBreaker, CircuitOpenError, MirrorSelector, UpstreamClient, UpstreamError,
+                                read_proxy_settings)
+
+
+class _UpstreamRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/redirect":
+            self._respond(302, "", {"Location": "/simple/"})
+        elif self.path == "/truncated":
+            self.send_response(200)
+            self.send_header("Content-Length", "100")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write("spam")
+            self.close_connection = 1
+        elif self.headers.get("If-None-Match") == '"spam"':
+            self._respond(304, None, {"ETag": '"spam"'})
+        else:
+            self._respond(200, "<a href='spam'>spam</a>", {"ETag": '"spam"'})
+
+    def _respond(self, status, body, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, *arguments):
+        pass
+
+
+class _UpstreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UpstreamServerFixture(Fixture):
+    def provide(self):
+        metrics.reset()
+        self._server = _UpstreamServer(("127.0.0.1", 0), _UpstreamRequestHandler)
+        server_thread = threading.Thread(target=self._server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return ["http://127.0.0.1:{0}".format(self._server.server_port)]
+
+    def reclaim(self, url):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _read(client, url, headers=None):
+    response = client.open(url, headers)
+    try:
+        return response.status, response.read()
+    finally:
+        response.close()
+
+
+@test
+def read_proxy_settings_should_use_proxies_only_when_both_variables_are_set():
+    assert_that(read_proxy_settings({"http_proxy": "http://proxy:3128"})).is_equal_to({})
+    assert_that(read_proxy_settings({"http_proxy": "http://proxy:3128", "https_proxy": "http://proxy:3129"})
+                ).is_equal_to({"http": "http://proxy:3128", "https": "http://proxy:3129"})
+
+
+@test
+@given(upstream_url=UpstreamServerFixture)
+def open_should_reuse_connection_for_subsequent_requests(upstream_url):
+    client = UpstreamClient()
+
+    assert_that(_read(client, upstream_url + "/simple/")).is_equal_to((200, "<a href='spam'>spam</a>"))
+    assert_that(_read(client, upstream_url + "/simple/spam/")).is_equal_to((200, "<a href='spam'>spam</a>"))
+
+    assert_that(metrics.get_value("upstream.connections_opened")).is_equal_to(1)
+    assert_that(metrics.get_value("upstream.connections_reused")).is_equal_to(1)
+    client.close()
+
+
+@test
+@given(upstream_url=UpstreamServerFixture)
+def open_should_follow_redirect(upstream_url):
+    client = UpstreamClient()
+
+    assert_that(_read(client, upstream_url + "/redirect")).is_equal_to((200, "<a href='spam'>spam</a>"))
+    client.close()
+
+
+@test
+@given(upstream_url=UpstreamServerFixture)
+def open_should_return_not_modified_response_and_keep_connection(upstream_url):
+    client = UpstreamClient()
+
+    assert_that(_read(client, upstream_url + "/simple/", {"If-None-Match": '"spam"'})).is_equal_to((304, ""))
+    assert_that(_read(client, upstream_url + "/simple/")).is_equal_to((200, "<a href='spam'>spam</a>"))
+
+    assert_that(metrics.get_value("upstream.connections_reused")).is_equal_to(1)
+    client.close()
+
+
+@test
+def open_should_raise_upstream_error_when_connection_is_refused():
+    client = UpstreamClient(connect_timeout=1)
+
+    def callback():
+        client.open("http://127.0.0.1:1/simple/")
+
+    assert_that(callback).raises(UpstreamError)
+
+
+@test
+def circuit_breaker_should_open_after_consecutive_failures():
+    circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    circuit_breaker.record_failure()
+    circuit_breaker.record_success()
+    circuit_breaker.record_failure()
+    assert_that(circuit_breaker.state).is_equal_to(CircuitBreaker.CLOSED)
+
+    circuit_breaker.record_failure()
+    assert_that(circuit_breaker.state).is_equal_to(CircuitBreaker.OPEN)
+    assert_that(circuit_breaker.allow_request()).is_false()
+    assert_that(metrics.get_value("upstream.circuit_state")).is_equal_to(CircuitBreaker.OPEN)
+
+
+@test
+def circuit_breaker_should_let_one_trial_request_through_after_reset_timeout():
+    circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    try:
+        when(time).time().thenReturn(100)
+        circuit_breaker.record_failure()
+
+        when(time).time().thenReturn(130)
+        assert_that(circuit_breaker.allow_request()).is_true()
+        assert_that(circuit_breaker.state).is_equal_to(CircuitBreaker.HALF_OPEN)
+        assert_that(circuit_breaker.allow_request()).is_false()
+
+        circuit_breaker.record_success()
+        assert_that(circuit_breaker.state).is_equal_to(CircuitBreaker.CLOSED)
+        assert_that(circuit_breaker.allow_request()).is_true()
+    finally:
+        unstub()
+
+
+@test
+def circuit_breaker_should_open_again_when_trial_request_fails():
+    metrics.reset()
+    circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    circuit_breaker.record_failure()
+
+    assert_that(circuit_breaker.allow_request()).is_true()
+    circuit_breaker.record_failure()
+
+    assert_that(circuit_breaker.state).is_equal_to(CircuitBreaker.OPEN)
+    assert_that(metrics.get_value("upstream.circuit_opened")).is_equal_to(2)
+
+
+@test
+def open_should_raise_circuit_open_error_without_connecting_when_circuit_is_open():
+    metrics.reset()
+    client = UpstreamClient(connect_timeout=1,
+                            create_circuit_breaker=lambda host: CircuitBreaker(1, 30, host))
+
+    def callback():
+        client.open("http://127.0.0.1:1/simple/")
+
+    assert_that(callback).raises(UpstreamError)
+    assert_that(callback).raises(CircuitOpenError)
+    assert_that(metrics.get_value("upstream.connections_opened")).is_equal_to(1)
+    assert_that(metrics.get_value("upstream.rejected_requests")).is_equal_to(1)
+    assert_that(metrics.get_value("upstream.circuit_state.127.0.0.1:1")).is_equal_to(CircuitBreaker.OPEN)
+
+
+@test
+@given(upstream_url=UpstreamServerFixture)
+def circuit_breaker_should_count_failure_to_read_response(upstream_url):
+    client = UpstreamClient(create_circuit_breaker=lambda host: CircuitBreaker(1, 30, host))
+
+    def callback():
+        _read(client, upstream_url + "/truncated")
+
+    assert_that(callback).raises(UpstreamError)
+    assert_that(client.is_available(upstream_url + "/simple/")).is_false()
+    client.close()
+
+
+@test
+def is_available_should_tell_whether_circuit_of_upstream_is_open():
+    client = UpstreamClient(connect_timeout=1,
+                            create_circuit_breaker=lambda host: CircuitBreaker(1, 30, host))
+
+    def callback():
+        client.open("http://127.0.0.1:1/simple/")
+
+    assert_that(callback).raises(UpstreamError)
+    assert_that(client.is_available("http://127.0.0.1:1/simple/spam/")).is_false()
+    assert_that(client.is_available("http://127.0.0.1:2/simple/spam/")).is_true()
+
+
+@test
+def mirror_selector_should_keep_configured_order_until_latencies_are_known():
+    selector = MirrorSelector(["http://first/", "http://second", "http://third"])
+
+    assert_that(selector.rank()).is_equal_to(["http://first", "http://second", "http://third"])
+
+
+@test
+def mirror_selector_should_rank_available_mirrors_by_moving_average_of_latencies():
+    selector = MirrorSelector(["http://first", "http://second", "http://third"], smoothing=0.5)
+
+    selector.record_latency("http://first", 2.0)
+    selector.record_latency("http://second", 0.5)
+    selector.record_latency("http://third", 1.0)
+    selector.record_latency("http://second", 2.5)
+
+    assert_that(selector.get_latency("http://second")).is_equal_to(1.5)
+    assert_that(selector.rank()).is_equal_to(["http://third", "http://second", "http://first"])
+    assert_that(selector.rank(lambda url: url != "http://third")).is_equal_to(
+        ["http://second", "http://first", "http://third"])
+
+
+@test
+def mirror_selector_should_count_failure_as_penalty_latency():
+    selector = MirrorSelector(["http://first", "http://second"], failure_penalty=10.0)
+
+    selector.record_failure("http://first")
+    selector.record_latency("http://second", 3.0)
+
+    assert_that(selector.rank()).is_equal_to(["http://second", "http://first"])
+    assert_that(metrics.get_value("upstream.latency.http://first")).is_equal_to(10.0)
+
+
+@test
+def mirror_selector_should_probe_mirror_again_once_its_latency_is_older_than_probe_interval():
+    selector = MirrorSelector(["http://first", "http://second"], probe_interval=60)
+    selector.record_latency("http://first", 0.05)
+    selector.record_failure("http://first")
+    selector.record_latency("http://second", 0.3)
+
+    assert_that(selector.rank()).is_equal_to(["http://second", "http://first"])
+
+    selector._measured_at["http://first"] -= 60
+
+    assert_that(selector.rank()).is_equal_to(["http://first", "http://second"])
+
+    selector.record_latency("http://first", 0.05)
+
+    assert_that(selector.get_latency("http://first")).is_equal_to(0.05)
+    assert_that(selector.rank()).is_equal_to(["http://first", "http://second"])
+
+
+if __name__ == "__main__":
+    from pyfix import run_tests
+
+    run_tests()
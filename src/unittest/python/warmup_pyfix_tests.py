@@ -0,0 +1,109 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+from pyfix import after, test, given
+from pyfix.fixtures import TemporaryDirectoryFixture
+from pyassert import assert_that
+from mockito import when, mock, unstub, verify, any as any_value
+
+from pypiproxy.packageindex import PackageFile
+from pypiproxy.warmup import (CACHED, DOWNLOADED, FAILED, WarmUp, WarmUpReport, WarmUpResult, format_report,
+                              parse_requirements, read_requirements_file)
+
+
+@test
+def parse_requirements_should_read_pins_and_package_names():
+    lines = ["# comment\n", "\n", "spam==1.0\n", "eggs [extra] == 2.0 ; python_version < '3' # why\n",
+             "ham\n", "bacon==3.0 --hash=sha256:abc\n", "-e git+https://example.com/spam.git\n",
+             "--index-url http://example.com\n"]
+
+    assert_that(list(parse_requirements(lines))).is_equal_to(
+        [("spam", "1.0"), ("eggs", "2.0"), ("ham", None), ("bacon", "3.0")])
+
+
+@test
+def parse_requirements_should_skip_requirements_with_version_ranges():
+    assert_that(list(parse_requirements(["spam>=1.0", "eggs==1.0,<2"]))).is_equal_to([])
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def read_requirements_file_should_follow_includes(temp_dir):
+    temp_dir.create_file("base.txt", "spam==1.0\n")
+    temp_dir.create_file("requirements.txt", "-r base.txt\neggs==2.0\n")
+
+    assert_that(read_requirements_file(temp_dir.join("requirements.txt"))).is_equal_to(
+        [("spam", "1.0"), ("eggs", "2.0")])
+
+
+@test
+def format_report_should_include_throughput():
+    report = WarmUpReport(downloaded=4, cached=2, failed=1, bytes=4 * 1024 * 1024, seconds=2.0)
+
+    assert_that(format_report(report)).is_equal_to(
+        "Downloaded 4 package(s), 4.0 MB in 2.0 s (2.00 MB/s, 2.0 packages/s); 2 already cached, 1 failed")
+
+
+@test
+@after(unstub)
+def run_should_download_missing_packages_and_skip_cached_ones():
+    proxy_package_index = mock()
+    when(proxy_package_index).contains("spam", "1.0").thenReturn(True)
+    when(proxy_package_index).contains("eggs", "2.0").thenReturn(False)
+    when(proxy_package_index).get_package_file("eggs", "2.0").thenReturn(PackageFile("eggs-2.0.tar.gz", 42, 0))
+    when(proxy_package_index).contains("ham", "3.0").thenReturn(False)
+    when(proxy_package_index).get_package_file("ham", "3.0").thenReturn(None)
+    results = []
+
+    report = WarmUp(proxy_package_index, workers=2).run(
+        [("spam", "1.0"), ("eggs", "2.0"), ("ham", "3.0"), ("eggs", "2.0")], results.append)
+
+    assert_that(report[:4]).is_equal_to((1, 1, 1, 42))
+    assert_that(sorted(results)).is_equal_to([WarmUpResult("eggs", "2.0", DOWNLOADED, 42),
+                                              WarmUpResult("ham", "3.0", FAILED, 0),
+                                              WarmUpResult("spam", "1.0", CACHED, 0)])
+    verify(proxy_package_index, times=1).get_package_file("eggs", "2.0")
+
+
+@test
+@after(unstub)
+def run_should_resolve_package_name_to_latest_version():
+    proxy_package_index = mock()
+    when(proxy_package_index).list_versions("spam").thenReturn(["1.9", "1.10", "1.2"])
+    when(proxy_package_index).contains(any_value(), any_value()).thenReturn(True)
+    results = []
+
+    WarmUp(proxy_package_index).run([("spam", None)], results.append)
+
+    assert_that(results).is_equal_to([WarmUpResult("spam", "1.10", CACHED, 0)])
+
+
+@test
+@after(unstub)
+def run_should_report_package_without_versions_as_failed():
+    proxy_package_index = mock()
+    when(proxy_package_index).list_versions("spam").thenReturn([])
+
+    report = WarmUp(proxy_package_index).run([("spam", None)])
+
+    assert_that(report.failed).is_equal_to(1)
+
+
+if __name__ == "__main__":
+    from pyfix import run_tests
+
+    run_tests()
@@ -0,0 +1,147 @@
+#   pypiproxy
+#   Copyright 2012 Michael Gruber, Alexander Metzner
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Michael Gruber, Alexander Metzner"
+
+import errno
+import os
+import struct
+
+from pyfix import test, given
+from pyfix.fixtures import TemporaryDirectoryFixture
+from pyassert import assert_that
+from mockito import mock, verify, never, any as any_value
+
+from pypiproxy.watcher import PollingWatcher, InotifyWatcher
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def polling_watcher_should_not_notify_handler_when_directory_is_unchanged(temp_dir):
+    temp_dir.create_directory("packages")
+    handler = mock()
+    watcher = PollingWatcher(temp_dir.join("packages"), handler)
+
+    watcher.check()
+
+    verify(handler, never).directory_changed(any_value())
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def polling_watcher_should_notify_handler_when_modification_time_of_directory_changes(temp_dir):
+    temp_dir.create_directory("packages")
+    handler = mock()
+    watcher = PollingWatcher(temp_dir.join("packages"), handler)
+    os.utime(temp_dir.join("packages"), (0, 0))
+
+    watcher.check()
+
+    verify(handler).directory_changed(temp_dir.join("packages"))
+
+
+@test
+def inotify_watcher_should_report_added_and_removed_files():
+    handler = mock()
+    watcher = InotifyWatcher.__new__(InotifyWatcher)
+    watcher._directory = "packages"
+    watcher._handler = handler
+    watcher._watched_directories = {1: "packages"}
+
+    watcher._dispatch(_event(0x08, "spam-0.1.2.tar.gz") + _event(0x200, "eggs-0.1.2.tar.gz"))
+
+    verify(handler).file_added(os.path.join("packages", "spam-0.1.2.tar.gz"))
+    verify(handler).file_removed(os.path.join("packages", "eggs-0.1.2.tar.gz"))
+
+
+@test
+def inotify_watcher_should_request_resynchronization_when_event_queue_overflows():
+    handler = mock()
+    watcher = InotifyWatcher.__new__(InotifyWatcher)
+    watcher._directory = "packages"
+    watcher._handler = handler
+    watcher._watched_directories = {1: "packages"}
+
+    watcher._dispatch(_event(0x4000, ""))
+
+    verify(handler).directory_changed(None)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def inotify_watcher_should_watch_created_subdirectories(temp_dir):
+    temp_dir.create_directory("packages")
+    handler = mock()
+    watcher = InotifyWatcher(temp_dir.join("packages"), handler)
+    try:
+        temp_dir.create_directory("packages", "s", "spam")
+
+        watcher._dispatch(_event(0x40000100, "s"))
+
+        verify(handler).directory_changed(temp_dir.join("packages"))
+        assert_that(sorted(watcher._watched_directories.values())).is_equal_to(
+            [temp_dir.join("packages"), temp_dir.join("packages", "s"), temp_dir.join("packages", "s", "spam")])
+    finally:
+        watcher.stop()
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def inotify_watcher_should_raise_error_when_subdirectory_cannot_be_watched(temp_dir):
+    temp_dir.create_directory("packages", "s")
+
+    def callback():
+        _ExhaustedInotifyWatcher(temp_dir.join("packages"), mock())
+
+    assert_that(callback).raises(OSError)
+
+
+@test
+@given(temp_dir=TemporaryDirectoryFixture)
+def inotify_watcher_should_fall_back_to_polling_when_created_subdirectory_cannot_be_watched(temp_dir):
+    temp_dir.create_directory("packages")
+    handler = mock()
+    watcher = _ExhaustedInotifyWatcher(temp_dir.join("packages"), handler)
+    try:
+        temp_dir.create_directory("packages", "s")
+
+        watcher._dispatch(_event(0x40000100, "s"))
+
+        verify(handler).directory_changed(None)
+        assert_that(watcher._polling_watcher).is_not_none()
+    finally:
+        watcher.stop()
+
+
+class _ExhaustedInotifyWatcher(InotifyWatcher):
+    """
+        Can only watch the top level directory, as if there were no inotify watches left for the subdirectories.
+    """
+
+    def _add_watch(self, directory):
+        if directory != self._directory:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        super(_ExhaustedInotifyWatcher, self)._add_watch(directory)
+
+
+def _event(mask, name):
+    padded_name = name + "\0" * (16 - len(name) % 16) if name else ""
+    return struct.pack("iIII", 1, mask, 0, len(padded_name)) + padded_name
+
+
+if __name__ == "__main__":
+    from pyfix import run_tests
+
+    run_tests()
@@ -15,13 +15,18 @@
 
 __author__ = "Michael Gruber, Alexander Metzner"
 
+import gzip
+import os
 import StringIO
 
 from pyfix import test, run_tests, after, Fixture, given
+from pyfix.fixtures import TemporaryDirectoryFixture
 from pyassert import assert_that
-from mockito import when, verify, never, any as any_value, unstub
+from mockito import mock, when, verify, never, any as any_value, unstub
 
 from pypiproxy import webapp
+from pypiproxy.packageindex import PackageFile
+from pypiproxy.streaming import CachingDownload
 
 
 class FlaskWebAppFixture(Fixture):
@@ -44,6 +49,32 @@ def should_return_list_of_available_package_versions(web_application):
     verify(webapp).list_versions("committer")
 
 
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_send_not_modified_when_version_list_matches_etag(web_application):
+    when(webapp).list_versions(any_value()).thenReturn(["0.1.2", "0.1.3"])
+    etag = web_application.get("/simple/committer/").headers["ETag"]
+
+    response = web_application.get("/simple/committer/", headers={"If-None-Match": etag})
+
+    assert_that(response.status_code).is_equal_to(304)
+    assert_that(response.headers["Cache-Control"]).is_equal_to("public, max-age=60")
+
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_send_version_list_when_versions_have_changed(web_application):
+    when(webapp).list_versions(any_value()).thenReturn(["0.1.2"]).thenReturn(["0.1.2", "0.1.3"])
+    etag = web_application.get("/simple/committer/").headers["ETag"]
+
+    response = web_application.get("/simple/committer/", headers={"If-None-Match": etag})
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.data).contains("0.1.3")
+
+
 @test
 @given(web_application=FlaskWebAppFixture)
 @after(unstub)
@@ -61,6 +92,7 @@ def should_return_error_when_no_versions_available(web_application):
 @given(web_application=FlaskWebAppFixture)
 @after(unstub)
 def should_return_list_of_available_packages(web_application):
+    when(webapp).get_package_names_digest().thenReturn(None)
     when(webapp).list_available_package_names().thenReturn(["abc", "def", "ghi"])
 
     response = web_application.get("/simple/")
@@ -76,8 +108,23 @@ def should_return_list_of_available_packages(web_application):
 @test
 @given(web_application=FlaskWebAppFixture)
 @after(unstub)
-def should_return_package_content(web_application):
-    when(webapp).get_package_content(any_value(), any_value()).thenReturn("package content")
+def should_stream_list_of_available_packages(web_application):
+    when(webapp).get_package_names_digest().thenReturn(None)
+    when(webapp).list_available_package_names().thenReturn(iter(["abc", "def"]))
+
+    response = web_application.get("/simple/")
+
+    assert_that(response.is_streamed).is_true()
+    assert_that(response.headers["Content-Type"]).is_equal_to("text/html; charset=utf-8")
+    assert_that(response.data).contains('<a href="/simple/abc">abc</a><br/>')
+    assert_that(response.data).contains('<a href="/simple/def">def</a><br/>')
+
+
+@test
+@given(web_application=FlaskWebAppFixture, temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def should_return_package_content(web_application, temp_dir):
+    when(webapp).open_package(any_value(), any_value()).thenReturn(_create_package_file(temp_dir))
 
     response = web_application.get("/package/package_name/version/package_name-version.tar.gz")
 
@@ -87,21 +134,153 @@ def should_return_package_content(web_application):
         "attachment; filename=package_name-version.tar.gz")
     assert_that(response.headers.get("Content-Type", None)).is_equal_to(
         "application/x-gzip")
+    assert_that(response.headers.get("Content-Length", None)).is_equal_to("15")
 
-    verify(webapp).get_package_content("package_name", "version")
+    verify(webapp).open_package("package_name", "version")
+
+
+@test
+@given(web_application=FlaskWebAppFixture, temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def should_mark_package_content_as_immutable_with_validators(web_application, temp_dir):
+    package_file = _create_package_file(temp_dir)
+    when(webapp).open_package(any_value(), any_value()).thenReturn(package_file)
+
+    response = web_application.get("/package/package_name/version/package_name-version.tar.gz")
+
+    assert_that(response.headers.get("Cache-Control", None)).is_equal_to("public, max-age=31536000, immutable")
+    assert_that(response.headers.get("ETag", None)).is_equal_to('"f-{0:x}"'.format(int(package_file.mtime)))
+    assert_that(response.headers.get("Last-Modified", None)).is_not_none()
+
+
+@test
+@given(web_application=FlaskWebAppFixture, temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def should_send_not_modified_when_package_content_matches_etag(web_application, temp_dir):
+    package_file = _create_package_file(temp_dir)
+    when(webapp).open_package(any_value(), any_value()).thenReturn(package_file)
+
+    response = web_application.get("/package/package_name/version/package_name-version.tar.gz",
+                                   headers={"If-None-Match": '"f-{0:x}"'.format(int(package_file.mtime))})
+
+    assert_that(response.status_code).is_equal_to(304)
+    assert_that(response.data).is_equal_to("")
+
+
+@test
+@given(web_application=FlaskWebAppFixture, temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def should_send_package_content_when_etag_does_not_match(web_application, temp_dir):
+    when(webapp).open_package(any_value(), any_value()).thenReturn(_create_package_file(temp_dir))
+
+    response = web_application.get("/package/package_name/version/package_name-version.tar.gz",
+                                   headers={"If-None-Match": '"0-0"'})
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.data).is_equal_to("package content")
+
+
+@test
+@given(web_application=FlaskWebAppFixture, temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def should_return_partial_package_content_when_range_is_requested(web_application, temp_dir):
+    when(webapp).open_package(any_value(), any_value()).thenReturn(_create_package_file(temp_dir))
+
+    response = web_application.get("/package/package_name/version/package_name-version.tar.gz",
+                                   headers={"Range": "bytes=8-"})
+
+    assert_that(response.status_code).is_equal_to(206)
+    assert_that(response.data).is_equal_to("content")
+    assert_that(response.headers.get("Content-Range", None)).is_equal_to("bytes 8-14/15")
+    assert_that(response.headers.get("Content-Length", None)).is_equal_to("7")
+
+
+@test
+@given(web_application=FlaskWebAppFixture, temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def should_send_requested_range_not_satisfiable_when_range_is_beyond_package_content(web_application, temp_dir):
+    when(webapp).open_package(any_value(), any_value()).thenReturn(_create_package_file(temp_dir))
+
+    response = web_application.get("/package/package_name/version/package_name-version.tar.gz",
+                                   headers={"Range": "bytes=15-"})
+
+    assert_that(response.status_code).is_equal_to(416)
+    assert_that(response.headers.get("Content-Range", None)).is_equal_to("bytes */15")
+
+
+@test
+@given(web_application=FlaskWebAppFixture, temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def should_send_content_length_without_content_when_package_is_requested_with_head(web_application, temp_dir):
+    when(webapp).open_package(any_value(), any_value()).thenReturn(_create_package_file(temp_dir))
+
+    response = web_application.head("/package/package_name/version/package_name-version.tar.gz")
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.data).is_equal_to("")
+    assert_that(response.headers.get("Content-Length", None)).is_equal_to("15")
+
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_stream_package_content_when_package_is_downloaded_from_upstream(web_application):
+    package_writer = mock()
+    package_writer.size = 15
+    download = CachingDownload(StringIO.StringIO("package content"), package_writer, 15, chunk_size=4)
+    when(webapp).open_package(any_value(), any_value()).thenReturn(download)
+
+    response = web_application.get("/package/package_name/version/package_name-version.tar.gz")
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.data).is_equal_to("package content")
+    assert_that(response.headers.get("Content-Length", None)).is_equal_to("15")
+
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_send_content_length_without_waiting_for_download_when_package_is_requested_with_head(web_application):
+    download = mock()
+    download.size = 15
+    when(webapp).open_package(any_value(), any_value()).thenReturn(download)
+
+    response = web_application.head("/package/package_name/version/package_name-version.tar.gz")
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.data).is_equal_to("")
+    assert_that(response.headers.get("Content-Length", None)).is_equal_to("15")
+    verify(download).close()
+
+
+@test
+@given(web_application=FlaskWebAppFixture, temp_dir=TemporaryDirectoryFixture)
+@after(unstub)
+def should_open_package_again_when_package_file_has_been_deleted(web_application, temp_dir):
+    deleted_package_file = PackageFile(temp_dir.join("deleted-version.tar.gz"), 15, 0)
+    when(webapp).open_package(any_value(), any_value()).thenReturn(deleted_package_file).thenReturn(
+        _create_package_file(temp_dir))
+    when(webapp).forget_package_file(any_value()).thenReturn(None)
+
+    response = web_application.get("/package/package_name/version/package_name-version.tar.gz")
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.data).is_equal_to("package content")
+    verify(webapp).forget_package_file(deleted_package_file)
+    verify(webapp, times=2).open_package("package_name", "version")
 
 
 @test
 @given(web_application=FlaskWebAppFixture)
 @after(unstub)
 def should_send_not_found_when_trying_to_get_package_content_for_nonexisting_package(web_application):
-    when(webapp).get_package_content(any_value(), any_value()).thenReturn(None)
+    when(webapp).open_package(any_value(), any_value()).thenReturn(None)
 
     response = web_application.get("/package/package_name/version/package_name-version.tar.gz")
 
     assert_that(response.status_code).is_equal_to(404)
 
-    verify(webapp).get_package_content("package_name", "version")
+    verify(webapp).open_package("package_name", "version")
 
 
 @test
@@ -143,15 +322,33 @@ def should_send_bad_request_when_trying_to_upload_package_and_content_is_missing
 @given(web_application=FlaskWebAppFixture)
 @after(unstub)
 def should_send_ok_and_delegate_to_services_when_uploading_file(web_application):
-    when(webapp).add_package(any_value(), any_value(), any_value()).thenReturn(None)
+    uploaded_content = []
+    original_add_package = webapp.add_package
+    webapp.add_package = lambda name, version, stream, md5_digest: uploaded_content.append(
+        (name, version, stream.read(), md5_digest))
+    try:
+        response = web_application.post("/",
+            data={":action": "file_upload", "name": "name", "version": "version",
+                  "content": (StringIO.StringIO("content"), "name-version.tar.gz")})
+    finally:
+        webapp.add_package = original_add_package
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(uploaded_content).is_equal_to([("name", "version", "content", None)])
+
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_send_bad_request_when_md5_digest_of_uploaded_file_does_not_match(web_application):
+    when(webapp).add_package(any_value(), any_value(), any_value(), any_value()).thenRaise(ValueError("mismatch"))
 
     response = web_application.post("/",
-        data={":action": "file_upload", "name": "name", "version": "version",
+        data={":action": "file_upload", "name": "name", "version": "version", "md5_digest": "spam",
               "content": (StringIO.StringIO("content"), "name-version.tar.gz")})
 
-    assert_that(response.status_code).is_equal_to(200)
-
-    verify(webapp).add_package("name", "version", "content")
+    assert_that(response.status_code).is_equal_to(400)
+    verify(webapp).add_package("name", "version", any_value(), "spam")
 
 
 @test
@@ -165,5 +362,95 @@ def should_send_index_result(web_application):
 
     verify(webapp).get_package_statistics()
 
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_send_metrics_as_json(web_application):
+    when(webapp.metrics).snapshot().thenReturn({"upstream.bytes_saved": 42})
+    response = web_application.get("/metrics")
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.headers["Content-Type"]).is_equal_to("application/json")
+    assert_that(response.data).is_equal_to('{"upstream.bytes_saved": 42}')
+
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_send_statistics_as_json(web_application):
+    when(webapp).get_index_statistics().thenReturn({"hosted": {"files": 1}})
+    response = web_application.get("/stats")
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.headers["Content-Type"]).is_equal_to("application/json")
+    assert_that(response.data).is_equal_to('{"hosted": {"files": 1}}')
+
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_send_not_modified_without_listing_packages_when_digest_matches_etag(web_application):
+    when(webapp).get_package_names_digest().thenReturn("abc")
+    when(webapp).list_available_package_names().thenReturn(["abc"])
+    etag = web_application.get("/simple/").headers["ETag"]
+
+    response = web_application.get("/simple/", headers={"If-None-Match": etag})
+
+    assert_that(response.status_code).is_equal_to(304)
+    assert_that(response.headers["Cache-Control"]).is_equal_to("public, max-age=60")
+    verify(webapp, times=1).list_available_package_names()
+
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_send_package_list_without_etag_when_digest_is_unknown(web_application):
+    when(webapp).get_package_names_digest().thenReturn(None)
+    when(webapp).list_available_package_names().thenReturn(["abc"])
+
+    response = web_application.get("/simple/")
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.headers.get("ETag", None)).is_none()
+    assert_that(response.headers["Cache-Control"]).is_equal_to("public, max-age=60")
+
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_send_gzipped_package_list_when_client_accepts_gzip(web_application):
+    when(webapp).get_package_names_digest().thenReturn("def")
+    when(webapp).list_available_package_names().thenReturn(["abc"])
+
+    response = web_application.get("/simple/", headers={"Accept-Encoding": "gzip"})
+
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.headers["Content-Encoding"]).is_equal_to("gzip")
+    assert_that(response.headers["Vary"]).is_equal_to("Accept-Encoding")
+    assert_that(response.headers["ETag"]).ends_with('-gzip"')
+    assert_that(gzip.GzipFile(fileobj=StringIO.StringIO(response.data)).read()).contains(
+        '<a href="/simple/abc">abc</a><br/>')
+
+
+@test
+@given(web_application=FlaskWebAppFixture)
+@after(unstub)
+def should_compress_version_list_once_per_etag(web_application):
+    when(webapp).list_versions(any_value()).thenReturn(["0.1.4", "0.1.5"])
+
+    first_response = web_application.get("/simple/eggs/", headers={"Accept-Encoding": "gzip"})
+    second_response = web_application.get("/simple/eggs/", headers={"Accept-Encoding": "gzip"})
+
+    assert_that(second_response.data).is_equal_to(first_response.data)
+    assert_that(gzip.GzipFile(fileobj=StringIO.StringIO(second_response.data)).read()).contains("0.1.5")
+
+
+def _create_package_file(temp_dir):
+    temp_dir.create_file("package_name-version.tar.gz", "package content", binary=True)
+    path = temp_dir.join("package_name-version.tar.gz")
+    return PackageFile(path, 15, os.stat(path).st_mtime)
+
+
 if __name__ == "__main__":
     run_tests()